@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+from __future__ import division
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import fakeimgur
+
+OPT_DEFAULTS = {'comments':20000, 'latency':0.02, 'repeat':1,
+  'python':sys.executable}
+DESCRIPTION = """Time the tools end to end against a local fake Imgur API
+server (fakeimgur.py), with synthetic comment histories and simulated network
+latency. For each run, reports the wall-clock time, the number of API requests,
+the throughput, and the peak memory use of the process."""
+
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CLIENT_ID = 'benchmark'
+QUERY = 'upvote'
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**OPT_DEFAULTS)
+
+  parser.add_argument('-n', '--comments', type=int,
+    help='Number of comments in the history of the user being downloaded and '
+      'searched. Default: %(default)s')
+  parser.add_argument('-l', '--latency', type=float,
+    help='Seconds the fake server waits before answering each request. '
+      'Default: %(default)s')
+  parser.add_argument('-r', '--repeat', type=int,
+    help='Run each benchmark this many times, and report the fastest. '
+      'Default: %(default)s')
+  parser.add_argument('-p', '--python',
+    help='The Python interpreter to run the tools with. Default: %(default)s')
+  parser.add_argument('-b', '--benchmarks', nargs='+',
+    help='Only run these benchmarks. Default: all of them ('
+      +', '.join(name for (name, setup, args, items) in get_benchmarks(0))+')')
+
+  args = parser.parse_args()
+
+  fake = fakeimgur.FakeImgur(latency=args.latency, user_limit=10**9,
+    client_limit=10**9)
+  server = fakeimgur.start_server(fake)
+  work_dir = tempfile.mkdtemp(prefix='imgur-bench.')
+  cache_dir = os.path.join(work_dir, 'cache')
+  env = dict(os.environ)
+  env['IMGUR_API_DOMAIN'] = server.get_domain()
+  env['IMGUR_API_SCHEME'] = 'http'
+  env['IMGUR_CACHE_DIR'] = cache_dir
+
+  print '{:<24s} {:>9s} {:>9s} {:>14s} {:>12s}'.format('benchmark', 'seconds',
+    'requests', 'throughput', 'peak memory')
+  try:
+    for (name, setup, script_args, items) in get_benchmarks(args.comments):
+      if args.benchmarks and name not in args.benchmarks:
+        continue
+      best = None
+      for i in range(args.repeat):
+        if setup == 'cold':
+          shutil.rmtree(cache_dir, ignore_errors=True)
+        requests_before = fake.requests
+        (elapsed, max_rss) = run(args.python, script_args, env, work_dir)
+        requests = fake.requests - requests_before
+        if best is None or elapsed < best[0]:
+          best = (elapsed, requests, max_rss)
+      (elapsed, requests, max_rss) = best
+      if items:
+        throughput = '{:0.0f} comm/s'.format(items/elapsed)
+      else:
+        throughput = '{:0.1f} req/s'.format(requests/elapsed)
+      print '{:<24s} {:>9.2f} {:>9d} {:>14s} {:>9.1f} MB'.format(name, elapsed,
+        requests, throughput, max_rss/1024)
+      sys.stdout.flush()
+  finally:
+    server.shutdown()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def get_benchmarks(num_comments):
+  """Return a list of (name, setup, args, items) tuples for each benchmark.
+  "setup" is "cold" if the cache should be cleared first, "args" is the script
+  and its arguments, and "items" is the number of comments it processes (or 0 to
+  report requests per second instead)."""
+  user = 'bench_{}'.format(num_comments)
+  output_file = os.devnull
+  # Both downloads start from an empty cache, so neither can just read back
+  # what the other one cached.
+  return [
+    ('dl-comments', 'cold',
+      ['dl-comments.py', '-C', CLIENT_ID, '-u', user, '-q', '-o', output_file],
+      num_comments),
+    ('dl-comments --jobs 8', 'cold',
+      ['dl-comments.py', '-C', CLIENT_ID, '-u', user, '-q', '-o', output_file,
+        '-j', '8'],
+      num_comments),
+    ('search-comments cold', 'cold',
+      ['search-comments.py', '-C', CLIENT_ID, '-u', user, '-q', '-l', '0',
+        QUERY],
+      num_comments),
+    ('search-comments warm', None,
+      ['search-comments.py', '-C', CLIENT_ID, '-u', user, '-q', '-l', '0',
+        QUERY],
+      num_comments),
+    ('comment-survey', None,
+      ['comment-survey.py', '-C', CLIENT_ID],
+      0),
+  ]
+
+
+def run(python, script_args, env, work_dir):
+  """Run one of the tools, with its output discarded. Returns the elapsed
+  seconds and the peak resident memory of the process, in kilobytes."""
+  command = [python, os.path.join(SCRIPT_DIR, script_args[0])] + script_args[1:]
+  with open(os.devnull, 'w') as devnull:
+    start = time.time()
+    process = subprocess.Popen(command, env=env, cwd=work_dir, stdout=devnull)
+    (pid, status, rusage) = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+  process.returncode = status
+  if status != 0:
+    sys.stderr.write('Warning: "{}" exited with status {}.\n'.format(
+      ' '.join(script_args), status >> 8))
+  return (elapsed, rusage.ru_maxrss)
+
+
+if __name__ == '__main__':
+  main()
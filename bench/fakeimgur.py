@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""A local stand-in for the parts of the Imgur API these tools use, serving
+synthetic data, for benchmarking without spending real quota.
+Point the tools at it by setting IMGUR_API_DOMAIN to its host:port and
+IMGUR_API_SCHEME to "http"."""
+from __future__ import division
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import urlparse
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+OPT_DEFAULTS = {'host':'127.0.0.1', 'port':8080, 'comments':2000, 'latency':0,
+  'user_limit':12500, 'client_limit':12500}
+DESCRIPTION = """Run a fake Imgur API server with synthetic comment histories.
+Every user has "--comments" comments, unless their username ends in "_" and a
+number, in which case that's how many they have (so "user_50000" has
+50000)."""
+
+WORDS = ('the a of and to in is you that it he was for on are as with his they '
+  'at be this have from or one had by word but not what all were we when your '
+  'can said there use an each which she do how their if will up other about '
+  'out many then them these so some her would make like him into time has look '
+  'two more write go see number no way could people my than first water been '
+  'call who oil its now find long down day did get come made may part imgur '
+  'cat dog upvote gif meme op fp usersub frontpage lol wow').split()
+IMAGES_PER_PAGE = 60
+COMMENTS_PER_IMAGE = 30
+USER_POOL = 500
+START_TIME = 1400000000
+INTERVAL = 600
+ID_SPACING = 10**7
+
+
+class FakeImgur(object):
+  """The synthetic data and rate limit state behind the server. Each Client-ID
+  gets its own quotas, like on the real API."""
+
+  def __init__(self, comments=OPT_DEFAULTS['comments'], latency=0,
+      user_limit=OPT_DEFAULTS['user_limit'],
+      client_limit=OPT_DEFAULTS['client_limit']):
+    self.default_comments = comments
+    self.latency = latency
+    self.user_limit = user_limit
+    self.client_limit = client_limit
+    self.quotas = {}
+    self.user_reset = int(time.time()) + 60*60
+    self.requests = 0
+    self.users = {}
+    self.lock = threading.Lock()
+
+  def get_num_comments(self, user):
+    match = re.search(r'_(\d+)$', user)
+    if match:
+      return int(match.group(1))
+    else:
+      return self.default_comments
+
+  def get_account_id(self, user):
+    account_id = (zlib.crc32(user) & 0xffffff) + 1
+    self.users[account_id] = user
+    return account_id
+
+  def make_comment(self, user, i):
+    """Return the "i"th newest comment by "user"."""
+    account_id = self.get_account_id(user)
+    num_comments = self.get_num_comments(user)
+    rand = random.Random(account_id*ID_SPACING + i)
+    comment_id = account_id*ID_SPACING + num_comments - i
+    ups = rand.randrange(0, 200)
+    downs = rand.randrange(0, 20)
+    if rand.random() < 0.5:
+      parent_id = 0
+    else:
+      parent_id = comment_id - rand.randrange(1, 1000)
+    return {
+      'id':comment_id,
+      'image_id':'{:07x}'.format(rand.randrange(0x1000000, 0xfffffff))[:7],
+      'comment':u' '.join(rand.choice(WORDS)
+                          for j in range(rand.randrange(3, 40))),
+      'author':user,
+      'author_id':account_id,
+      'on_album':False,
+      'album_cover':None,
+      'ups':ups,
+      'downs':downs,
+      'points':ups-downs,
+      'datetime':START_TIME + (num_comments - i)*INTERVAL,
+      'parent_id':parent_id,
+      'deleted':False,
+      'vote':None,
+      'platform':'desktop',
+      'children':[],
+    }
+
+  def get_user_comment(self, comment_id):
+    (account_id, remainder) = divmod(comment_id, ID_SPACING)
+    user = self.users.get(account_id)
+    if user is None:
+      return None
+    num_comments = self.get_num_comments(user)
+    if 0 < remainder <= num_comments:
+      return self.make_comment(user, num_comments - remainder)
+    return None
+
+  def get_image_comments(self, image_id, new=True):
+    rand = random.Random(image_id)
+    comments = []
+    for i in range(COMMENTS_PER_IMAGE):
+      user = 'user{}'.format(rand.randrange(USER_POOL))
+      comment = self.make_comment(user, rand.randrange(
+        self.get_num_comments(user)))
+      comment['image_id'] = image_id
+      comments.append(comment)
+    if new:
+      return comments
+    # The full thread: the first third are top-level, the rest reply to an
+    # earlier comment.
+    roots = []
+    for (i, comment) in enumerate(comments):
+      if i < COMMENTS_PER_IMAGE // 3:
+        comment['parent_id'] = 0
+        roots.append(comment)
+      else:
+        parent = comments[rand.randrange(i)]
+        comment['parent_id'] = parent['id']
+        parent['children'].append(comment)
+    return roots
+
+  def handle(self, path, params, client_id=None):
+    """Return the (status, data) for a request."""
+    match = re.search(r'^/3/account/([^/]+)/comments/count$', path)
+    if match:
+      return (200, self.get_num_comments(match.group(1)))
+    match = re.search(r'^/3/account/([^/]+)/comments$', path)
+    if match:
+      user = match.group(1)
+      per_page = min(int(params.get('perPage', 50)), 100)
+      page = int(params.get('page', 0))
+      num_comments = self.get_num_comments(user)
+      start = page*per_page
+      end = min(start+per_page, num_comments)
+      return (200, [self.make_comment(user, i) for i in range(start, end)])
+    match = re.search(r'^/3/account/([^/]+)$', path)
+    if match:
+      user = match.group(1)
+      return (200, {'id':self.get_account_id(user), 'url':user})
+    match = re.search(r'^/3/comment/(\d+)$', path)
+    if match:
+      comment = self.get_user_comment(int(match.group(1)))
+      if comment is None:
+        return (404, {'error':'Unable to find a comment with the id'})
+      return (200, comment)
+    match = re.search(r'^/3/gallery/random/random/(\d+)$', path)
+    if match:
+      rand = random.Random(int(match.group(1)))
+      return (200, [{'id':'{:07x}'.format(rand.randrange(0x1000000, 0xfffffff))}
+                    for i in range(IMAGES_PER_PAGE)])
+    match = re.search(r'^/3/gallery/([^/]+)/comments/new$', path)
+    if match:
+      return (200, self.get_image_comments(match.group(1)))
+    match = re.search(r'^/3/gallery/([^/]+)/comments(?:/best|/top)?$', path)
+    if match:
+      return (200, self.get_image_comments(match.group(1), new=False))
+    if path == '/3/credits':
+      return (200, self.get_credits(client_id))
+    return (404, {'error':'Not found'})
+
+  def get_quota(self, client_id):
+    """Return the [UserRemaining, ClientRemaining] of "client_id"."""
+    quota = self.quotas.get(client_id)
+    if quota is None:
+      quota = self.quotas[client_id] = [self.user_limit, self.client_limit]
+    return quota
+
+  def get_credits(self, client_id=None):
+    (user_remaining, client_remaining) = self.get_quota(client_id)
+    return {
+      'UserLimit':self.user_limit,
+      'UserRemaining':user_remaining,
+      'UserReset':self.user_reset,
+      'ClientLimit':self.client_limit,
+      'ClientRemaining':client_remaining,
+    }
+
+  def spend(self, client_id=None):
+    """Count a request against the quotas of "client_id" and return the rate
+    limit headers."""
+    with self.lock:
+      self.requests += 1
+      quota = self.get_quota(client_id)
+      quota[0] = max(quota[0] - 1, 0)
+      quota[1] = max(quota[1] - 1, 0)
+      credits = self.get_credits(client_id)
+    return dict(('X-RateLimit-'+key, str(value))
+                for (key, value) in credits.items())
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    fake = self.server.fake
+    if fake.latency:
+      time.sleep(fake.latency)
+    url = urlparse.urlparse(self.path)
+    params = dict(urlparse.parse_qsl(url.query))
+    client_id = get_client_id(self.headers.get('Authorization', ''))
+    (status, data) = fake.handle(url.path, params, client_id=client_id)
+    body = json.dumps({'data':data, 'success':status == 200, 'status':status})
+    gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+    if gzipped:
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16+zlib.MAX_WBITS)
+      body = compressor.compress(body)+compressor.flush()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    if gzipped:
+      self.send_header('Content-Encoding', 'gzip')
+    self.send_header('Content-Length', str(len(body)))
+    for (header, value) in fake.spend(client_id).items():
+      self.send_header(header, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def get_client_id(authorization):
+  match = re.search(r'^Client-ID (.+)$', authorization)
+  if match:
+    return match.group(1)
+  return None
+
+
+class FakeImgurServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, fake):
+    BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+    self.fake = fake
+
+  def get_domain(self):
+    return '{}:{}'.format(*self.server_address)
+
+
+def start_server(fake, host=OPT_DEFAULTS['host'], port=0):
+  """Start a server for "fake" (a FakeImgur) in a background thread. With the
+  default "port" of 0, a free one is picked. Returns the server."""
+  server = FakeImgurServer((host, port), fake)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION)
+  parser.set_defaults(**OPT_DEFAULTS)
+
+  parser.add_argument('-H', '--host',
+    help='Address to listen on. Default: %(default)s')
+  parser.add_argument('-p', '--port', type=int,
+    help='Port to listen on. Default: %(default)s')
+  parser.add_argument('-n', '--comments', type=int,
+    help='Number of comments each user has. Default: %(default)s')
+  parser.add_argument('-l', '--latency', type=float,
+    help='Seconds to wait before answering each request. Default: '
+      '%(default)s')
+  parser.add_argument('--user-limit', type=int,
+    help='Requests allowed per user before the quota runs out. Default: '
+      '%(default)s')
+  parser.add_argument('--client-limit', type=int,
+    help='Requests allowed per client before the quota runs out. Default: '
+      '%(default)s')
+
+  args = parser.parse_args()
+
+  fake = FakeImgur(comments=args.comments, latency=args.latency,
+    user_limit=args.user_limit, client_limit=args.client_limit)
+  server = FakeImgurServer((args.host, args.port), fake)
+  sys.stderr.write('Serving on {}. Use IMGUR_API_DOMAIN={} '
+    'IMGUR_API_SCHEME=http\n'.format(server.get_domain(), server.get_domain()))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -3,19 +3,37 @@ from __future__ import division
 import re
 import os
 import sys
+import math
+import Queue
+import httplib
 import random
 import argparse
+import multiprocessing.pool
 import imgurlib
+import imgurcache
 
 CONFIG_FILE = 'default.args'  # must be in same directory as script
 RANDOM_PATH = '/3/gallery/random/random/{}'
 COMMENTS_PATH = '/3/gallery/{}/comments/new'
 COMMENT_COUNT_PATH = '/3/account/{}/comments/count'
+COUNT_TTL_PATTERN = r'^/3/account/[^/]+/comments/count$'
+RANDOM_PAGES = 51
+# Z-scores for the --confidence levels.
+Z_SCORES = {80:1.2816, 90:1.6449, 95:1.9600, 99:2.5758}
+# Don't trust the margin of error of a smaller sample than this.
+MIN_SAMPLE = 30
+# Hours to keep comment counts in survey mode, unless --count-ttl says.
+SURVEY_COUNT_TTL = 24
 
-OPT_DEFAULTS = {'per_image':2}
+OPT_DEFAULTS = {'per_image':2, 'jobs':8, 'pages':1, 'target':0,
+  'confidence':95, 'margin':0, 'count_ttl':None}
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Get a random-ish sample of users and the number of comments
-they've made. 2-column output: username and number of comments."""
+they've made. 2-column output: username and number of comments. By default,
+it's a few commenters from each image on a random gallery page. For bigger
+surveys, give a --target sample size: a uniform sample of that many is drawn
+from everyone who commented on the --pages, and only their counts are looked
+up."""
 EPILOG = """You can include command line arguments from a file by including the
 path to the file, prefixed with "@", as an argument (like "@dir/args.txt"). The
 file should contain normal command line options, one per line. Ones that take
@@ -34,47 +52,285 @@ def main():
   parser.set_defaults(**OPT_DEFAULTS)
 
   parser.add_argument('-n', '--per-image', type=int,
-    help='Comments per image.')
-  parser.add_argument('-C', '--client-id', required=True,
-    help='Imgur API Client-ID to use. Required, if not provided by an @ file '
-      'like @default.args.')
+    help='Comments per image (without --target).')
+  parser.add_argument('-p', '--pages', type=int,
+    help='Number of random gallery pages to draw commenters from. Default: '
+      '%(default)s')
+  parser.add_argument('-t', '--target', type=int,
+    help='Survey mode: sample this many distinct commenters, chosen uniformly '
+      'from everyone who commented on the --pages (replies included), and look '
+      'up only their counts.')
+  parser.add_argument('-m', '--margin', type=float,
+    help='In survey mode, stop early once the mean comment count is known to '
+      'within this fraction of it (like 0.05 for +/-5%%), at the --confidence '
+      'level. Default: keep going until the --target is reached.')
+  parser.add_argument('--confidence', type=int, choices=sorted(Z_SCORES),
+    help='Confidence level (in percent) for --margin. Default: %(default)s')
+  parser.add_argument('--count-ttl', type=float,
+    help='Keep users\' comment counts in the local cache for this many hours, '
+      'and reuse them instead of asking again. 0 turns this off. Default: '
+      +str(SURVEY_COUNT_TTL)+' in survey mode (with --target), otherwise off.')
+  parser.add_argument('-C', '--client-id', required=True, action='append',
+    help='Imgur API Client-ID to use. Give it more than once to spread the '
+      'requests over several, each going to the one with the most quota '
+      'left. Required, if not provided by an @ file like @default.args.')
   parser.add_argument('-u', '--user',
     help='Imgur username. For compatibility only; not required.')
+  parser.add_argument('-j', '--jobs', type=int,
+    help='Maximum number of requests to have in flight at once. Default: '
+      '%(default)s')
+  parser.add_argument('-w', '--wait-for-quota', action='store_true',
+    help='If the API request quota runs out, wait for it to reset instead of '
+      'exiting.')
+
+  parser.add_argument('--metrics', metavar='FILE',
+    help='Record metrics on the API requests made (counts, timings, bytes, and '
+      'the remaining quota) to this file. If it ends in ".prom", they\'re '
+      'written in the Prometheus text format at the end. Otherwise, a line of '
+      'JSON is appended for each request.')
+  parser.add_argument('--profile', action='store_true',
+    help='When done, print a breakdown of where the time went to stderr: by '
+      'phase of the API requests, then by function (from cProfile).')
 
   new_argv = imgurlib.include_args_from_file(sys.argv, CONFIG_FILE)
   args = parser.parse_args(new_argv)
+  args.client_id = imgurlib.set_client_ids(args.client_id)
 
-  # get random set of images
-  page = random.randrange(0,51)
-  path = RANDOM_PATH.format(page)
-  (response, images) = imgurlib.make_request(path, args.client_id)
-  imgurlib.handle_status(response.status)
+  if args.profile:
+    imgurlib.start_profiling()
+  if args.metrics:
+    imgurlib.enable_metrics(args.metrics)
 
-  sys.excepthook = catch_quota_except
-  for image in images:
-    # get comments per image
-    path = COMMENTS_PATH.format(image['id'])
-    (response, comments) = imgurlib.make_request(path, args.client_id)
-    imgurlib.handle_status(response.status)
+  if args.wait_for_quota:
+    imgurlib.SCHEDULER.max_wait = None
 
-    if args.per_image > len(comments):
-      comment_sample_size = len(comments)
-    else:
-      comment_sample_size = args.per_image
+  if args.count_ttl is None and args.target:
+    args.count_ttl = SURVEY_COUNT_TTL
+  if args.count_ttl:
+    ttls = [(COUNT_TTL_PATTERN, int(args.count_ttl*60*60))]
+    imgurcache.enable_response_cache(ttls=ttls+list(imgurlib.RESPONSE_TTLS))
 
-    for comment in random.sample(comments, comment_sample_size):
-      username = comment['author']
-      if username == '[deleted]':
-        sys.stderr.write('Deleted username. Skipping.\n')
-        continue
-      # get number of comments per user
-      path = COMMENT_COUNT_PATH.format(username)
-      (response, count) = imgurlib.make_request(path, args.client_id)
-      imgurlib.handle_status(response.status)
+  sys.excepthook = catch_quota_except
+  stats = RunningStats()
+  try:
+    images = get_images(args.pages, args.client_id)
+    if args.target:
+      results = survey_sample(images, args.client_id, args.target,
+        jobs=args.jobs, margin=args.margin, z=Z_SCORES[args.confidence],
+        stats=stats)
+    else:
+      results = survey(images, args.client_id, args.per_image, jobs=args.jobs)
+    for (username, count) in results:
       if not isinstance(count, int):
         sys.stderr.write('Non-integer count: '+str(count)[:70]+'\n')
         continue
       print "{}\t{}".format(username, count)
+      sys.stdout.flush()
+  except httplib.HTTPException as error:
+    fail('Error: '+str(error))
+
+  if args.target and stats.n:
+    sys.stderr.write('Counted {} commenters. Mean comments: {:0.1f} +/- {:0.1f} '
+      '({}% confidence)\n'.format(stats.n, stats.mean,
+        stats.error(Z_SCORES[args.confidence]), args.confidence))
+
+
+def get_images(num_pages, client_id):
+  """Return the images on "num_pages" different random gallery pages."""
+  images = []
+  image_ids = set()
+  for page in random.sample(range(RANDOM_PAGES), min(num_pages, RANDOM_PAGES)):
+    path = RANDOM_PATH.format(page)
+    (response, page_images) = imgurlib.make_request(path, client_id)
+    imgurlib.handle_status(response.status)
+    for image in page_images:
+      if image['id'] not in image_ids:
+        image_ids.add(image['id'])
+        images.append(image)
+  return images
+
+
+def survey(images, client_id, per_image, jobs=1):
+  """Yield a (username, count) tuple for a sample of "per_image" commenters on
+  each of "images", in the order the counts come in.
+  The requests for each image's comments, and then for each sampled author's
+  comment count, are run by a pool of "jobs" threads. As soon as an image's
+  comments arrive, the count requests for its authors are queued, without
+  waiting for the other images. Each author's count is only requested once."""
+  results = Queue.Queue()
+  requested = set()
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    for image in images:
+      pool.apply_async(run_task, (results, 'authors', sample_authors, image,
+        client_id, per_image))
+    outstanding = len(images)
+    while outstanding:
+      # A timeout makes the wait interruptible by Ctrl+C.
+      (kind, value) = results.get(True, 3600)
+      outstanding -= 1
+      if kind == 'error':
+        (type_, exception, traceback) = value
+        raise type_, exception, traceback
+      elif kind == 'authors':
+        for username in value:
+          if username in requested:
+            continue
+          requested.add(username)
+          pool.apply_async(run_task, (results, 'count', get_count, username,
+            client_id))
+          outstanding += 1
+      elif kind == 'count':
+        yield value
+  finally:
+    pool.terminate()
+
+
+def survey_sample(images, client_id, target, jobs=1, margin=0,
+    z=Z_SCORES[95], stats=None):
+  """Yield a (username, count) tuple for each of a uniform random sample of
+  "target" distinct commenters on "images".
+  First the comments on every image are fetched (by a pool of "jobs"
+  threads), and the sample is kept up to date as they come in, so it's uniform
+  over everyone who commented, no matter how many that turns out to be. Then
+  the counts of just the sampled authors are looked up, in random order. If
+  "margin" is given, that stops as soon as the mean count is known to within
+  that fraction of it, at the confidence level of the z-score "z". The counts
+  are added to "stats" (a RunningStats) as they come in."""
+  if stats is None:
+    stats = RunningStats()
+  sampler = ReservoirSampler(target)
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    for authors in pool.imap_unordered(
+        lambda image: get_authors(image, client_id), images):
+      for username in authors:
+        sampler.add(username)
+    sample = list(sampler.sample)
+    random.shuffle(sample)
+    for (username, count) in pool.imap(
+        lambda username: get_count(username, client_id), sample):
+      yield (username, count)
+      if isinstance(count, int):
+        stats.add(count)
+        if margin and stats.is_within(margin, z):
+          break
+  finally:
+    pool.terminate()
+
+
+class ReservoirSampler(object):
+  """A uniform random sample of up to "size" distinct items from a stream of
+  them of unknown length, kept with reservoir sampling (Algorithm R). Repeats
+  of an item already seen are ignored."""
+
+  def __init__(self, size):
+    self.size = size
+    self.sample = []
+    self.seen = set()
+
+  def add(self, item):
+    if item in self.seen:
+      return
+    self.seen.add(item)
+    if len(self.sample) < self.size:
+      self.sample.append(item)
+    else:
+      i = random.randrange(len(self.seen))
+      if i < self.size:
+        self.sample[i] = item
+
+
+class RunningStats(object):
+  """The mean and variance of a stream of numbers, updated as each comes in
+  (with Welford's method)."""
+
+  def __init__(self):
+    self.n = 0
+    self.mean = 0.0
+    self.m2 = 0.0
+
+  def add(self, value):
+    self.n += 1
+    delta = value - self.mean
+    self.mean += delta / self.n
+    self.m2 += delta * (value - self.mean)
+
+  def stdev(self):
+    if self.n < 2:
+      return 0.0
+    return math.sqrt(self.m2 / (self.n - 1))
+
+  def error(self, z):
+    """Return the margin of error of the mean, for the z-score "z"."""
+    if self.n == 0:
+      return 0.0
+    return z * self.stdev() / math.sqrt(self.n)
+
+  def is_within(self, margin, z):
+    """Return whether the mean is known to within "margin" (a fraction of
+    it) at the confidence level of "z". Needs at least MIN_SAMPLE numbers."""
+    return (self.n >= MIN_SAMPLE and self.mean > 0
+            and self.error(z) <= margin * self.mean)
+
+
+def run_task(results, kind, function, *args):
+  """Call "function" with "args" and put its result on the "results" queue,
+  labeled with "kind". Exceptions are passed along as an "error"."""
+  try:
+    results.put((kind, function(*args)))
+  except Exception:
+    results.put(('error', sys.exc_info()))
+
+
+def sample_authors(image, client_id, per_image):
+  """Return the usernames of a random sample of "per_image" commenters on
+  "image"."""
+  # get comments per image
+  path = COMMENTS_PATH.format(image['id'])
+  (response, comments) = imgurlib.make_request(path, client_id)
+  imgurlib.handle_status(response.status, fatal=False)
+
+  if per_image > len(comments):
+    comment_sample_size = len(comments)
+  else:
+    comment_sample_size = per_image
+
+  usernames = []
+  for comment in random.sample(comments, comment_sample_size):
+    username = comment['author']
+    if username == '[deleted]':
+      sys.stderr.write('Deleted username. Skipping.\n')
+      continue
+    usernames.append(username)
+  return usernames
+
+
+def get_authors(image, client_id):
+  """Return the usernames of everyone who commented on "image" (including
+  replies), with repeats."""
+  path = COMMENTS_PATH.format(image['id'])
+  (response, comments) = imgurlib.make_request(path, client_id)
+  imgurlib.handle_status(response.status, fatal=False)
+  if not isinstance(comments, list):
+    return []
+  usernames = []
+  pending = list(comments)
+  while pending:
+    comment = pending.pop()
+    if comment['author'] != '[deleted]':
+      usernames.append(comment['author'])
+    pending.extend(comment.get('children') or ())
+  return usernames
+
+
+def get_count(username, client_id):
+  """Return a (username, count) tuple with the number of comments "username"
+  has made."""
+  path = COMMENT_COUNT_PATH.format(username)
+  (response, count) = imgurlib.make_request(path, client_id)
+  imgurlib.handle_status(response.status, fatal=False)
+  return (username, count)
 
 
 def catch_quota_except(type_, value, traceback):
@@ -4,21 +4,30 @@ import re
 import os
 import sys
 import json
+import errno
+import socket
+import httplib
 import argparse
 import imgurlib
 import imgurcache
 
 USER_AGENT = 'NBS comment-archiver'
 CONFIG_FILE = 'default.args'  # must be in same directory as script
-API_DOMAIN = 'api.imgur.com'
+API_DOMAIN = imgurlib.API_DOMAIN
 API_PATH_TEMPLATE = '/3/account/{}/comments'
+PER_PAGE = 100
+FORMATS = ('json', 'ndjson')
 
-OPT_DEFAULTS = {'limit':0, 'verbose':None,'quiet':None}
+OPT_DEFAULTS = {'limit':0, 'jobs':1, 'verbose':None,'quiet':None,
+  'format':'json'}
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Download all comments by an Imgur user. By default, comments
 will be printed to stdout in JSON format. Individual comments will be in the
 same structure as the Imgur API returns, and they will all be contained in one
-big list."""
+big list (or with --format ndjson, one per line). Either way, they're written
+out as they're downloaded, a page at a time (with --cache too: new comments
+come out as they're fetched, then the cached ones). Or, with --batch, archive
+the comments of a whole list of users into the local cache."""
 EPILOG = """You can include command line arguments from a file by including the
 path to the file, prefixed with "@", as an argument (like "@dir/args.txt"). The
 file should contain normal command line options, one per line. Ones that take
@@ -34,24 +43,76 @@ def main():
     fromfile_prefix_chars='@')
   parser.set_defaults(**OPT_DEFAULTS)
 
-  parser.add_argument('-u', '--user', required=True,
-    help='The username whose comments will be downloaded. Required (if not '
-    'provided by an @ file like @default.args).')
-  parser.add_argument('-C', '--client-id', required=True,
-    help='Imgur API Client-ID to use. Required (if not provided by an @ file '
-      'like @default.args).')
+  parser.add_argument('-u', '--user',
+    help='The username whose comments will be downloaded. Required (unless '
+    'using --batch), if not provided by an @ file like @default.args.')
+  parser.add_argument('-b', '--batch',
+    help='Archive the comments of every user listed in this file (one per '
+      'line, or "-" to read them from stdin) into the local cache, instead of '
+      'printing one user\'s comments. Users are added to a queue kept on disk, '
+      'so if the batch is interrupted (or the API quota runs out), running it '
+      'again resumes where it left off. Users already done are skipped, and '
+      'only ones whose downloads failed are retried with --retry-failed.')
+  parser.add_argument('--queue',
+    help='The file to keep the --batch queue in. Default: "'
+      +imgurcache.BATCH_QUEUE_FILENAME+'" in the cache directory.')
+  parser.add_argument('--retry-failed', action='store_true',
+    help='In --batch mode, retry the users whose downloads failed before.')
+  parser.add_argument('--skip-unchanged', action='store_true',
+    help='In --batch mode, skip users whose comment count matches the number '
+      'cached, without requesting any of their comments. That saves a request '
+      'per idle user, but misses new comments by users who deleted as many '
+      'old ones.')
+  parser.add_argument('-C', '--client-id', required=True, action='append',
+    help='Imgur API Client-ID to use. Give it more than once to spread the '
+      'requests over several, each going to the one with the most quota '
+      'left. Required (if not provided by an @ file like @default.args).')
   parser.add_argument('-o', '--output-file',
     help='A file to save the comments in, instead of printing to stdout.')
+  parser.add_argument('-f', '--format', choices=FORMATS,
+    help='How to write the comments: "json" is one JSON list of them all, and '
+      '"ndjson" is one JSON object per line, which other tools can read a line '
+      'at a time. Default: %(default)s')
   parser.add_argument('-l', '--limit', type=int,
     help='Maximum number of comments to output. Default: no limit.')
+  parser.add_argument('-c', '--cache', action='store_true',
+    help='Download through the local cache, instead of directly. The download '
+      'is saved to the cache as it goes, so if it\'s interrupted, running it '
+      'again resumes where it stopped, and only comments newer than the ones '
+      'already cached are downloaded. But cached comments keep the vote counts '
+      'they had when cached. Downloads with --limit are always direct.')
+  parser.add_argument('-j', '--jobs', type=int,
+    help='Number of pages of comments to download at once. Default: '
+      '%(default)s')
   parser.add_argument('-q', '--quiet', dest='quiet', action='store_true',
     help='Do not print anything but the results (even if there are none). '
       'Default: False')
   parser.add_argument('-v', '--verbose', action='store_true',
     help='Verbose output (print more than just the results). Default: True')
+  parser.add_argument('-w', '--wait-for-quota', action='store_true',
+    help='If the API request quota runs out, wait for it to reset instead of '
+      'exiting.')
+
+  parser.add_argument('--metrics', metavar='FILE',
+    help='Record metrics on the API requests made (counts, timings, bytes, and '
+      'the remaining quota) to this file. If it ends in ".prom", they\'re '
+      'written in the Prometheus text format at the end. Otherwise, a line of '
+      'JSON is appended for each request.')
+  parser.add_argument('--profile', action='store_true',
+    help='When done, print a breakdown of where the time went to stderr: by '
+      'phase of the API requests, then by function (from cProfile).')
 
   new_argv = imgurlib.include_args_from_file(sys.argv, CONFIG_FILE)
   args = parser.parse_args(new_argv)
+  args.client_id = imgurlib.set_client_ids(args.client_id)
+
+  if args.profile:
+    imgurlib.start_profiling()
+  if args.metrics:
+    imgurlib.enable_metrics(args.metrics)
+
+  if args.wait_for_quota:
+    imgurlib.SCHEDULER.max_wait = None
   
   if args.verbose:
     verbosity = 2
@@ -60,18 +121,146 @@ def main():
   else:
     verbosity = 2
 
-  comment_generator = imgurcache.get_live_comments(args.user, args.client_id,
-    limit=args.limit, user_agent=USER_AGENT, verbosity=verbosity)
-  comments = list(comment_generator)
+  if args.batch:
+    if args.output_file or args.limit:
+      fail('Error: --output-file and --limit can\'t be used with --batch.')
+    run_batch(args, verbosity)
+    return
+  if not args.user:
+    fail('Error: Either --user or --batch is required.')
 
-  if args.output_file:
-    with open(args.output_file, 'w') as filehandle:
-      json.dump(comments, filehandle)
+  if args.limit or not args.cache:
+    chunks = imgurcache.get_live_comment_chunks(args.user, args.client_id,
+      limit=args.limit, per_page=PER_PAGE, jobs=args.jobs,
+      user_agent=USER_AGENT, verbosity=verbosity)
   else:
-    print json.dumps(comments)
+    chunks = get_cached_comment_chunks(args, verbosity)
+
+  try:
+    if args.output_file:
+      with open(args.output_file, 'w') as filehandle:
+        total = write_comments(chunks, filehandle, args.format)
+    else:
+      total = write_comments(chunks, sys.stdout, args.format)
+      if args.format == 'json':
+        sys.stdout.write('\n')
+  except IOError as error:
+    # The reader hung up (like "| head"), so there's no one left to write to.
+    if error.errno != errno.EPIPE:
+      raise
+    sys.exit(1)
 
   if verbosity > 0:
-    sys.stderr.write('Saved '+str(len(comments))+' comments.\n')
+    sys.stderr.write('Saved '+str(total)+' comments.\n')
+  if verbosity >= 2:
+    sys.stderr.write(imgurlib.POOL.stats_summary()+'\n')
+
+
+def write_comments(chunks, filehandle, format='json'):
+  """Write each list of comments in "chunks" to "filehandle" as it comes,
+  flushing after each one, so only one chunk is ever in memory and readers
+  get the comments right away. "format" is one of FORMATS. The "json" format
+  comes out exactly like json.dump() of the whole list would. Returns the
+  number of comments written."""
+  total = 0
+  if format == 'json':
+    filehandle.write('[')
+  for chunk in chunks:
+    lines = []
+    for comment in chunk:
+      comment_json = json.dumps(comment)
+      if format == 'ndjson':
+        lines.append(comment_json+'\n')
+      elif total == 0 and not lines:
+        lines.append(comment_json)
+      else:
+        lines.append(', '+comment_json)
+    total += len(lines)
+    filehandle.write(''.join(lines))
+    filehandle.flush()
+  if format == 'json':
+    filehandle.write(']')
+  return total
+
+
+def get_cached_comment_chunks(args, verbosity):
+  """Yield lists of the user's comments, downloading through the cache: the
+  new ones a page at a time as they're fetched (and written to the cache), then
+  the cached ones. If the download is interrupted, exit with an error, since
+  running it again resumes where it stopped."""
+  account_id = imgurcache.username_to_id(args.user, args.client_id,
+    user_agent=USER_AGENT)
+  comments = imgurcache.get_cached_and_live_comments(args.user, args.client_id,
+    account_id=account_id, jobs=args.jobs, user_agent=USER_AGENT,
+    verbosity=verbosity)
+  try:
+    for chunk in imgurcache.iter_chunks(comments, PER_PAGE):
+      yield [dict(comment) for comment in chunk]
+  except imgurlib.NearQuotaException:
+    fail('Error: The API request quota is almost used up. Run this again once '
+      'it resets, and the download will resume where it stopped.')
+  except (httplib.HTTPException, socket.error) as error:
+    fail('Error: The download was interrupted ({}). Run this again, and it '
+      'will resume where it stopped.'.format(error))
+
+
+def run_batch(args, verbosity):
+  """Download each user in the --batch file into the cache, one at a time,
+  keeping track of them in a BatchQueue."""
+  queue = imgurcache.BatchQueue(args.queue)
+  if args.batch == '-':
+    users = read_users(sys.stdin)
+  else:
+    with open(args.batch) as filehandle:
+      users = read_users(filehandle)
+  added = queue.add(users, retry_failed=args.retry_failed)
+  pending = queue.get_pending()
+  if verbosity > 0:
+    sys.stderr.write('Queued {} users. {} are pending.\n'.format(added,
+      len(pending)))
+
+  try:
+    for user in pending:
+      try:
+        account_id = imgurcache.username_to_id(user, args.client_id,
+          user_agent=USER_AGENT)
+        count = imgurcache.update_cache(user, args.client_id,
+          account_id=account_id, jobs=args.jobs, user_agent=USER_AGENT,
+          skip_unchanged=args.skip_unchanged)
+      except imgurlib.NearQuotaException:
+        # Leave the user pending, for the next run.
+        if verbosity > 0:
+          sys.stderr.write('The API request quota is almost used up. Stopping '
+            'here. Run the batch again once it resets to continue.\n')
+        break
+      except (httplib.HTTPException, socket.error, ValueError) as error:
+        queue.mark(user, 'failed', error=str(error))
+        if verbosity > 0:
+          sys.stderr.write('{}: failed ({})\n'.format(user, error))
+        continue
+      queue.mark(user, 'done', account_id=account_id, new_comments=count)
+      if verbosity >= 2:
+        sys.stderr.write('{}: {} new comments.\n'.format(user, count))
+  finally:
+    queue.save()
+
+  if verbosity > 0:
+    counts = queue.get_counts()
+    sys.stderr.write('Done: {done}  Failed: {failed}  Pending: {pending}\n'
+      .format(**counts))
+  if verbosity >= 2:
+    sys.stderr.write(imgurlib.POOL.stats_summary()+'\n')
+
+
+def read_users(filehandle):
+  """Return the usernames in a file, one per line. Blank lines and lines
+  starting with "#" are skipped."""
+  users = []
+  for line in filehandle:
+    user = line.strip()
+    if user and not user.startswith('#'):
+      users.append(user)
+  return users
 
 
 def fail(message):
@@ -1,26 +1,80 @@
 #!/usr/bin/env python
-#TODO: Right now it's updating the cache BEFORE it returns any comments. So if
-#      there's no cache, it makes ALL the requests before returning any results.
-#      Need to figure out how to make it return results, THEN update the cache.
-#      Looks like I can have get_live_comment_chunks() itself do it, after the
-#      loop containing the yields.
 from __future__ import division
 import os
+import re
 import sys
 import json
+import time
+import shutil
+import fcntl
+import threading
+import zlib
+import struct
+import sqlite3
 import httplib
 import itertools
+import collections
+import multiprocessing.pool
 import imgurlib
+import imgurindex
+import imgurdb
+import imgurrecord
 
 USER_AGENT = 'NBS comment-downloader'
-API_DOMAIN = 'api.imgur.com'
+API_DOMAIN = imgurlib.API_DOMAIN
 COMMENTS_PATH = '/3/account/{}/comments'
+COMMENT_COUNT_PATH = '/3/account/{}/comments/count'
 ACCOUNT_PATH = '/3/account/{}'
 CACHE_DIRNAME = 'cache'
+SEGMENT_PATTERN = r'^(\d+)-(\d+)\.(?:seg\.gz|jsonl)$'
+SEGMENT_NAME = '{}-{}.seg.gz'
+PARTIAL_PATTERN = r'^(\d+)-(\d+)\.partial(?:\.gz)?$'
+PARTIAL_NAME = '{}-{}.partial.gz'
+CHECKPOINT_EXT = '.checkpoint'
+LOCK_FILENAME = 'write.lock'
+OFFSETS_EXT = '.offsets'
+OFFSETS_BLOCK = 4096
+# Bytes per comment in an offsets file (an id and an offset, 8 bytes each).
+OFFSETS_ENTRY = 16
+BLOCK_RECORDS = 256
+BLOCK_SHIFT = 24
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+COMPRESS_LEVEL = 6
+READ_SIZE = 65536
+INDEX_FILENAME = 'index.db'
+LEGACY_INDEX_FILENAME = 'index.json'
+RESPONSES_DIRNAME = 'responses'
+LOCATOR_FILENAME = 'comment-locations.db'
+LEGACY_LOCATOR_FILENAME = 'comment-locations.json'
+LOCATOR_VERSION = 2
+LOCATOR_SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+  path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS locations (
+  id INTEGER PRIMARY KEY,
+  segment TEXT,
+  offset INTEGER
+);
+CREATE INDEX IF NOT EXISTS locations_segment ON locations (segment);
+"""
+DB_FILENAME = 'comments.db'
+BATCH_QUEUE_FILENAME = 'batch-queue.json'
+BATCH_QUEUE_VERSION = 1
+# Changes to the batch queue are appended to a file with this suffix, and only
+# folded into the queue file once there are about as many as there are users
+# (or at least this many).
+BATCH_JOURNAL_SUFFIX = '.journal'
+BATCH_JOURNAL_MIN_LINES = 100
+ACCOUNTS_FILENAME = 'accounts.json'
+ACCOUNTS_VERSION = 1
+BATCH_STATES = ('pending', 'done', 'failed')
+MAX_SEGMENTS = 16
 
 
 def get_live_comments(user, client_id, cutoff_date=0, limit=0, per_page=100,
-    user_agent=USER_AGENT, verbosity=0):
+    jobs=1, account_id=None, cache_dir=None, user_agent=USER_AGENT,
+    verbosity=0):
   """Yield all comments for "user", up to a specified limit or date.
   "limit" (int) is the maximum number of comments which will be returned.
   "cutoff_date" (int) is a unix timestamp. Only comments this old or newer will
@@ -32,74 +86,297 @@ def get_live_comments(user, client_id, cutoff_date=0, limit=0, per_page=100,
   The number of requests made depends on the number of comments returned (duh),
   and the value of "per_page", which is the number of comments returned per
   request. Can be any int > 0, but it is ultimately limited by the Imgur API,
-  which limits a request to 100 at maximum."""
+  which limits a request to 100 at maximum.
+  If "jobs" is more than 1, up to that many pages are fetched at once (see
+  get_live_comment_chunks()).
+  If "account_id" is given, each page is written through to the cache for that
+  account as it's yielded (see get_live_comment_chunks())."""
   generator = get_live_comment_chunks(user, client_id, cutoff_date=cutoff_date,
-    limit=limit, per_page=per_page, user_agent=user_agent, verbosity=verbosity)
+    limit=limit, per_page=per_page, jobs=jobs, account_id=account_id,
+    cache_dir=cache_dir, user_agent=user_agent, verbosity=verbosity)
   # Create an iterable from the chunk generator which will join them into a
   # single list. But it evaluates lazily, conserving the number of requests.
   return itertools.chain.from_iterable(generator)
 
 
 def get_live_comment_chunks(user, client_id, cutoff_date=0, limit=0,
-    per_page=100, user_agent=USER_AGENT, verbosity=0):
+    per_page=100, jobs=1, account_id=None, cache_dir=None,
+    user_agent=USER_AGENT, verbosity=0, new_count=None):
   """Same as get_comments(), but yield lists of comments at a time instead of
-  individual ones. (Each list == one page == one request.)"""
-
+  individual ones. (Each list == one page == one request.)
+  If "jobs" is more than 1, pages are fetched by that many threads at once, but
+  still yielded in order, newest first. If "new_count" is given (the number of
+  comments back to "cutoff_date", like from get_new_comment_count()), only the
+  pages covering those are fetched in parallel, instead of all of the user's.
+  If "account_id" is given, each page is appended to a new cache segment for
+  that account before it's yielded, so an interrupted run keeps what it
+  fetched. "cutoff_date" should then be just past the newest cached comment.
+  The segment only becomes part of the cache once every comment back to
+  "cutoff_date" has been fetched (not if "limit" stopped it early).
+  If an earlier run for "account_id" was interrupted, this one resumes it: the
+  comments it got are yielded first, then fetching continues from the page it
+  stopped at. Only one run at a time can write to an account's cache (see
+  SegmentWriter), so this may wait for another to finish first."""
   api_path = COMMENTS_PATH.format(user)
+  writer = None
+  added_comments = None
+  try:
+    if account_id is not None:
+      writer = SegmentWriter(account_id, cache_dir=cache_dir, resume=True)
+      # If another refresh added to the cache while this one waited for the
+      # writer's lock, only comments newer than those are fetched, and the
+      # ones it added are read from the cache instead.
+      newest = get_newest_cached_comment(account_id, cache_dir=cache_dir)
+      if newest is not None and newest['datetime'] >= cutoff_date:
+        added_cutoff = cutoff_date
+        added_comments = itertools.takewhile(
+          lambda comment: comment['datetime'] >= added_cutoff,
+          iter_comments(open_segments(account_id, cache_dir=cache_dir)))
+        cutoff_date = newest['datetime'] + 1
+    total = 0
+    for comments_group in iter_live_comment_chunks(user, client_id, api_path,
+        writer, cutoff_date=cutoff_date, limit=limit, per_page=per_page,
+        jobs=jobs, user_agent=user_agent, verbosity=verbosity,
+        new_count=new_count):
+      total += len(comments_group)
+      yield comments_group
+    if added_comments is not None:
+      if limit:
+        added_comments = itertools.islice(added_comments, max(limit-total, 0))
+      for comments_group in iter_chunks(added_comments, per_page):
+        yield comments_group
+  finally:
+    if writer is not None:
+      writer.close()
+
+
+def iter_live_comment_chunks(user, client_id, api_path, writer, cutoff_date=0,
+    limit=0, per_page=100, jobs=1, user_agent=USER_AGENT, verbosity=0,
+    new_count=None):
+  """The body of get_live_comment_chunks(), given its SegmentWriter (or None),
+  which it commits if every comment back to "cutoff_date" is fetched."""
+  total = 0
+  start = 0
+  if writer is not None and writer.count:
+    if verbosity >= 2:
+      sys.stderr.write('Resuming an interrupted download of {} comments.\n'
+        .format(writer.count))
+    start = find_resume_page(client_id, api_path, writer, per_page=per_page,
+      user_agent=user_agent)
+    resumed = writer.read_written()
+    if limit:
+      resumed = itertools.islice(resumed, limit)
+    for comments_group in iter_chunks(resumed, per_page):
+      total += len(comments_group)
+      yield comments_group
+    if limit and total >= limit:
+      return
+
+  if jobs > 1:
+    if new_count is None:
+      count = None
+    else:
+      # One more, to reach the first comment already cached (or the empty page
+      # after the last comment), which shows that they've all been fetched.
+      count = new_count + 1
+    pages = get_pages_parallel(user, client_id, api_path, jobs, start=start,
+      limit=limit, per_page=per_page, count=count, user_agent=user_agent)
+  else:
+    pages = get_pages_serial(client_id, api_path, start=start,
+      per_page=per_page, user_agent=user_agent)
+
+  page_num = start - 1
+  still_searching = True
+  complete = True
+  try:
+    while still_searching:
+
+      comments_page = next(pages)
+      page_num+=1
+
+      assert is_iterable(comments_page), ('Error: Expected comments to be an '
+        'iterable.')
+      if len(comments_page) == 0:
+        still_searching = False
+        if verbosity >= 2:
+          sys.stderr.write('Reached end of comments. All were retrieved.\n')
+
+      # Skip comments already written (from a resumed run, or ones pushed onto
+      # this page by new comments posted since the last page).
+      if writer is not None:
+        comments_page = [comment for comment in comments_page
+                         if writer.is_new(comment)]
+
+      if limit == 0 and cutoff_date == 0:
+        comments_group = comments_page
+      else:
+        comments_group = []
+        for comment in comments_page:
+          total+=1
+          # Exceeded limit? Discard comment.
+          if comment['datetime'] < cutoff_date or (limit and total > limit):
+            still_searching = False
+            complete = comment['datetime'] < cutoff_date
+            if verbosity >= 1:
+              sys.stderr.write('Found more comments than the limit.\n')
+            break
+          else:
+            comments_group.append(comment)
+
+      if len(comments_group) == 0:
+        continue
+      if writer is not None:
+        writer.write(comments_group, page=page_num, per_page=per_page)
+      yield comments_group
+  finally:
+    pages.close()
+
+  if writer is not None and complete:
+    writer.commit()
+
+
+def find_resume_page(client_id, api_path, writer, per_page=100,
+    user_agent=USER_AGENT):
+  """Return the page to continue an interrupted download from, given the
+  SegmentWriter it was resumed with. That's the last page it fetched, unless
+  comments have been deleted since, shifting older ones onto earlier pages. So
+  it checks that the page still reaches back to the oldest comment fetched, and
+  steps back a page at a time until it does."""
+  checkpoint = writer.checkpoint
+  if checkpoint['per_page'] == per_page:
+    page_num = checkpoint['page']
+  else:
+    page_num = checkpoint['count'] // per_page
+  while page_num > 0:
+    comments_page = get_comments_page(client_id, api_path, page_num,
+      per_page=per_page, user_agent=user_agent)
+    if (comments_page
+        and comments_page[0]['datetime'] >= checkpoint['oldest_datetime']):
+      break
+    page_num-=1
+  return page_num
+
+
+def get_comments_page(client_id, api_path, page_num, per_page=100,
+    user_agent=USER_AGENT):
+  """Return one page of comments. The response is parsed as it arrives, so
+  only the comments themselves are ever held in memory, not the whole body."""
   params = {
     'perPage':str(per_page),
+    'page':str(page_num),
   }
+  (response, comments_page) = imgurlib.make_request(
+    api_path,
+    client_id,
+    user_agent=user_agent,
+    params=params,
+    domain=API_DOMAIN,
+    stream=True
+  )
+  imgurlib.handle_status(response.status, fatal=False)
+  if isinstance(comments_page, collections.Iterator):
+    return list(comments_page)
+  return comments_page
 
-  total = 0
-  page_num = 0
-  still_searching = True
-  while still_searching:
-
-    # make request
-    params['page'] = str(page_num)
-    (response, comments_page) = imgurlib.make_request(
-      api_path,
-      client_id,
-      user_agent=user_agent,
-      params=params,
-      domain=API_DOMAIN
-    )
-    imgurlib.handle_status(response.status, fatal=False)
-
-    assert is_iterable(comments_page), ('Error: Expected comments to be an '
-      'iterable.')
-    if len(comments_page) == 0:
-      still_searching = False
-      if verbosity >= 2:
-        sys.stderr.write('Reached end of comments. All were retrieved.\n')
-
-    if limit == 0 and cutoff_date == 0:
-      comments_group = comments_page
-    else:
-      comments_group = []
-      for comment in comments_page:
-        total+=1
-        # Exceeded limit? Discard comment.
-        if comment['datetime'] < cutoff_date or (limit and total > limit):
-          still_searching = False
-          if verbosity >= 1:
-            sys.stderr.write('Found more comments than the limit.\n')
-          break
-        else:
-          comments_group.append(comment)
 
+def get_pages_serial(client_id, api_path, start=0, per_page=100,
+    user_agent=USER_AGENT):
+  """Yield pages of comments from "api_path", one request at a time, starting
+  from page number "start". Never stops on its own."""
+  page_num = start
+  while True:
+    yield get_comments_page(client_id, api_path, page_num, per_page=per_page,
+      user_agent=user_agent)
     page_num+=1
-    if len(comments_group) == 0:
-      raise StopIteration
-    else:
-      yield comments_group
 
-    #TODO: Update cache here.
-    #      Have to retrieve the comments already in the cache in order to
-    #      combine with the live comments. But get_cached_and_live_comments(),
-    #      which calls this, already does that. So hopefully avoid doing it
-    #      twice. I may have to bite the bullet and make this optionally
-    #      take on the function of get_cached_and_live_comments().
+
+def get_pages_parallel(user, client_id, api_path, jobs, start=0, limit=0,
+    per_page=100, count=None, user_agent=USER_AGENT):
+  """Yield pages of comments from "api_path" in order, starting from page number
+  "start", with up to "jobs" requests in flight at a time. The user's comment
+  count determines how many pages there should be. Only that many (or as many
+  as "limit" needs) are fetched in parallel. Past that point, in case the count
+  was stale, pages are fetched one at a time like get_pages_serial().
+  Give "count" to page through that many comments instead of requesting the
+  user's count."""
+  if count is None:
+    count = get_comment_count(user, client_id, user_agent=user_agent)
+  if count is None:
+    num_pages = 0
+  else:
+    num_pages = -(-count // per_page)
+  if limit:
+    num_pages = min(num_pages, -(-limit // per_page))
+  pool = multiprocessing.pool.ThreadPool(jobs)
+  try:
+    # Keep a window of "jobs" pending pages ahead of the one being yielded, so
+    # if the caller stops early, only that many requests are wasted.
+    pending = collections.deque()
+    page_num = start
+    while page_num < num_pages or pending:
+      while page_num < num_pages and len(pending) < jobs:
+        pending.append(pool.apply_async(get_comments_page,
+          (client_id, api_path, page_num),
+          {'per_page':per_page, 'user_agent':user_agent}))
+        page_num+=1
+      yield pending.popleft().get()
+  finally:
+    pool.terminate()
+  for comments_page in get_pages_serial(client_id, api_path,
+      start=max(num_pages, start), per_page=per_page, user_agent=user_agent):
+    yield comments_page
+
+
+def get_comment_count(user, client_id, fresh=False, user_agent=USER_AGENT):
+  """Return the total number of comments "user" has made, or None if the API
+  doesn't give a number. If "fresh" is true, it's always requested from the
+  API, never taken from the response cache."""
+  (response, count) = imgurlib.make_request(
+    COMMENT_COUNT_PATH.format(user),
+    client_id,
+    user_agent=user_agent,
+    domain=API_DOMAIN,
+    cache=not fresh
+  )
+  imgurlib.handle_status(response.status, fatal=False)
+  if isinstance(count, (int, long)):
+    return count
+  else:
+    return None
+
+
+def get_new_comment_count(user, client_id, account_id, cache_dir=None,
+    user_agent=USER_AGENT):
+  """Return how many comments "user" has made since the cache for "account_id"
+  was last updated, going by the difference between their comment count (always
+  requested fresh) and the number cached. That's one small request instead of a
+  page of comments.
+  It's only an estimate: if they deleted some comments and posted as many new
+  ones, the counts still match. So it's fine for sizing a fetch, but 0 only
+  proves nothing is new to a caller who accepts that risk (see update_cache()'s
+  "skip_unchanged").
+  Returns None if it can't tell: when the API doesn't give a count, or it's less
+  than the number cached (comments were deleted, so new ones could be hiding
+  behind the difference)."""
+  count = get_comment_count(user, client_id, fresh=True, user_agent=user_agent)
+  if count is None:
+    return None
+  cached_count = count_cached_comments(account_id, cache_dir=cache_dir)
+  if count < cached_count:
+    return None
+  return count - cached_count
+
+
+def iter_chunks(iterable, chunk_size):
+  """Yield lists of up to "chunk_size" items from "iterable", in order."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) >= chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
 
 
 def is_iterable(obj):
@@ -111,62 +388,1072 @@ def is_iterable(obj):
 
 
 def get_cached_and_live_comments(user, client_id, update_cache=True,
-    user_agent=USER_AGENT, verbosity=0):
+    account_id=None, queries=None, regex=False, jobs=1, user_agent=USER_AGENT,
+    verbosity=0):
   """Yield all comments for "user", drawing on cache files and updates via the
   API on the backend.
+  If "update_cache" is true, new comments are written through to the cache as
+  they're fetched, and the search index is updated once they all have been.
+  Give "account_id" if you already know it, to save a request.
+  The newest page of comments is always requested, to see whether any are
+  new.
+  If "queries" is given (a list of queries, with "regex" saying whether they're
+  regexes), cached comments the search index rules out as matches for all of
+  them are skipped.
+  "jobs" is the number of pages of new comments to fetch at once (see
+  get_live_comment_chunks()).
   Returns a generator that yields one comment at a time, starting with the
-  newest."""
-  account_id = username_to_id(user, client_id, user_agent=user_agent)
-  cached_comments = get_cached_comments(account_id)
-  if len(cached_comments) == 0:
+  newest. New comments are yielded as their pages arrive, before the cached
+  ones are read."""
+  if account_id is None:
+    account_id = username_to_id(user, client_id, user_agent=user_agent)
+  migrate_legacy_cache(account_id)
+  # Open the segments now, so a compaction at the end of the refresh can't
+  # pull them out from under us (or add the new comments to them).
+  segments = open_segments(account_id, offsets=queries is not None)
+  newest = read_first_comment(segments)
+  if newest is None:
     cutoff_date = 0
   else:
-    cutoff_date = cached_comments[0]['datetime'] + 1
-  live_comments = get_live_comments(user, client_id, cutoff_date=cutoff_date,
-    user_agent=USER_AGENT, verbosity=0)
-  
-  combined_comments = itertools.chain(live_comments, cached_comments)
-
-  # overwrite cache with all live + cached comments
+    cutoff_date = newest['datetime'] + 1
+  candidate_ids = None
+  if queries is not None:
+    if segments:
+      last = segments[0][1]
+    else:
+      last = 0
+    candidate_ids = get_candidate_ids(account_id, queries, regex=regex,
+      segment=last)
+  cached_comments = iter_comments(segments, candidate_ids=candidate_ids)
+  new_count = None
+  if jobs > 1:
+    new_count = get_new_comment_count(user, client_id, account_id,
+      user_agent=user_agent)
   if update_cache:
-    cache_file = get_cache_filename(account_id)
-    cache_dir = os.path.dirname(cache_file)
-    if not os.path.exists(cache_dir):
-      os.makedirs(cache_dir)
-    combined_comments_list = list(combined_comments)
-    with open(cache_file, 'w') as filehandle:
-      json.dump(combined_comments_list, filehandle)
-    # have to return a generator, not a list
-    return (comment for comment in combined_comments_list)
+    write_account_id = account_id
   else:
-    return combined_comments
+    write_account_id = None
+  live_comments = itertools.chain.from_iterable(get_live_comment_chunks(user,
+    client_id, cutoff_date=cutoff_date, jobs=jobs, account_id=write_account_id,
+    user_agent=user_agent, verbosity=verbosity, new_count=new_count))
+  return itertools.chain(live_comments, cached_comments)
+
+
+def get_candidate_ids(account_id, queries, regex=False, segment=None,
+    count=None, cache_dir=None):
+  """Return the set of ids of the cached comments which the search index says
+  might match any of "queries". "segment" is the newest segment being searched
+  (and "count", if given, the number of comments), so an index which doesn't
+  cover exactly those isn't used. If there's no such index, or it can't help
+  with one of the queries, returns None."""
+  index = open_index(account_id, cache_dir=cache_dir)
+  if index is None:
+    return None
+  try:
+    if index.segment != segment or (count is not None and len(index) != count):
+      return None
+    candidate_ids = set()
+    for query in queries:
+      candidates = index.candidates(query, regex=regex)
+      if candidates is None:
+        return None
+      candidate_ids.update(candidates)
+    return candidate_ids
+  finally:
+    index.close()
 
 
 def get_cached_comments(account_id, cache_dir=None):
   """Return cached comments for "account_id", if any exist on disk.
-  This will look for a file named "account_id.json" in "cache_dir". If one is
-  found, all comments in it will be returned in a list. Otherwise, an empty list
-  is returned. If "cache_dir" is not given, it will use a directory named
+  The cache for an account is a directory named "account_id" in "cache_dir",
+  holding a series of segment files. Returns a generator which reads them one
+  line at a time, yielding the comments newest first, so memory use doesn't
+  grow with the size of the cache. The files are opened right away, so it
+  yields what was cached at the time of the call, even if the cache is updated
+  in the meantime. If "cache_dir" is not given, it will use a directory named
   "cache" in the script directory."""
-  cache_file = get_cache_filename(account_id, cache_dir=cache_dir)
-  if os.path.isfile(cache_file):
-    with open(cache_file) as filehandle:
-      return json.load(filehandle)
+  migrate_legacy_cache(account_id, cache_dir=cache_dir)
+  return iter_comments(open_segments(account_id, cache_dir=cache_dir))
+
+
+def get_newest_cached_comment(account_id, cache_dir=None):
+  """Return the newest cached comment for "account_id", or None if there are
+  none."""
+  migrate_legacy_cache(account_id, cache_dir=cache_dir)
+  segments = open_segments(account_id, cache_dir=cache_dir)
+  try:
+    return read_first_comment(segments)
+  finally:
+    for (first, last, filehandle, offsets_filehandle) in segments:
+      filehandle.close()
+
+
+def count_cached_comments(account_id, cache_dir=None):
+  """Return the number of comments cached for "account_id". Every segment's
+  offsets file has one entry per comment, so this only needs their sizes."""
+  migrate_legacy_cache(account_id, cache_dir=cache_dir)
+  total = 0
+  for segment_file in get_segment_files(account_id, cache_dir=cache_dir):
+    offsets_file = get_offsets_file(segment_file)
+    if not os.path.isfile(offsets_file):
+      build_offsets(segment_file)
+    total += os.path.getsize(offsets_file) // OFFSETS_ENTRY
+  return total
+
+
+def update_cache(user, client_id, account_id=None, jobs=1, cache_dir=None,
+    user_agent=USER_AGENT, verbosity=0, skip_unchanged=False):
+  """Download any comments by "user" which aren't in the cache yet, and add
+  them to it. Returns the number of new comments.
+  Pages are requested newest first, until one reaches back to the newest
+  cached comment, so a user with nothing new costs one page. With "jobs" more
+  than 1, their comment count is checked first (see get_new_comment_count()),
+  so only about as many pages as hold the new comments are fetched at once.
+  If "skip_unchanged" is true, a user whose count matches the number cached is
+  skipped without requesting any pages. That's cheaper for big sweeps, but
+  misses new comments when as many old ones were deleted."""
+  if account_id is None:
+    account_id = username_to_id(user, client_id, user_agent=user_agent,
+      cache_dir=cache_dir)
+  new_count = None
+  if skip_unchanged or jobs > 1:
+    new_count = get_new_comment_count(user, client_id, account_id,
+      cache_dir=cache_dir, user_agent=user_agent)
+  if skip_unchanged and new_count == 0:
+    if verbosity >= 2:
+      sys.stderr.write('No change in comment count.\n')
+    return 0
+  newest = get_newest_cached_comment(account_id, cache_dir=cache_dir)
+  if newest is None:
+    cutoff_date = 0
   else:
+    cutoff_date = newest['datetime'] + 1
+  count = 0
+  for comments in get_live_comment_chunks(user, client_id,
+      cutoff_date=cutoff_date, jobs=jobs, account_id=account_id,
+      cache_dir=cache_dir, user_agent=user_agent, verbosity=verbosity,
+      new_count=new_count):
+    count += len(comments)
+  return count
+
+
+# The cache for each account is a directory of append-only segment files. Each
+# one holds a batch of comments, one per line (encoded by imgurrecord), newest
+# first, and is named "first-last.seg.gz" after the range of segment numbers it
+# covers. A refresh writes its new comments as the next-numbered segment, so it
+# never touches the older ones. Once there are more than MAX_SEGMENTS, they're
+# compacted into one that covers the whole range. Every file is written under a
+# temporary name and renamed into place, so a crash can never leave a partial
+# segment behind. If one happens between writing a compacted segment and
+# deleting the ones it replaced, the old ones are simply ignored, since their
+# range is covered.
+# While a refresh is still fetching pages, its segment is a ".partial" file,
+# which readers ignore. It's renamed only once it reaches back to the newest
+# comment already cached, so the cache never has a gap in it. After each page,
+# a ".checkpoint" file next to it records how far it got, so if the refresh is
+# interrupted, the next one can pick up the partial segment where it stopped
+# (as long as no other segment was added in the meantime).
+# Segments are compressed as a series of independent gzip members (so the file
+# as a whole is a valid gzip file) of at most BLOCK_RECORDS lines each. That
+# way, one comment can be read by decompressing just the block it's in. Its
+# position is given as a "virtual offset": the offset of the block in the file,
+# shifted left by BLOCK_SHIFT bits, plus the offset of the line in the
+# decompressed block.
+# Each segment has a "first-last.offsets" file next to it: the id and offset of
+# every line, as pairs of little-endian 64-bit integers, so single comments can
+# be read without parsing the rest. It's written after the segment is, and
+# rebuilt from the segment if it's missing.
+# Segments written before compression was added are uncompressed "first-last.
+# jsonl" files of plain JSON, whose offsets are ordinary byte offsets. They're
+# still read, and get converted the next time the segments are compacted.
+
+def get_segments(account_id, cache_dir=None):
+  """Return a list of (first, last, path) tuples for the current segments of
+  "account_id", newest first. Segments whose range is covered by another one
+  are left out."""
+  account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+  if not os.path.isdir(account_dir):
     return []
+  ranges = []
+  for filename in os.listdir(account_dir):
+    match = re.search(SEGMENT_PATTERN, filename)
+    if match:
+      first = int(match.group(1))
+      last = int(match.group(2))
+      ranges.append((first, last, os.path.join(account_dir, filename)))
+  segments = []
+  for (first, last, path) in ranges:
+    covered = False
+    for (other_first, other_last, other_path) in ranges:
+      if (other_first <= first and last <= other_last
+          and (other_first, other_last) != (first, last)):
+        covered = True
+        break
+    if not covered:
+      segments.append((first, last, path))
+  segments.sort(reverse=True)
+  return segments
 
 
-def get_cache_filename(account_id, cache_dir=None):
+def get_segment_files(account_id, cache_dir=None):
+  return [path for (first, last, path) in
+          get_segments(account_id, cache_dir=cache_dir)]
+
+
+def get_last_segment(account_id, cache_dir=None):
+  """Return the number of the newest segment for "account_id" (0 if none)."""
+  segments = get_segments(account_id, cache_dir=cache_dir)
+  if segments:
+    return segments[0][1]
+  else:
+    return 0
+
+
+def get_partial_segments(account_id, cache_dir=None):
+  """Return a list of (number, path) tuples for the partial segments left by
+  refreshes which haven't finished, newest first."""
+  account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+  if not os.path.isdir(account_dir):
+    return []
+  partials = []
+  for filename in os.listdir(account_dir):
+    match = re.search(PARTIAL_PATTERN, filename)
+    if match:
+      partials.append((int(match.group(2)), os.path.join(account_dir, filename)))
+  partials.sort(reverse=True)
+  return partials
+
+
+def read_segment(segment_file):
+  """Return a list of the comments in a segment file."""
+  with open(segment_file, 'rb') as filehandle:
+    return list(iter_segment(filehandle))
+
+
+def iter_segment(filehandle):
+  """Yield the comments in an open segment file, one line at a time."""
+  for (offset, line) in iter_lines(filehandle):
+    if line.strip():
+      yield imgurrecord.decode(line)
+
+
+def iter_lines(filehandle):
+  """Yield an (offset, line) tuple for each line in an open segment file,
+  starting at the current position."""
+  if not is_compressed(filehandle.name):
+    while True:
+      offset = filehandle.tell()
+      line = filehandle.readline()
+      if not line:
+        break
+      yield (offset, line)
+    return
+  for (block_offset, data) in iter_blocks(filehandle):
+    position = 0
+    for line in data.splitlines(True):
+      yield ((block_offset << BLOCK_SHIFT) + position, line)
+      position += len(line)
+
+
+def iter_blocks(filehandle):
+  """Yield a (block_offset, data) tuple for each gzip member in an open
+  compressed segment file, starting at the current position, where "data" is
+  its decompressed contents."""
+  block_offset = filehandle.tell()
+  data = ''
+  while True:
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    fed = 0
+    blocks = []
+    # Once a member ends, the decompressor keeps any input after it in
+    # unused_data.
+    while not decompressor.unused_data:
+      if not data:
+        data = filehandle.read(READ_SIZE)
+        if not data:
+          break
+      blocks.append(decompressor.decompress(data))
+      fed += len(data)
+      data = ''
+    if fed == 0:
+      break
+    data = decompressor.unused_data
+    yield (block_offset, ''.join(blocks))
+    block_offset += fed - len(data)
+
+
+def read_line(filehandle, offset):
+  """Return the line at "offset" (a virtual offset, for compressed segments) in
+  an open segment file."""
+  if not is_compressed(filehandle.name):
+    filehandle.seek(offset)
+    return filehandle.readline()
+  (block_offset, position) = divmod(offset, 1 << BLOCK_SHIFT)
+  data = read_block(filehandle, block_offset)
+  end = data.find('\n', position)
+  if end == -1:
+    return data[position:]
+  return data[position:end+1]
+
+
+def read_block(filehandle, block_offset):
+  """Return the decompressed contents of the gzip member at "block_offset" in an
+  open compressed segment file."""
+  filehandle.seek(block_offset)
+  for (block_offset, data) in iter_blocks(filehandle):
+    return data
+  return ''
+
+
+def is_compressed(segment_file):
+  return segment_file.endswith('.gz')
+
+
+def open_segments(account_id, offsets=False, cache_dir=None):
+  """Open the current segments for "account_id". Returns a list of
+  (first, last, filehandle, offsets_filehandle) tuples, newest first. The
+  offsets files are only opened if "offsets" is true (and created first if
+  they're missing). Otherwise "offsets_filehandle" is None."""
+  segments = []
+  for (first, last, path) in get_segments(account_id, cache_dir=cache_dir):
+    offsets_filehandle = None
+    if offsets:
+      offsets_file = get_offsets_file(path)
+      if not os.path.isfile(offsets_file):
+        build_offsets(path)
+      offsets_filehandle = open(offsets_file, 'rb')
+    segments.append((first, last, open(path, 'rb'), offsets_filehandle))
+  return segments
+
+
+def read_first_comment(segments):
+  """Return the newest comment in the open "segments" (as returned by
+  open_segments()), or None if they're empty. Leaves the files where they
+  were."""
+  for (first, last, filehandle, offsets_filehandle) in segments:
+    position = filehandle.tell()
+    try:
+      for comment in iter_segment(filehandle):
+        return comment
+    finally:
+      filehandle.seek(position)
+  return None
+
+
+def iter_comments(segments, candidate_ids=None):
+  """Yield the comments in the open "segments" (as returned by
+  open_segments()), newest first, closing each file once it's done.
+  If "candidate_ids" is given, only the comments with those ids are read: the
+  offsets file says where each one is, so the rest are never parsed (or, in
+  compressed segments, only the blocks holding candidates are decompressed)."""
+  try:
+    for (first, last, filehandle, offsets_filehandle) in segments:
+      if candidate_ids is None:
+        for comment in iter_segment(filehandle):
+          yield comment
+      elif is_compressed(filehandle.name):
+        block_offset = None
+        for (comment_id, offset) in iter_offsets(offsets_filehandle):
+          if comment_id in candidate_ids:
+            (this_block, position) = divmod(offset, 1 << BLOCK_SHIFT)
+            if this_block != block_offset:
+              block_offset = this_block
+              data = read_block(filehandle, block_offset)
+            end = data.find('\n', position)
+            yield imgurrecord.decode(data[position:end])
+      else:
+        for (comment_id, offset) in iter_offsets(offsets_filehandle):
+          if comment_id in candidate_ids:
+            yield imgurrecord.decode(read_line(filehandle, offset))
+      filehandle.close()
+  finally:
+    for (first, last, filehandle, offsets_filehandle) in segments:
+      filehandle.close()
+      if offsets_filehandle is not None:
+        offsets_filehandle.close()
+
+
+def write_block(filehandle, comments, offsets):
+  """Append "comments" to an open compressed segment file as one gzip member,
+  and add an (id, offset) tuple for each to the list "offsets"."""
+  block_offset = filehandle.tell()
+  lines = []
+  position = 0
+  for comment in comments:
+    line = imgurrecord.encode(comment)+'\n'
+    lines.append(line)
+    offsets.append((comment['id'], (block_offset << BLOCK_SHIFT) + position))
+    position += len(line)
+  compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+  filehandle.write(compressor.compress(''.join(lines)) + compressor.flush())
+
+
+def write_blocks(filehandle, comments, offsets):
+  """Append "comments" to an open compressed segment file, BLOCK_RECORDS at a
+  time."""
+  for i in range(0, len(comments), BLOCK_RECORDS):
+    write_block(filehandle, comments[i:i+BLOCK_RECORDS], offsets)
+
+
+def write_segment(segment_file, comments):
+  """Write "comments" to "segment_file" atomically (via a temporary file)."""
+  temp_file = segment_file+'.tmp'
+  offsets = []
+  with open(temp_file, 'wb') as filehandle:
+    write_blocks(filehandle, comments, offsets)
+  os.rename(temp_file, segment_file)
+  write_offsets(get_offsets_file(segment_file), offsets)
+
+
+def remove_segment(segment_file):
+  """Delete a segment file and its offsets file."""
+  os.remove(segment_file)
+  offsets_file = get_offsets_file(segment_file)
+  if os.path.isfile(offsets_file):
+    os.remove(offsets_file)
+
+
+def get_offsets_file(segment_file):
+  (dirname, filename) = os.path.split(segment_file)
+  return os.path.join(dirname, filename.split('.')[0]+OFFSETS_EXT)
+
+
+def write_offsets(offsets_file, offsets):
+  """Write a list of (id, offset) tuples to "offsets_file" atomically."""
+  temp_file = offsets_file+'.tmp'
+  with open(temp_file, 'wb') as filehandle:
+    for i in range(0, len(offsets), OFFSETS_BLOCK):
+      block = offsets[i:i+OFFSETS_BLOCK]
+      filehandle.write(struct.pack('<{}q'.format(len(block)*2),
+        *itertools.chain.from_iterable(block)))
+  os.rename(temp_file, offsets_file)
+
+
+def iter_offsets(filehandle):
+  """Yield the (id, offset) tuples in an open offsets file."""
+  while True:
+    data = filehandle.read(OFFSETS_BLOCK*OFFSETS_ENTRY)
+    if not data:
+      break
+    values = struct.unpack('<{}q'.format(len(data)//8), data)
+    for i in range(0, len(values), 2):
+      yield (values[i], values[i+1])
+
+
+def read_offsets(segment_file):
+  """Return a list of the (id, offset) tuples for the lines of "segment_file",
+  building its offsets file first if it's missing."""
+  offsets_file = get_offsets_file(segment_file)
+  if not os.path.isfile(offsets_file):
+    return build_offsets(segment_file)
+  with open(offsets_file, 'rb') as filehandle:
+    return list(iter_offsets(filehandle))
+
+
+def build_offsets(segment_file):
+  """Write the offsets file for "segment_file" by reading through it. Returns
+  the list of (id, offset) tuples."""
+  offsets = []
+  with open(segment_file, 'rb') as filehandle:
+    for (offset, line) in iter_lines(filehandle):
+      if line.strip():
+        offsets.append((imgurrecord.decode(line)['id'], offset))
+  write_offsets(get_offsets_file(segment_file), offsets)
+  return offsets
+
+
+class SegmentWriter(object):
+  """Write a new segment for "account_id" a batch of comments at a time.
+  Batches are appended to a partial segment as they come in, and only their
+  offsets are kept in memory. commit() then turns it into a real segment,
+  brings the search index up to date, and compacts the segments if there are
+  too many.
+  If "resume" is true and an earlier refresh was interrupted, its partial
+  segment is continued instead of starting a new one. "count" is then the
+  number of comments it already holds (read_written() reads them back), and
+  "checkpoint" says how far it got (see write()).
+  A writer holds an exclusive lock on the account (a flock() of LOCK_FILENAME
+  in its directory) until commit() or close(), so two processes can never
+  write or resume the same partial segment. Creating one waits for the lock."""
+
+  def __init__(self, account_id, cache_dir=None, resume=False):
+    self.account_id = account_id
+    self.cache_dir = cache_dir
+    self.account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+    if not os.path.isdir(self.account_dir):
+      os.makedirs(self.account_dir)
+    self.lock_file = open(os.path.join(self.account_dir, LOCK_FILENAME), 'a')
+    fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+    self.previous = get_last_segment(account_id, cache_dir=cache_dir)
+    partials = get_partial_segments(account_id, cache_dir=cache_dir)
+    if partials:
+      self.number = max(self.previous, partials[0][0]) + 1
+    else:
+      self.number = self.previous + 1
+    self.path = os.path.join(self.account_dir,
+      PARTIAL_NAME.format(self.number, self.number))
+    self.count = 0
+    self.offsets = []
+    self.checkpoint = None
+    self.filehandle = None
+    if resume:
+      for (number, path) in partials:
+        checkpoint = load_checkpoint(path)
+        if checkpoint is not None and checkpoint['previous'] == self.previous:
+          self.resume(number, path, checkpoint)
+          break
+
+  def resume(self, number, path, checkpoint):
+    """Continue the partial segment "path", cutting off anything written after
+    its "checkpoint"."""
+    self.number = number
+    self.path = path
+    self.checkpoint = checkpoint
+    self.filehandle = open(self.path, 'r+b')
+    self.filehandle.truncate(checkpoint['size'])
+    for (offset, line) in iter_lines(self.filehandle):
+      if line.strip():
+        self.offsets.append((imgurrecord.decode(line)['id'], offset))
+    self.count = len(self.offsets)
+    self.filehandle.seek(0, os.SEEK_END)
+
+  def read_written(self):
+    """Yield the comments written to the partial segment so far, newest first,
+    reading them back from disk."""
+    with open(self.path, 'rb') as filehandle:
+      for comment in itertools.islice(iter_segment(filehandle), self.count):
+        yield comment
+
+  def is_new(self, comment):
+    """Return whether "comment" is older than everything written so far (so
+    it isn't one already written, seen again on a later page because newer
+    comments pushed it there)."""
+    if self.checkpoint is None:
+      return True
+    oldest = self.checkpoint['oldest_datetime']
+    if comment['datetime'] != oldest:
+      return comment['datetime'] < oldest
+    return comment['id'] not in self.checkpoint['oldest_ids']
+
+  def write(self, comments, page=None, per_page=None):
+    """Append "comments" to the partial segment. If "page" is given (the
+    number of the API page they came from, with "per_page" comments per page),
+    a checkpoint is saved too."""
+    if self.filehandle is None:
+      self.filehandle = open(self.path, 'wb')
+    write_blocks(self.filehandle, comments, self.offsets)
+    self.filehandle.flush()
+    self.count += len(comments)
+    if comments:
+      oldest = comments[-1]['datetime']
+      if self.checkpoint is None or oldest != self.checkpoint['oldest_datetime']:
+        oldest_ids = []
+      else:
+        oldest_ids = self.checkpoint['oldest_ids']
+      oldest_ids = oldest_ids + [comment['id'] for comment in comments
+                                 if comment['datetime'] == oldest]
+      self.checkpoint = {
+        'previous':self.previous,
+        'page':page,
+        'per_page':per_page,
+        'count':self.count,
+        'oldest_datetime':oldest,
+        'oldest_ids':oldest_ids,
+        'size':self.filehandle.tell(),
+      }
+      if page is not None:
+        save_checkpoint(self.path, self.checkpoint)
+
+  def commit(self):
+    segment_file = None
+    if self.filehandle is not None:
+      self.filehandle.close()
+      segment_file = os.path.join(self.account_dir,
+        SEGMENT_NAME.format(self.number, self.number))
+      os.rename(self.path, segment_file)
+      write_offsets(get_offsets_file(segment_file), self.offsets)
+    # Partial segments left by earlier interrupted refreshes only held comments
+    # which this one has now fetched too.
+    for (number, path) in get_partial_segments(self.account_id, self.cache_dir):
+      if number < self.number:
+        os.remove(path)
+    for filename in os.listdir(self.account_dir):
+      if filename.endswith(CHECKPOINT_EXT):
+        number = int(filename.split('-')[0])
+        if number <= self.number:
+          os.remove(os.path.join(self.account_dir, filename))
+    # Index the new segment before a compaction merges it into the others.
+    update_index(self.account_id, segment_file, self.count, self.previous,
+      cache_dir=self.cache_dir)
+    if len(get_segments(self.account_id, cache_dir=self.cache_dir)) > MAX_SEGMENTS:
+      compact_segments(self.account_id, cache_dir=self.cache_dir)
+    self.close()
+
+  def close(self):
+    """Release the lock on the account, leaving any partial segment which
+    wasn't committed for a later refresh to resume."""
+    if self.filehandle is not None:
+      self.filehandle.close()
+    if not self.lock_file.closed:
+      fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+      self.lock_file.close()
+
+
+def get_checkpoint_file(partial_file):
+  (dirname, filename) = os.path.split(partial_file)
+  return os.path.join(dirname, filename.split('.')[0]+CHECKPOINT_EXT)
+
+
+def load_checkpoint(partial_file):
+  """Return the checkpoint saved for "partial_file", or None if there is none
+  (or it doesn't match the file)."""
+  checkpoint_file = get_checkpoint_file(partial_file)
+  if not os.path.isfile(checkpoint_file):
+    return None
+  with open(checkpoint_file) as filehandle:
+    try:
+      checkpoint = json.load(filehandle)
+    except ValueError:
+      return None
+  if os.path.getsize(partial_file) < checkpoint['size']:
+    return None
+  return checkpoint
+
+
+def save_checkpoint(partial_file, checkpoint):
+  checkpoint_file = get_checkpoint_file(partial_file)
+  temp_file = checkpoint_file+'.tmp'
+  with open(temp_file, 'w') as filehandle:
+    json.dump(checkpoint, filehandle)
+  os.rename(temp_file, checkpoint_file)
+
+
+def append_segment(account_id, comments, cache_dir=None):
+  """Add "comments" (newer than any already cached) to the cache for
+  "account_id" as a new segment."""
+  writer = SegmentWriter(account_id, cache_dir=cache_dir)
+  try:
+    writer.write(comments)
+    writer.commit()
+  finally:
+    writer.close()
+
+
+def compact_segments(account_id, cache_dir=None):
+  """Merge all the segments for "account_id" into one.
+  Compressed segments are copied over as they are, a block at a time, and their
+  offsets are shifted to match, so nothing is decompressed. Uncompressed ones
+  (from older versions) are converted.
+  The new segment gets the modification time of the oldest one it replaces, so
+  the time a segment was written stays a safe bound on how stale it is."""
+  segments = get_segments(account_id, cache_dir=cache_dir)
+  if len(segments) <= 1:
+    return
+  first = segments[-1][0]
+  last = segments[0][1]
+  account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+  segment_file = os.path.join(account_dir, SEGMENT_NAME.format(first, last))
+  temp_file = segment_file+'.tmp'
+  offsets = []
+  mtimes = []
+  with open(temp_file, 'wb') as filehandle:
+    for (first, last, path) in segments:
+      if is_compressed(path):
+        base = filehandle.tell() << BLOCK_SHIFT
+        for (comment_id, offset) in read_offsets(path):
+          offsets.append((comment_id, base+offset))
+        with open(path, 'rb') as segment_filehandle:
+          shutil.copyfileobj(segment_filehandle, filehandle)
+      else:
+        write_blocks(filehandle, read_segment(path), offsets)
+      mtimes.append(os.path.getmtime(path))
+  os.rename(temp_file, segment_file)
+  write_offsets(get_offsets_file(segment_file), offsets)
+  os.utime(segment_file, (time.time(), min(mtimes)))
+  for (first, last, path) in segments:
+    remove_segment(path)
+
+
+def migrate_legacy_cache(account_id, cache_dir=None):
+  """Convert a cache file in the old format (one "account_id.json" file holding
+  a JSON list) into the first segment of the new format."""
+  legacy_file = get_cache_filename(account_id, cache_dir=cache_dir)
+  if not os.path.isfile(legacy_file):
+    return
+  if not get_segments(account_id, cache_dir=cache_dir):
+    with open(legacy_file) as filehandle:
+      comments = json.load(filehandle)
+    append_segment(account_id, comments, cache_dir=cache_dir)
+  os.remove(legacy_file)
+  legacy_index_file = os.path.splitext(legacy_file)[0]+'.index.json'
+  if os.path.isfile(legacy_index_file):
+    os.remove(legacy_index_file)
+
+
+def get_cache_dir(cache_dir=None):
+  """Return "cache_dir", or if it's None, the default cache directory: the one
+  in $IMGUR_CACHE_DIR if set, or else a directory named "cache" in the script
+  directory."""
+  if cache_dir is None and os.environ.get('IMGUR_CACHE_DIR'):
+    cache_dir = os.environ['IMGUR_CACHE_DIR']
   if cache_dir is None:
     if sys.argv[0] == '':
       script_dir = os.path.realpath(sys.argv[0])
     else:
       script_dir = os.path.dirname(os.path.realpath(sys.argv[0]))
     cache_dir = os.path.join(script_dir, CACHE_DIRNAME)
-  return os.path.join(cache_dir, account_id+'.json')
+  return cache_dir
+
+
+class CommentLocator(object):
+  """An index of where every cached comment is, across all accounts, so a
+  comment can be looked up by id without knowing who wrote it.
+  It maps comment ids to the segment file (relative to the cache directory)
+  and byte offset of the line holding the comment. It's kept in a SQLite
+  database, LOCATOR_FILENAME in the cache directory, so a lookup only reads
+  the row it needs. update() brings it up to date by reading only the offsets
+  of the segments it hasn't seen yet."""
+
+  def __init__(self, cache_dir=None):
+    self.cache_dir = get_cache_dir(cache_dir)
+    if not os.path.isdir(self.cache_dir):
+      os.makedirs(self.cache_dir)
+    legacy_file = os.path.join(self.cache_dir, LEGACY_LOCATOR_FILENAME)
+    if os.path.isfile(legacy_file):
+      os.remove(legacy_file)
+    self.path = os.path.join(self.cache_dir, LOCATOR_FILENAME)
+    self.conn = sqlite3.connect(self.path)
+    (version,) = self.conn.execute('PRAGMA user_version').fetchone()
+    if version != LOCATOR_VERSION:
+      with self.conn:
+        self.conn.execute('DROP TABLE IF EXISTS segments')
+        self.conn.execute('DROP TABLE IF EXISTS locations')
+        self.conn.execute('PRAGMA user_version = {}'.format(LOCATOR_VERSION))
+    self.conn.executescript(LOCATOR_SCHEMA)
+
+  def close(self):
+    self.conn.close()
+
+  def update(self):
+    """Index any new segments, and drop the ones which no longer exist, in one
+    transaction."""
+    current = []
+    for account_id in os.listdir(self.cache_dir):
+      if not os.path.isdir(get_account_dir(account_id, self.cache_dir)):
+        continue
+      for segment_file in get_segment_files(account_id, self.cache_dir):
+        current.append(os.path.relpath(segment_file, self.cache_dir))
+    current_set = set(current)
+    old_set = set(path for (path,) in
+                  self.conn.execute('SELECT path FROM segments'))
+    if current_set == old_set:
+      return
+    with self.conn:
+      for segment in old_set - current_set:
+        self.conn.execute('DELETE FROM locations WHERE segment = ?',
+          (segment,))
+        self.conn.execute('DELETE FROM segments WHERE path = ?', (segment,))
+      for segment in current:
+        if segment not in old_set:
+          self.add_segment(segment)
+
+  def add_segment(self, segment):
+    segment_file = os.path.join(self.cache_dir, segment)
+    self.conn.executemany('INSERT OR REPLACE INTO locations (id, segment, '
+      'offset) VALUES (?, ?, ?)', ((comment_id, segment, offset)
+      for (comment_id, offset) in read_offsets(segment_file)))
+    self.conn.execute('INSERT INTO segments (path) VALUES (?)', (segment,))
+
+  def get(self, comment_id, max_age=None):
+    """Return the cached comment with id "comment_id", or None if it isn't
+    cached. If "max_age" is given, also return None if the comment was
+    downloaded more than that many seconds ago."""
+    location = self.conn.execute('SELECT segment, offset FROM locations WHERE '
+      'id = ?', (int(comment_id),)).fetchone()
+    if location is None:
+      return None
+    (segment, offset) = location
+    segment_file = os.path.join(self.cache_dir, segment)
+    try:
+      if max_age is not None:
+        if time.time() - os.path.getmtime(segment_file) > max_age:
+          return None
+      with open(segment_file, 'rb') as filehandle:
+        return imgurrecord.decode(read_line(filehandle, offset))
+    except (IOError, OSError, ValueError, zlib.error):
+      return None
+
+
+class BatchQueue(object):
+  """A persistent queue of users to download, for archiving lots of them.
+  Each user is "pending", "done", or "failed" (with the error). It's kept in
+  BATCH_QUEUE_FILENAME in the cache directory, unless another "path" is given.
+  Every change to a user is appended to a journal next to it right away, so an
+  interrupted batch picks up where it left off, and save() folds the journal
+  back into the queue file."""
+
+  def __init__(self, path=None, cache_dir=None):
+    if path is None:
+      path = os.path.join(get_cache_dir(cache_dir), BATCH_QUEUE_FILENAME)
+    self.path = path
+    self.journal_path = path+BATCH_JOURNAL_SUFFIX
+    self.journal = None
+    self.journal_lines = 0
+    self.users = []
+    if os.path.isfile(self.path):
+      with open(self.path) as filehandle:
+        try:
+          data = json.load(filehandle)
+        except ValueError:
+          data = {}
+      if data.get('version') == BATCH_QUEUE_VERSION:
+        self.users = data['users']
+    self.by_name = dict((entry['user'], entry) for entry in self.users)
+    self.replay()
+
+  def replay(self):
+    """Apply the changes recorded in the journal since the last save()."""
+    if not os.path.isfile(self.journal_path):
+      return
+    with open(self.journal_path) as filehandle:
+      for line in filehandle:
+        try:
+          fields = json.loads(line)
+        except ValueError:
+          # Probably the last line, cut off when the batch was interrupted.
+          continue
+        entry = self.by_name.get(fields['user'])
+        if entry is not None:
+          entry.update(fields)
+        self.journal_lines += 1
+
+  def add(self, users, retry_failed=False):
+    """Queue up any of "users" which aren't already. If "retry_failed", every
+    user which failed before is made pending again too. Returns the number
+    queued."""
+    added = 0
+    for user in users:
+      if user not in self.by_name:
+        entry = {'user':user, 'state':'pending'}
+        self.users.append(entry)
+        self.by_name[user] = entry
+        added += 1
+    if retry_failed:
+      for entry in self.users:
+        if entry['state'] == 'failed':
+          entry['state'] = 'pending'
+          entry.pop('error', None)
+          added += 1
+    if added:
+      self.save()
+    return added
+
+  def get_pending(self):
+    return [entry['user'] for entry in self.users
+            if entry['state'] == 'pending']
+
+  def mark(self, user, state, **fields):
+    """Set the state of "user", along with any other "fields" to record (like
+    "error"), and append the change to the journal. Once the journal is as long
+    as the queue, it's folded back in with save(), so a batch only rewrites the
+    whole queue a few times."""
+    entry = self.by_name[user]
+    fields['user'] = user
+    fields['state'] = state
+    fields['time'] = int(time.time())
+    entry.update(fields)
+    if self.journal is None:
+      self.make_directory()
+      self.journal = open(self.journal_path, 'a')
+    self.journal.write(json.dumps(fields)+'\n')
+    self.journal.flush()
+    self.journal_lines += 1
+    if self.journal_lines >= max(len(self.users), BATCH_JOURNAL_MIN_LINES):
+      self.save()
+
+  def get_counts(self):
+    counts = collections.Counter(entry['state'] for entry in self.users)
+    return dict((state, counts[state]) for state in BATCH_STATES)
+
+  def save(self):
+    """Write the whole queue to its file and empty the journal."""
+    data = {'version':BATCH_QUEUE_VERSION, 'users':self.users}
+    self.make_directory()
+    temp_file = self.path+'.tmp'
+    with open(temp_file, 'w') as filehandle:
+      json.dump(data, filehandle)
+    os.rename(temp_file, self.path)
+    if self.journal is not None:
+      self.journal.close()
+      self.journal = None
+    if os.path.exists(self.journal_path):
+      os.remove(self.journal_path)
+    self.journal_lines = 0
+
+  def make_directory(self):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+
+
+class AccountIds(object):
+  """The account id of every username looked up so far, so username_to_id()
+  doesn't have to ask the API again. Usernames are matched regardless of case,
+  like Imgur does. It's kept in ACCOUNTS_FILENAME in the cache directory, and
+  read again whenever the file changes (say, another program adds to it)."""
+
+  def __init__(self, cache_dir=None):
+    self.path = os.path.join(get_cache_dir(cache_dir), ACCOUNTS_FILENAME)
+    self.ids = {}
+    self.mtime = None
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Read the file, if it's changed since it was last read."""
+    try:
+      mtime = os.path.getmtime(self.path)
+    except OSError:
+      return
+    if mtime == self.mtime:
+      return
+    with open(self.path) as filehandle:
+      try:
+        data = json.load(filehandle)
+      except ValueError:
+        data = {}
+    if data.get('version') == ACCOUNTS_VERSION:
+      self.ids = data['ids']
+    self.mtime = mtime
+
+  def get(self, user):
+    with self.lock:
+      self.load()
+      return self.ids.get(user.lower())
+
+  def set(self, user, account_id):
+    with self.lock:
+      self.load()
+      self.ids[user.lower()] = account_id
+      self.save()
+
+  def save(self):
+    data = {'version':ACCOUNTS_VERSION, 'ids':self.ids}
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    temp_file = '{}.{}.tmp'.format(self.path, os.getpid())
+    with open(temp_file, 'w') as filehandle:
+      json.dump(data, filehandle)
+    os.rename(temp_file, self.path)
+    self.mtime = os.path.getmtime(self.path)
+
+
+# AccountIds by cache directory, shared so each process only reads the file
+# again when it changes.
+ACCOUNT_IDS = {}
+
+
+def get_account_ids(cache_dir=None):
+  cache_dir = get_cache_dir(cache_dir)
+  if cache_dir not in ACCOUNT_IDS:
+    ACCOUNT_IDS[cache_dir] = AccountIds(cache_dir)
+  return ACCOUNT_IDS[cache_dir]
+
+
+def open_comment_db(cache_dir=None):
+  """Return an imgurdb.CommentDB of all the comments in the cache, for every
+  account. It's kept in DB_FILENAME in the cache directory. Any segments which
+  aren't in it yet are added first."""
+  cache_dir = get_cache_dir(cache_dir)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  db = imgurdb.CommentDB(os.path.join(cache_dir, DB_FILENAME))
+  for account_id in os.listdir(cache_dir):
+    if not os.path.isdir(get_account_dir(account_id, cache_dir)):
+      continue
+    for segment_file in get_segment_files(account_id, cache_dir):
+      segment = os.path.relpath(segment_file, cache_dir)
+      if not db.has_segment(segment):
+        with open(segment_file, 'rb') as filehandle:
+          db.add_segment(segment, account_id, iter_segment(filehandle))
+  return db
+
+
+def enable_response_cache(cache_dir=None, ttls=imgurlib.RESPONSE_TTLS):
+  """Turn on imgurlib's cache of API responses, keeping it in a "responses"
+  directory in the cache directory."""
+  imgurlib.enable_response_cache(os.path.join(get_cache_dir(cache_dir),
+    RESPONSES_DIRNAME), ttls=ttls)
+
+
+def get_account_dir(account_id, cache_dir=None):
+  return os.path.join(get_cache_dir(cache_dir), account_id)
+
+
+def get_cache_filename(account_id, cache_dir=None):
+  """Return the path to the cache file for "account_id" in the old,
+  single-file format."""
+  return os.path.join(get_cache_dir(cache_dir), account_id+'.json')
+
+
+def get_index_filename(account_id, cache_dir=None):
+  account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+  return os.path.join(account_dir, INDEX_FILENAME)
+
+
+def open_index(account_id, cache_dir=None):
+  """Return the search index (an imgurindex.CommentIndex) of the cached
+  comments for "account_id", or None if there is none. Close it when done."""
+  index_file = get_index_filename(account_id, cache_dir=cache_dir)
+  return imgurindex.open_index(index_file)
+
+
+def update_index(account_id, new_segment, new_count, previous,
+    cache_dir=None):
+  """Bring the search index for "account_id" up to date after "new_count"
+  comments were added to the cache as the segment file "new_segment" (None if
+  there were none). "previous" is the number of the newest segment before that.
+  The new comments are streamed from disk, a batch at a time. If the index
+  didn't cover exactly the segments up to "previous", it's rebuilt from
+  scratch, streaming all the segments.
+  Accounts too small to be worth indexing (see imgurindex.MIN_COMMENTS) don't
+  get one."""
+  account_dir = get_account_dir(account_id, cache_dir=cache_dir)
+  legacy_index_file = os.path.join(account_dir, LEGACY_INDEX_FILENAME)
+  if os.path.isfile(legacy_index_file):
+    os.remove(legacy_index_file)
+  index_file = get_index_filename(account_id, cache_dir=cache_dir)
+  count = count_cached_comments(account_id, cache_dir=cache_dir)
+  if count < imgurindex.MIN_COMMENTS:
+    if os.path.isfile(index_file):
+      os.remove(index_file)
+    return
+  last = get_last_segment(account_id, cache_dir=cache_dir)
+  index = imgurindex.CommentIndex(index_file)
+  try:
+    if index.segment == last and len(index) == count:
+      return
+    if index.segment == previous and len(index) + new_count == count:
+      if new_segment is not None:
+        with open(new_segment, 'rb') as filehandle:
+          index.add(iter_segment(filehandle))
+    else:
+      index.clear()
+      for segment_file in get_segment_files(account_id, cache_dir):
+        with open(segment_file, 'rb') as filehandle:
+          index.add(iter_segment(filehandle))
+    index.set_segment(last)
+  finally:
+    index.close()
 
 
-def username_to_id(user, client_id, user_agent=USER_AGENT):
+def username_to_id(user, client_id, user_agent=USER_AGENT, cache_dir=None):
+  """Return the account id of "user". Once one is looked up, it's stored in the
+  cache directory (see AccountIds), so it's only ever requested once."""
+  account_ids = get_account_ids(cache_dir)
+  account_id = account_ids.get(user)
+  if account_id is not None:
+    return account_id
   api_path = ACCOUNT_PATH.format(user)
   (response, account_data) = imgurlib.make_request(
     api_path,
@@ -175,7 +1462,9 @@ def username_to_id(user, client_id, user_agent=USER_AGENT):
     domain=API_DOMAIN
   )
   imgurlib.handle_status(response.status, fatal=False)
-  return str(account_data['id'])
+  account_id = str(account_data['id'])
+  account_ids.set(user, account_id)
+  return account_id
 
 
 def fail(message):
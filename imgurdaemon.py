@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""A long-running search server, which keeps users' cached comments in memory
+and answers searches over a local Unix socket. Run it with search-daemon.py,
+and query it with search-comments.py --daemon.
+The protocol is lines of JSON. The client sends one request, a dict with the
+"user", "queries", "regex", "ignore_case", "invert", and "limit" of the search.
+The server answers with one line per result, a dict with the "comment" and the
+queries it "matched", then a last line of {"done": true}, or {"error": message}
+if something went wrong."""
+from __future__ import division
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import collections
+import SocketServer
+import imgurcache
+import imgurmatch
+import imgurrecord
+
+SOCKET_FILENAME = 'search.sock'
+MEMORY_BUDGET = 512*1024*1024
+REFRESH_INTERVAL = 5*60
+
+
+class DaemonError(Exception):
+  pass
+
+
+class UserEntry(object):
+  """What the daemon keeps in memory for one user: their comments (newest
+  first), and the newest cache segment they go up to, which says whether the
+  search index on disk covers them. "lock" guards changes to both. "strings"
+  holds the one copy of each author and image id their comments share (see
+  imgurrecord.Comment.share_strings()), so it's dropped along with them."""
+
+  def __init__(self, user):
+    self.user = user
+    self.account_id = None
+    self.comments = None
+    self.segment = None
+    self.strings = None
+    self.size = 0
+    self.refreshed = 0
+    self.lock = threading.Lock()
+
+
+class SearchDaemon(object):
+  """Answers searches of the comments of any number of users, keeping the most
+  recently searched ones in memory, up to about "memory_budget" bytes. The
+  least recently searched users are dropped to stay under it (but the latest
+  one is always kept, even if it's bigger).
+  Users in memory are brought up to date with the API every
+  "refresh_interval" seconds by a background thread (see start_refresher()),
+  which also writes the new comments through to the cache."""
+
+  def __init__(self, client_id, memory_budget=MEMORY_BUDGET,
+      refresh_interval=REFRESH_INTERVAL, user_agent=imgurcache.USER_AGENT,
+      verbosity=0):
+    self.client_id = client_id
+    self.memory_budget = memory_budget
+    self.refresh_interval = refresh_interval
+    self.user_agent = user_agent
+    self.verbosity = verbosity
+    # Least recently used first.
+    self.users = collections.OrderedDict()
+    self.account_ids = {}
+    self.lock = threading.Lock()
+
+  def search(self, user, queries, regex=False, ignore_case=True, invert=False,
+      limit=0):
+    """Yield a (comment, matched) tuple for each comment by "user" which
+    matches any of "queries", newest first, like search-comments.py does.
+    Like there, the search index narrows down the comments to check for any
+    search but an inverted one."""
+    matcher = imgurmatch.Matcher(queries, regex=regex, ignore_case=ignore_case)
+    entry = self.get_entry(user)
+    with entry.lock:
+      comments = entry.comments
+      candidate_ids = None
+      if not invert:
+        candidate_ids = imgurcache.get_candidate_ids(entry.account_id, queries,
+          regex=regex, segment=entry.segment, count=len(comments))
+    hits = 0
+    for comment in comments:
+      if candidate_ids is not None and comment['id'] not in candidate_ids:
+        continue
+      matched = matcher.get_hits(comment['comment'])
+      if (not invert and matched) or (invert and not matched):
+        yield (comment, matched)
+        hits += 1
+        if limit and hits >= limit:
+          return
+
+  def get_entry(self, user):
+    """Return the UserEntry for "user", loading it if it isn't in memory, and
+    mark it as the most recently used."""
+    with self.lock:
+      entry = self.users.pop(user, None)
+      if entry is None:
+        entry = UserEntry(user)
+      self.users[user] = entry
+    with entry.lock:
+      if entry.comments is None:
+        try:
+          self.load(entry)
+        except Exception:
+          with self.lock:
+            if self.users.get(user) is entry:
+              del self.users[user]
+          raise
+    self.evict()
+    return entry
+
+  def load(self, entry):
+    """Read the user's comments from the cache (bringing it up to date with the
+    API first). Call with "entry.lock" held."""
+    if entry.account_id is None:
+      entry.account_id = self.get_account_id(entry.user)
+    comments = imgurcache.get_cached_and_live_comments(entry.user,
+      self.client_id, account_id=entry.account_id, user_agent=self.user_agent)
+    strings = {}
+    comments = [imgurrecord.from_dict(comment, strings)
+                for comment in comments]
+    entry.comments = comments
+    entry.strings = strings
+    entry.segment = imgurcache.get_last_segment(entry.account_id)
+    entry.size = measure_size(comments, strings)
+    entry.refreshed = time.time()
+    self.log('Loaded {} comments by {} ({:0.1f} MB).'.format(len(comments),
+      entry.user, entry.size/1024/1024))
+
+  def get_account_id(self, user):
+    account_id = self.account_ids.get(user)
+    if account_id is None:
+      account_id = imgurcache.username_to_id(user, self.client_id,
+        user_agent=self.user_agent)
+      self.account_ids[user] = account_id
+    return account_id
+
+  def evict(self):
+    """Drop the least recently used users until the rest fit in the memory
+    budget."""
+    with self.lock:
+      total = sum(entry.size for entry in self.users.values())
+      while total > self.memory_budget and len(self.users) > 1:
+        (user, entry) = self.users.popitem(last=False)
+        total -= entry.size
+        self.log('Dropped {} from memory.'.format(user))
+
+  def refresh(self, entry):
+    """Fetch any new comments for a user in memory, adding them to the cache
+    and to the copy in memory. If the cache has changed underneath it (say,
+    another program added to it), the user is just reloaded."""
+    with entry.lock:
+      if entry.comments is None:
+        return
+      if entry.comments:
+        newest = entry.comments[0]
+      else:
+        newest = None
+      cached_newest = imgurcache.get_newest_cached_comment(entry.account_id)
+      if (cached_newest is None) != (newest is None) or (newest is not None
+          and cached_newest['id'] != newest['id']):
+        self.load(entry)
+        return
+    if newest is None:
+      cutoff_date = 0
+    else:
+      cutoff_date = newest['datetime'] + 1
+    new_comments = []
+    for comments in imgurcache.get_live_comment_chunks(entry.user,
+        self.client_id, cutoff_date=cutoff_date, account_id=entry.account_id,
+        user_agent=self.user_agent):
+      new_comments.extend(imgurrecord.from_dict(comment, entry.strings)
+                          for comment in comments)
+    with entry.lock:
+      if new_comments:
+        entry.comments = new_comments + entry.comments
+        entry.size = measure_size(entry.comments, entry.strings)
+        self.log('Added {} new comments by {}.'.format(len(new_comments),
+          entry.user))
+      # If another program added comments to the cache between the ones in
+      # memory and these, they're missing here.
+      if (imgurcache.count_cached_comments(entry.account_id)
+          != len(entry.comments)):
+        self.load(entry)
+        return
+      entry.segment = imgurcache.get_last_segment(entry.account_id)
+      entry.refreshed = time.time()
+
+  def refresh_all(self):
+    """Refresh every user in memory which is due for it."""
+    with self.lock:
+      entries = self.users.values()
+    for entry in entries:
+      if time.time() - entry.refreshed < self.refresh_interval:
+        continue
+      try:
+        self.refresh(entry)
+      except Exception as error:
+        self.log('Error refreshing {}: {}'.format(entry.user, error))
+    self.evict()
+
+  def start_refresher(self):
+    """Start a background thread which calls refresh_all() periodically."""
+    thread = threading.Thread(target=self.run_refresher)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def run_refresher(self):
+    while True:
+      time.sleep(min(self.refresh_interval, 60))
+      self.refresh_all()
+
+  def log(self, message):
+    if self.verbosity >= 1:
+      sys.stderr.write(message+'\n')
+
+
+def measure_size(comments, strings):
+  """Return how many bytes the list "comments" takes up in memory: the list
+  itself, each comment with all its field values, and the "strings" they share
+  (see imgurrecord.Comment.share_strings()), which are only counted once."""
+  size = sys.getsizeof(comments) + sys.getsizeof(strings)
+  for value in strings:
+    size += sys.getsizeof(value)
+  for comment in comments:
+    size += sys.getsizeof(comment)
+    if isinstance(comment, imgurrecord.Comment):
+      for field in imgurrecord.Comment.__slots__:
+        if field not in imgurrecord.INTERNED_FIELDS:
+          size += sys.getsizeof(getattr(comment, field))
+    else:
+      for (key, value) in comment.iteritems():
+        size += sys.getsizeof(key) + sys.getsizeof(value)
+  return size
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    try:
+      request = json.loads(self.rfile.readline())
+      results = self.server.daemon.search(request['user'], request['queries'],
+        regex=request.get('regex', False),
+        ignore_case=request.get('ignore_case', True),
+        invert=request.get('invert', False), limit=request.get('limit', 0))
+      for (comment, matched) in results:
+        self.send({'comment':dict(comment), 'matched':matched})
+      self.send({'done':True})
+    except socket.error:
+      # The client hung up (like after getting as many results as it wanted).
+      pass
+    except Exception as error:
+      try:
+        self.send({'error':'{}: {}'.format(type(error).__name__, error)})
+      except socket.error:
+        pass
+
+  def send(self, message):
+    self.wfile.write(json.dumps(message)+'\n')
+
+  def finish(self):
+    try:
+      SocketServer.StreamRequestHandler.finish(self)
+    except socket.error:
+      # The client hung up before the last results were flushed to it, so
+      # closing "wfile" (which flushes again) failed too.
+      self.rfile.close()
+
+
+class DaemonServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path, daemon):
+    if os.path.exists(socket_path):
+      if is_listening(socket_path):
+        raise DaemonError('A daemon is already listening on '+socket_path)
+      # Left behind by a daemon which didn't shut down cleanly.
+      os.remove(socket_path)
+    SocketServer.UnixStreamServer.__init__(self, socket_path, RequestHandler)
+    self.daemon = daemon
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+
+
+def is_listening(socket_path):
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+  except socket.error:
+    return False
+  finally:
+    sock.close()
+  return True
+
+
+def query_daemon(socket_path, request):
+  """Send a search "request" (see the module docstring) to the daemon listening
+  on "socket_path", and yield (comment, matched) tuples as the results come
+  in. Raises DaemonError if the daemon reports an error, and socket.error if
+  it can't be reached."""
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(socket_path)
+    sock.sendall(json.dumps(request)+'\n')
+    for line in sock.makefile('rb'):
+      message = json.loads(line)
+      if 'error' in message:
+        raise DaemonError(message['error'])
+      if message.get('done'):
+        return
+      yield (message['comment'], message['matched'])
+    raise DaemonError('The daemon closed the connection early.')
+  finally:
+    sock.close()
+
+
+def get_socket_path(cache_dir=None):
+  """Return the default socket path: SOCKET_FILENAME in the cache directory."""
+  return os.path.join(imgurcache.get_cache_dir(cache_dir), SOCKET_FILENAME)
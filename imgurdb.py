@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""A SQLite database of comments from any number of users, for structured
+queries across everyone in the cache (like "all comments on this image"),
+without loading whole cache files into memory."""
+from __future__ import division
+import re
+import json
+import sqlite3
+import imgurmatch
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS comments (
+  id INTEGER PRIMARY KEY,
+  account_id TEXT,
+  author TEXT,
+  image_id TEXT,
+  parent_id INTEGER,
+  datetime INTEGER,
+  points INTEGER,
+  comment TEXT,
+  json TEXT
+);
+CREATE INDEX IF NOT EXISTS comments_account_id ON comments (account_id);
+CREATE INDEX IF NOT EXISTS comments_author ON comments (author);
+CREATE INDEX IF NOT EXISTS comments_image_id ON comments (image_id);
+CREATE INDEX IF NOT EXISTS comments_parent_id ON comments (parent_id);
+CREATE INDEX IF NOT EXISTS comments_datetime ON comments (datetime);
+CREATE INDEX IF NOT EXISTS comments_points ON comments (points);
+CREATE TABLE IF NOT EXISTS segments (
+  path TEXT PRIMARY KEY
+);
+"""
+# Comment text is case folded the way Python's case-insensitive matching does
+# it before it's indexed (see fold()), so the full-text index finds everything
+# a search does. (The tokenizer folds case too, but not exactly the same way:
+# it leaves "\u0131", the dotless i, alone.)
+FTS_TABLE = 'comment_words'
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS comment_words USING fts4 (comment,
+  tokenize=unicode61 "remove_diacritics=0");
+"""
+# The full-text indexes of older versions, which folded case differently.
+LEGACY_FTS_TABLES = ('comments_fts', 'comment_text')
+ORDERS = {
+  'newest':'datetime DESC',
+  'oldest':'datetime ASC',
+  'points':'points DESC, datetime DESC',
+}
+
+
+class CommentDB(object):
+  """A SQLite database of comments, stored at "path".
+  Comments are stored whole (as JSON) along with indexed copies of the fields
+  you'd want to query by. If the SQLite library has FTS4, there's also a
+  full-text index of the comment text, used to narrow down text searches."""
+
+  def __init__(self, path):
+    self.conn = sqlite3.connect(path)
+    self.conn.create_function('regexp', 2, regexp)
+    self.conn.create_function('iregexp', 2, iregexp)
+    self.conn.create_function('fold', 1, fold)
+    self.conn.executescript(SCHEMA)
+    with self.conn:
+      for table in LEGACY_FTS_TABLES:
+        self.conn.execute('DROP TABLE IF EXISTS '+table)
+    created = not self.has_table(FTS_TABLE)
+    try:
+      self.conn.executescript(FTS_SCHEMA)
+      self.fts = True
+    except sqlite3.OperationalError:
+      self.fts = False
+    if self.fts and created:
+      # Index whatever was added before there was a full-text index.
+      with self.conn:
+        self.conn.execute('INSERT INTO '+FTS_TABLE+' (docid, comment) '
+          'SELECT id, fold(comment) FROM comments')
+
+  def has_table(self, name):
+    cursor = self.conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?',
+      (name,))
+    return cursor.fetchone() is not None
+
+  def close(self):
+    self.conn.close()
+
+  def has_segment(self, path):
+    cursor = self.conn.execute('SELECT 1 FROM segments WHERE path = ?', (path,))
+    return cursor.fetchone() is not None
+
+  def add_segment(self, path, account_id, comments):
+    """Add the "comments" from the cache segment "path" (from "account_id"), and
+    record that it's been added. All in one transaction."""
+    with self.conn:
+      self.add_comments(account_id, comments)
+      self.conn.execute('INSERT OR REPLACE INTO segments (path) VALUES (?)',
+        (path,))
+
+  def add_comments(self, account_id, comments):
+    rows = []
+    for comment in comments:
+      rows.append((comment['id'], account_id, comment.get('author'),
+        comment.get('image_id'), comment.get('parent_id'),
+        comment.get('datetime'), comment.get('points'), comment.get('comment'),
+        json.dumps(dict(comment))))
+    self.conn.executemany('INSERT OR REPLACE INTO comments (id, account_id, '
+      'author, image_id, parent_id, datetime, points, comment, json) '
+      'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    if self.fts:
+      self.conn.executemany('DELETE FROM '+FTS_TABLE+' WHERE docid = ?',
+        [(row[0],) for row in rows])
+      self.conn.executemany('INSERT INTO '+FTS_TABLE+' (docid, comment) '
+        'VALUES (?, ?)', [(row[0], fold(row[7])) for row in rows])
+
+  def get_comments(self, queries=None, regex=False, ignore_case=True,
+      account_ids=None, authors=None, image_id=None, since=None,
+      order='newest', limit=0):
+    """Yield the comments which fit all the given criteria, one at a time.
+    "queries" is a list of literal strings (or regexes, if "regex"), at least
+    one of which the comment text must contain. "since" is a unix timestamp.
+    "order" is one of the keys of ORDERS.
+    Results are streamed from the database, so memory use stays flat."""
+    conditions = []
+    params = []
+    if queries is not None:
+      alternatives = []
+      for query in queries:
+        if isinstance(query, str):
+          query = query.decode('utf8')
+        (where, query_params) = get_text_condition(query, regex, ignore_case,
+          self.fts)
+        alternatives.append('('+where+')')
+        params.extend(query_params)
+      conditions.append('('+' OR '.join(alternatives)+')')
+    for (column, values) in (('account_id', account_ids), ('author', authors)):
+      if values:
+        conditions.append('{} IN ({})'.format(column,
+          ', '.join('?' for value in values)))
+        params.extend(values)
+    if image_id is not None:
+      conditions.append('image_id = ?')
+      params.append(image_id)
+    if since is not None:
+      conditions.append('datetime >= ?')
+      params.append(since)
+    sql = 'SELECT json FROM comments'
+    if conditions:
+      sql += ' WHERE '+' AND '.join(conditions)
+    sql += ' ORDER BY '+ORDERS[order]
+    if limit:
+      sql += ' LIMIT ?'
+      params.append(limit)
+    for (comment_json,) in self.conn.execute(sql, params):
+      yield json.loads(comment_json)
+
+
+def get_text_condition(query, regex, ignore_case, fts):
+  """Return an SQL condition (and list of its parameters) selecting comments
+  which contain "query"."""
+  if regex:
+    if ignore_case:
+      return ('iregexp(?, comment)', [query])
+    else:
+      return ('regexp(?, comment)', [query])
+  if ignore_case:
+    # Not LIKE: it only folds the case of ASCII letters, so it would miss
+    # matches which differ in the case of any others.
+    where = 'iregexp(?, comment)'
+    params = [re.escape(query)]
+  else:
+    where = 'instr(comment, ?) > 0'
+    params = [query]
+  fts_query = get_fts_query(query)
+  if fts and fts_query:
+    where = ('id IN (SELECT docid FROM {0} WHERE {0} MATCH ?) AND '
+      .format(FTS_TABLE)+where)
+    params.insert(0, fts_query)
+  return (where, params)
+
+
+def get_fts_query(query):
+  """Return an FTS MATCH expression which every comment containing the literal
+  string "query" is sure to match, or None if there isn't a useful one.
+  Only whole words can be looked up in the full-text index, so this only uses
+  the words in "query" which can't be part of a longer word in the comment:
+  the ones between two separators. The last word can also be looked up as a
+  prefix, if it comes after a separator."""
+  # Stick to ASCII, where we know exactly what the FTS tokenizer considers part
+  # of a word.
+  if not re.search(r'^[\x20-\x7e]*$', query):
+    return None
+  words = re.split(r'[^A-Za-z0-9]+', query)
+  terms = []
+  for (i, word) in enumerate(words):
+    if not word:
+      continue
+    # (Lowercase, so words like "OR" aren't taken as operators.)
+    if 0 < i < len(words)-1:
+      terms.append(word.lower())
+    elif i == len(words)-1 and i > 0:
+      terms.append(word.lower()+'*')
+  if terms:
+    return ' '.join(terms)
+  else:
+    return None
+
+
+def regexp(pattern, text):
+  return (text is not None
+          and re.search(pattern, text, re.UNICODE) is not None)
+
+
+def iregexp(pattern, text):
+  return (text is not None
+          and re.search(pattern, text, re.UNICODE|re.I) is not None)
+
+
+def fold(text):
+  """Return "text" as it's stored in the full-text index (see FTS_TABLE)."""
+  if text is None:
+    return None
+  if isinstance(text, str):
+    text = text.decode('utf8')
+  return imgurmatch.fold_case(text)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""An inverted index over a user's cached comments. It maps tokens and trigrams
+to the comments containing them, so a search only has to check the comments
+which could possibly match instead of every comment in the cache.
+The index is a SQLite file, so a search only reads the postings of the keys in
+its queries, instead of loading the whole index."""
+from __future__ import division
+import os
+import re
+import zlib
+import struct
+import sqlite3
+import sre_parse
+import sre_constants
+import imgurmatch
+
+VERSION = 4
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+WORD_PATTERN = re.compile(r'^\w+$', re.UNICODE)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+  name TEXT PRIMARY KEY,
+  value INTEGER
+);
+CREATE TABLE IF NOT EXISTS tokens (
+  key TEXT,
+  ids BLOB
+);
+CREATE INDEX IF NOT EXISTS tokens_key ON tokens (key);
+CREATE TABLE IF NOT EXISTS trigrams (
+  key TEXT,
+  ids BLOB
+);
+CREATE INDEX IF NOT EXISTS trigrams_key ON trigrams (key);
+"""
+# Comments are indexed this many at a time, so only one batch of postings is
+# ever in memory. Each batch adds a row of postings for each of its keys.
+BATCH_SIZE = 5000
+# Accounts with fewer comments than this aren't indexed: scanning them all is
+# already about as fast as looking anything up.
+MIN_COMMENTS = 2000
+# If a query's candidates are more than this fraction of the comments, the
+# index isn't worth using for it, since nearly every block of the cache would
+# have to be read anyway.
+MAX_CANDIDATES = 0.25
+
+
+class CommentIndex(object):
+  """Token and trigram postings over a set of comments, stored in the SQLite
+  file "path". Postings are sets of comment ids. All text is case folded before
+  indexing, the same way case-insensitive searches fold it (see
+  imgurmatch.fold_case()), so the same index gives candidates for both
+  case-sensitive and case-insensitive queries. Candidates still have to be
+  checked against the actual comment text.
+  "segment" records the newest cache segment the index covers, and "count" the
+  number of comments in it. Changes are only saved by set_segment()."""
+
+  def __init__(self, path):
+    self.path = path
+    self.conn = sqlite3.connect(path)
+    self.conn.executescript(SCHEMA)
+    meta = dict(self.conn.execute('SELECT name, value FROM meta'))
+    if meta.get('version') == VERSION:
+      self.segment = meta.get('segment', 0)
+      self.count = meta.get('count', 0)
+    else:
+      self.clear()
+
+  def __len__(self):
+    return self.count
+
+  def close(self):
+    self.conn.close()
+
+  def clear(self):
+    """Remove everything from the index (not saved until set_segment())."""
+    self.conn.execute('DELETE FROM tokens')
+    self.conn.execute('DELETE FROM trigrams')
+    self.segment = 0
+    self.count = 0
+
+  def add(self, comments):
+    """Add the comments from an iterable, BATCH_SIZE at a time."""
+    batch = []
+    for comment in comments:
+      batch.append(comment)
+      if len(batch) >= BATCH_SIZE:
+        self.add_batch(batch)
+        batch = []
+    if batch:
+      self.add_batch(batch)
+
+  def add_batch(self, comments):
+    tokens = {}
+    trigrams = {}
+    for comment in comments:
+      text = imgurmatch.fold_case(comment['comment'])
+      for token in set(TOKEN_PATTERN.findall(text)):
+        tokens.setdefault(token, []).append(comment['id'])
+      for trigram in get_trigrams(text):
+        trigrams.setdefault(trigram, []).append(comment['id'])
+    for (table, postings) in (('tokens', tokens), ('trigrams', trigrams)):
+      self.conn.executemany('INSERT INTO {} (key, ids) VALUES (?, ?)'
+        .format(table), ((key, encode_ids(ids))
+                         for (key, ids) in postings.iteritems()))
+    self.count += len(comments)
+
+  def set_segment(self, segment):
+    """Record that the index covers the cache up to "segment", and save all the
+    changes since the last call."""
+    self.segment = segment
+    with self.conn:
+      self.conn.executemany('INSERT OR REPLACE INTO meta (name, value) '
+        'VALUES (?, ?)', (('version', VERSION), ('segment', segment),
+                          ('count', self.count)))
+
+  def candidates(self, query, regex=False):
+    """Return the set of ids of the comments which might match "query".
+    If the index can't narrow down the search much (say, a regex with no
+    required literal text, or a query in a large share of the comments),
+    returns None and every comment has to be checked."""
+    if regex:
+      literals = get_required_literals(query)
+    else:
+      literals = [query]
+    ids = None
+    for literal in literals:
+      literal_ids = self.get_literal_ids(imgurmatch.fold_case(literal))
+      if literal_ids is None:
+        continue
+      if ids is None:
+        ids = literal_ids
+      else:
+        ids &= literal_ids
+    if ids is None or len(ids) > MAX_CANDIDATES*self.count:
+      return None
+    return ids
+
+  def get_literal_ids(self, literal):
+    """Return the set of ids of the comments which could contain "literal", or
+    None if the index can't tell."""
+    if len(literal) >= 3:
+      ids = None
+      for trigram in get_trigrams(literal):
+        trigram_ids = self.get_postings('trigrams', 'key = ?', trigram)
+        if ids is None:
+          ids = trigram_ids
+        else:
+          ids &= trigram_ids
+        if not ids:
+          break
+      return ids
+    elif WORD_PATTERN.search(literal):
+      # A short run of word characters can only occur inside a single token, so
+      # scan the vocabulary instead of the comments.
+      return self.get_postings('tokens', 'instr(key, ?) > 0', literal)
+    else:
+      return None
+
+  def get_postings(self, table, where, param):
+    ids = set()
+    cursor = self.conn.execute('SELECT ids FROM {} WHERE {}'.format(table,
+      where), (param,))
+    for (blob,) in cursor:
+      ids.update(decode_ids(blob))
+    return ids
+
+
+def encode_ids(ids):
+  """Pack a list of comment ids into a compact string: the gaps between them,
+  in order, compressed."""
+  ids = sorted(ids)
+  gaps = [ids[0]] + [ids[i] - ids[i-1] for i in range(1, len(ids))]
+  return buffer(zlib.compress(struct.pack('<{}q'.format(len(gaps)), *gaps), 1))
+
+
+def decode_ids(blob):
+  gaps = zlib.decompress(blob)
+  ids = []
+  total = 0
+  for gap in struct.unpack('<{}q'.format(len(gaps)//8), gaps):
+    total += gap
+    ids.append(total)
+  return ids
+
+
+def get_trigrams(text):
+  return set(text[i:i+3] for i in range(len(text)-2))
+
+
+def get_required_literals(pattern):
+  """Return a list of literal strings which any match of the regex "pattern"
+  must contain. Only runs of literal characters at the top level of the
+  pattern count, so alternations, groups, and repeats just break up the runs.
+  Returns an empty list if there are none, or the pattern can't be parsed."""
+  try:
+    parsed = sre_parse.parse(pattern)
+  except sre_constants.error:
+    return []
+  literals = []
+  run = []
+  for (op, value) in parsed:
+    if op == sre_constants.LITERAL:
+      run.append(unichr(value))
+    else:
+      if run:
+        literals.append(u''.join(run))
+      run = []
+  if run:
+    literals.append(u''.join(run))
+  return literals
+
+
+def open_index(index_file):
+  """Open the index stored in "index_file". Returns None if there is none."""
+  if not os.path.isfile(index_file):
+    return None
+  return CommentIndex(index_file)
@@ -1,13 +1,27 @@
 #!/usr/bin/env python
 from __future__ import division
 import os
+import re
 import sys
 import json
+import time
+import zlib
+import atexit
+import pstats
+import random
+import socket
 import urllib
 import httplib
+import hashlib
+import cProfile
 import datetime
+import threading
+import collections
 
-API_DOMAIN = 'api.imgur.com'
+# The API host can be overridden for testing against a stand-in server (like
+# bench/fakeimgur.py), which would also use plain "http".
+API_DOMAIN = os.environ.get('IMGUR_API_DOMAIN', 'api.imgur.com')
+API_SCHEME = os.environ.get('IMGUR_API_SCHEME', 'https')
 USER_AGENT = 'NBS client'
 
 LINK_FORMAT = u'https://imgur.com/gallery/{image_id}/comment/{id}'
@@ -24,6 +38,44 @@ HTTP_MSGS = {
   429:'Exceeded request quota (HTTP status {})'
 }
 HTTP_MSG_DEFAULT = 'HTTP status {}'
+POOL_SIZE = 4
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# How long (in seconds) responses from each kind of endpoint stay fresh in the
+# response cache. Endpoints not listed here are never cached.
+RESPONSE_TTLS = (
+  (r'^/3/account/[^/]+$', 7*24*60*60),
+  (r'^/3/account/[^/]+/comments/count$', 60*60),
+  (r'^/3/comment/\d+$', 60*60),
+)
+RESPONSE_CACHE_MAX_BYTES = 50*1024*1024
+# Once the response cache is over its limit, it's trimmed down to this share of
+# it, so it isn't rescanned on every write while it's hovering at the limit.
+RESPONSE_CACHE_LOW_WATER = 0.9
+# Requests are grouped in the metrics by these endpoints. Any other path is
+# grouped under "other".
+ENDPOINTS = (
+  (r'^/3/account/[^/]+$', '/3/account/{user}'),
+  (r'^/3/account/[^/]+/comments$', '/3/account/{user}/comments'),
+  (r'^/3/account/[^/]+/comments/count$', '/3/account/{user}/comments/count'),
+  (r'^/3/comment/\d+$', '/3/comment/{id}'),
+  (r'^/3/gallery/random/random/\d+$', '/3/gallery/random/random/{page}'),
+  (r'^/3/gallery/[^/]+/comments(/\w+)?$', '/3/gallery/{id}/comments'),
+  (r'^/3/credits$', '/3/credits'),
+)
+# Upper bounds (in seconds) of the buckets of the latency histograms.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# The phases of a request which are timed. "wait" is time spent held back by
+# the rate limiter, "connect" is setting up a new connection (including TLS),
+# "response" is from sending the request to getting the response headers,
+# "read" is reading the body, and "decode" is parsing the JSON.
+PHASES = ('wait', 'connect', 'response', 'read', 'decode', 'total')
+PROFILE_LINES = 25
+# Responses are requested gzipped, and streamed responses are read this many
+# (compressed) bytes at a time.
+ACCEPT_ENCODING = 'gzip'
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+READ_SIZE = 16384
+WHITESPACE = re.compile(r'[ \t\n\r]*')
 
 
 class NearQuotaException(Exception):
@@ -56,44 +108,1015 @@ def include_args_from_file(argv, default_file, prefix='@'):
 
 
 def make_request(path, client_id, user_agent=USER_AGENT, params=None,
-    headers=None, domain=API_DOMAIN):
+    headers=None, domain=API_DOMAIN, stream=False, cache=True):
+  """Make a GET request to the API and return the response and its "data".
+  The request goes over a persistent connection from the shared pool (POOL), so
+  consecutive requests to the same domain skip the connection and TLS setup.
+  It's also paced by the shared rate limiter (SCHEDULER), which retries it on a
+  429 or 5xx status. If the response says a quota is nearly used up, this
+  raises NearQuotaException, unless the rate limiter is allowed to wait for the
+  quota to reset.
+  If the response cache is enabled (see enable_response_cache()), fresh cached
+  responses are returned without making a request at all, and stale ones are
+  revalidated with their ETag. Give "cache" as false to skip it, for requests
+  which need an up-to-date answer.
+  If several Client-IDs were given to set_client_ids(), each request goes out
+  with whichever has the most budget left, instead of "client_id".
+  Responses are requested gzipped, to save bandwidth.
+  If "stream" is true and the data is a list, the data returned is instead an
+  iterator over its items, which parses them as the body arrives, so the first
+  ones can be used before the rest has been read, and the whole body is never
+  in memory at once. The connection only goes back to the pool once the
+  iterator is used up."""
   
+  start = time.time()
+  timings = {}
   if headers is None:
     headers = {
       'Authorization':'Client-ID '+client_id,
       'User-Agent':user_agent,
+      'Accept-Encoding':ACCEPT_ENCODING,
     }
 
   if params is None:
     path_and_params = path
   else:
-    path_and_params = path+'?'+urllib.urlencode(params)
-
-  conex = httplib.HTTPSConnection(domain)
-  conex.request(
-    'GET',
-    path_and_params,
-    None,
-    headers
-  )
-  
-  response = conex.getresponse()
-  message = near_quota(response)
-  if message:
+    path_and_params = path+'?'+urllib.urlencode(sorted(params.items()))
+
+  cache_key = None
+  entry = None
+  if cache and RESPONSE_CACHE is not None and RESPONSE_CACHE.get_ttl(path):
+    cache_key = domain+path_and_params
+    entry = RESPONSE_CACHE.get(cache_key)
+    if entry is not None:
+      if RESPONSE_CACHE.is_fresh(entry, path):
+        METRICS.record(path, 'cached', {'total':time.time() - start})
+        return (CachedResponse(entry), entry['data'])
+      if entry.get('etag'):
+        headers = dict(headers)
+        headers['If-None-Match'] = entry['etag']
+
+  client_ids = CLIENT_IDS or [client_id]
+  attempt = 0
+  while True:
+    phase_start = time.time()
+    key = SCHEDULER.choose(client_ids)
+    SCHEDULER.acquire(key)
+    add_timing(timings, 'wait', time.time() - phase_start)
+    if key != client_id:
+      request_headers = dict(headers)
+      request_headers['Authorization'] = 'Client-ID '+key
+    else:
+      request_headers = headers
+    (conex, response) = send_request(domain, path_and_params, request_headers,
+      timings=timings)
+    SCHEDULER.update(response, key)
+    if response.status in RETRY_STATUSES and attempt < SCHEDULER.max_retries:
+      try:
+        response.read()
+      except (httplib.HTTPException, socket.error):
+        POOL.discard(conex)
+      else:
+        POOL.put(domain, conex, response)
+      METRICS.record(path, response.status, {}, response=response)
+      phase_start = time.time()
+      SCHEDULER.backoff(attempt, response)
+      add_timing(timings, 'wait', time.time() - phase_start)
+      attempt += 1
+      continue
+    break
+
+  message = near_quota(response, margin=SCHEDULER.margin)
+  if message and not SCHEDULER.can_continue(client_ids):
+    POOL.discard(conex)
+    METRICS.record(path, response.status, timings, response=response)
     raise NearQuotaException(message)
 
-  content = response.read()
-  conex.close()
+  if stream and response.status == 200 and cache_key is None:
+    return (response, stream_data(domain, conex, response, path, timings,
+      start))
+
+  phase_start = time.time()
+  try:
+    content = response.read()
+  except (httplib.HTTPException, socket.error):
+    POOL.discard(conex)
+    raise
+  add_timing(timings, 'read', time.time() - phase_start)
+  POOL.put(domain, conex, response)
+  size = len(content)
+  if response.status == 304 and entry is not None:
+    RESPONSE_CACHE.refresh(cache_key, entry)
+    timings['total'] = time.time() - start
+    METRICS.record(path, response.status, timings, size=size,
+      response=response)
+    return (CachedResponse(entry), entry['data'])
+  phase_start = time.time()
   try:
+    content = decode_body(response, content)
     api_response = json.loads(content)
-  except ValueError:
+  except (ValueError, zlib.error):
     sys.stderr.write('JSON parsing error on content:\n'+content[:80]+'\n')
     raise
+  add_timing(timings, 'decode', time.time() - phase_start)
   json_data = api_response['data']
+  timings['total'] = time.time() - start
+  METRICS.record(path, response.status, timings, size=size,
+    response=response)
 
+  if cache_key is not None and response.status == 200:
+    RESPONSE_CACHE.put(cache_key, response, json_data)
+
+  if stream and isinstance(json_data, list):
+    json_data = iter(json_data)
   return (response, json_data)
 
 
+def stream_data(domain, conex, response, path, timings, start):
+  """Yield the items of the "data" list in the body of "response" as they're
+  read, decompressing and parsing the body a piece at a time. Once it's all
+  been read, the connection goes back to the pool and the request is recorded
+  in METRICS. If the caller stops early, the connection is thrown away
+  instead, since the rest of the body is still waiting on it."""
+  parser = JSONItemParser('data')
+  decompressor = get_decompressor(response)
+  size = 0
+  done = False
+  try:
+    while not done:
+      phase_start = time.time()
+      chunk = response.read(READ_SIZE)
+      add_timing(timings, 'read', time.time() - phase_start)
+      size += len(chunk)
+      phase_start = time.time()
+      if decompressor is None:
+        text = chunk
+      elif chunk:
+        text = decompressor.decompress(chunk)
+      else:
+        text = decompressor.flush()
+      items = parser.feed(text)
+      if not chunk:
+        items.extend(parser.close())
+        done = True
+      add_timing(timings, 'decode', time.time() - phase_start)
+      for item in items:
+        yield item
+    if 'data' in parser.values:
+      raise ValueError('Expected the response data to be a list.')
+  finally:
+    if done:
+      POOL.put(domain, conex, response)
+      timings['total'] = time.time() - start
+      METRICS.record(path, response.status, timings, size=size,
+        response=response)
+    else:
+      POOL.discard(conex)
+
+
+def get_decompressor(response):
+  """Return a zlib decompressor for the body of "response", or None if it
+  isn't compressed."""
+  if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+    return zlib.decompressobj(GZIP_WBITS)
+  return None
+
+
+def decode_body(response, content):
+  """Return the body "content" of "response", decompressed if need be."""
+  if (response.getheader('Content-Encoding') or '').lower() == 'gzip':
+    return zlib.decompress(content, GZIP_WBITS)
+  return content
+
+
+class JSONItemParser(object):
+  """An incremental parser for a JSON object holding a list, like the API's
+  {"data": [...], "success": true, "status": 200}.
+  Give it the text a piece at a time with feed(), and it returns the items of
+  the list under "key" as soon as each one is complete. The object's other
+  values end up in "values". Call close() after the last piece.
+  Only the text of the item being parsed is kept around, never the whole
+  object."""
+
+  def __init__(self, key):
+    self.key = key
+    self.values = {}
+    self.buffer = ''
+    self.pos = 0
+    self.state = 'start'
+    self.current_key = None
+    self.closed = False
+    self.decoder = json.JSONDecoder()
+
+  def feed(self, text):
+    """Add "text", and return a list of the items it completed."""
+    self.buffer = self.buffer[self.pos:]+text
+    self.pos = 0
+    items = []
+    while self.step(items):
+      pass
+    return items
+
+  def close(self):
+    """Finish parsing, and return a list of any items left. Raises ValueError
+    if the object isn't complete."""
+    self.closed = True
+    items = self.feed('')
+    if self.state != 'end':
+      raise ValueError('Incomplete JSON object.')
+    return items
+
+  def step(self, items):
+    """Parse the next token (or value) in the buffer. Returns False if there
+    isn't enough text to yet."""
+    pos = WHITESPACE.match(self.buffer, self.pos).end()
+    self.pos = pos
+    if pos >= len(self.buffer):
+      return False
+    char = self.buffer[pos]
+    state = self.state
+    if state == 'start' and char == '{':
+      self.state = 'first_key'
+    elif state == 'first_key' and char == '}':
+      self.state = 'end'
+    elif state in ('first_key', 'key') and char == '"':
+      result = self.decode(pos)
+      if result is None:
+        return False
+      (self.current_key, pos) = result
+      self.state = 'colon'
+      self.pos = pos
+      return True
+    elif state == 'colon' and char == ':':
+      self.state = 'value'
+    elif state == 'value' and self.current_key == self.key and char == '[':
+      self.state = 'first_item'
+    elif state == 'value':
+      result = self.decode(pos)
+      if result is None:
+        return False
+      (self.values[self.current_key], self.pos) = result
+      self.state = 'after_value'
+      return True
+    elif state == 'first_item' and char == ']':
+      self.state = 'after_value'
+    elif state in ('first_item', 'item'):
+      result = self.decode(pos)
+      if result is None:
+        return False
+      (item, self.pos) = result
+      items.append(item)
+      self.state = 'after_item'
+      return True
+    elif state == 'after_item' and char == ',':
+      self.state = 'item'
+    elif state == 'after_item' and char == ']':
+      self.state = 'after_value'
+    elif state == 'after_value' and char == ',':
+      self.state = 'key'
+    elif state == 'after_value' and char == '}':
+      self.state = 'end'
+    else:
+      raise ValueError('Unexpected {!r} in JSON.'.format(char))
+    self.pos = pos + 1
+    return True
+
+  def decode(self, pos):
+    """Return the value starting at "pos" in the buffer and where it ends, or
+    None if it might not be complete yet."""
+    try:
+      (value, end) = self.decoder.raw_decode(self.buffer, pos)
+    except ValueError:
+      if self.closed:
+        raise
+      return None
+    # A number (or true/false/null) isn't over until something follows it, since
+    # the rest of it could be in the next piece of text.
+    if not self.closed and self.buffer[pos] not in '{["' and (
+        end >= len(self.buffer) or self.buffer[end] not in ' \t\n\r,]}'):
+      return None
+    return (value, end)
+
+
+def send_request(domain, path_and_params, headers, timings=None):
+  """Send a GET request over a pooled connection. Returns the connection and
+  the response, whose body hasn't been read yet.
+  If "timings" is given (a dict), the seconds spent connecting and waiting for
+  the response are added to it (see PHASES)."""
+  if timings is None:
+    timings = {}
+  while True:
+    (conex, reused) = POOL.get(domain)
+    try:
+      if not reused:
+        phase_start = time.time()
+        conex.connect()
+        add_timing(timings, 'connect', time.time() - phase_start)
+      phase_start = time.time()
+      conex.request(
+        'GET',
+        path_and_params,
+        None,
+        headers
+      )
+      response = conex.getresponse()
+      add_timing(timings, 'response', time.time() - phase_start)
+    except (httplib.HTTPException, socket.error):
+      POOL.discard(conex)
+      if reused:
+        # The server closed the idle connection. The others for this domain are
+        # probably stale too, so drop them and retry on a fresh connection.
+        POOL.clear(domain)
+        continue
+      raise
+    POOL.count(reused)
+    return (conex, response)
+
+
+class ConnectionPool(object):
+  """A thread-safe pool of persistent HTTPS connections, kept per domain.
+  Connections are handed out by get(). Once its response has been completely
+  read, a connection should be given back with put(), or thrown away with
+  discard() if anything went wrong. At most "max_size" idle connections are
+  kept for each domain."""
+
+  def __init__(self, max_size=POOL_SIZE, timeout=None):
+    self.max_size = max_size
+    self.timeout = timeout
+    self.idle = {}
+    self.requests = 0
+    self.reused = 0
+    self.lock = threading.Lock()
+
+  def get(self, domain):
+    """Return a tuple of a connection to "domain" and whether it was reused
+    from the pool (False if it was newly created)."""
+    with self.lock:
+      connections = self.idle.get(domain)
+      if connections:
+        return (connections.pop(), True)
+    return (self.connect(domain), False)
+
+  def connect(self, domain):
+    if API_SCHEME == 'http':
+      connection_class = httplib.HTTPConnection
+    else:
+      connection_class = httplib.HTTPSConnection
+    if self.timeout is None:
+      return connection_class(domain)
+    else:
+      return connection_class(domain, timeout=self.timeout)
+
+  def put(self, domain, conex, response=None):
+    """Return a connection to the pool. If "response" says the server will
+    close the connection, or the pool for "domain" is full, it's closed
+    instead."""
+    if response is not None and response.will_close:
+      conex.close()
+      return
+    with self.lock:
+      connections = self.idle.setdefault(domain, [])
+      if len(connections) < self.max_size:
+        connections.append(conex)
+        return
+    conex.close()
+
+  def discard(self, conex):
+    conex.close()
+
+  def clear(self, domain=None):
+    """Close all idle connections (to "domain", or to all domains if None)."""
+    with self.lock:
+      if domain is None:
+        domains = self.idle.keys()
+      else:
+        domains = [domain]
+      connections = []
+      for domain in domains:
+        connections.extend(self.idle.pop(domain, []))
+    for conex in connections:
+      conex.close()
+
+  def count(self, reused):
+    """Record a completed request, and whether its connection was reused."""
+    with self.lock:
+      self.requests += 1
+      if reused:
+        self.reused += 1
+
+  def reuse_rate(self):
+    """Return the fraction of requests which were sent over a reused
+    connection, or None if no requests have been made."""
+    with self.lock:
+      if self.requests == 0:
+        return None
+      return self.reused / self.requests
+
+  def stats_summary(self):
+    rate = self.reuse_rate()
+    if rate is None:
+      return 'No requests made.'
+    return 'Reused connections for {} of {} requests ({:0.1f}%).'.format(
+      self.reused, self.requests, 100*rate)
+
+
+POOL = ConnectionPool()
+
+
+class RateLimiter(object):
+  """Paces requests to spread out the remaining API budget, using the
+  X-RateLimit headers of every response.
+  It's a token bucket: it holds up to "burst" requests, and refills at the rate
+  which would use up the UserRemaining budget exactly at UserReset. With a full
+  budget that's faster than requests can be made anyway, but as the budget runs
+  low, requests are slowed down to match.
+  Once a quota is within "margin" of running out, it waits for it to reset, if
+  the reset time is known and is at most "max_wait" seconds away (None means
+  any wait is ok). Otherwise make_request() raises NearQuotaException like
+  always. The default "max_wait" of 0 never waits.
+  Each Client-ID has its own quotas, so the state is kept per Client-ID (see
+  Quota). With several of them (see set_client_ids()), choose() picks which to
+  use for each request, and one only has to be waited for once they're all
+  nearly used up. One which is nearly used up without saying when it resets is
+  left out of the choice for "park_time" seconds, then tried again.
+  Requests which get a 429 or 5xx status are retried up to "max_retries" times,
+  with exponential backoff starting at "backoff" seconds, plus random jitter."""
+
+  def __init__(self, burst=10, margin=1, max_wait=0, max_retries=4,
+      backoff=1, park_time=60):
+    self.burst = burst
+    self.margin = margin
+    self.max_wait = max_wait
+    self.max_retries = max_retries
+    self.base_backoff = backoff
+    self.park_time = park_time
+    self.quotas = {}
+    self.lock = threading.Lock()
+
+  def get_quota(self, client_id):
+    """Return the Quota of "client_id". Call with "lock" held."""
+    quota = self.quotas.get(client_id)
+    if quota is None:
+      quota = self.quotas[client_id] = Quota(self.burst)
+    return quota
+
+  def choose(self, client_ids):
+    """Return the one of "client_ids" to make the next request with: the one
+    with the most budget left, out of the ones which aren't nearly used up.
+    Ones nobody has used yet count as having the most. If they're all nearly
+    used up, it's the one which resets soonest."""
+    if len(client_ids) == 1:
+      return client_ids[0]
+    with self.lock:
+      now = time.time()
+      best = None
+      best_budget = None
+      soonest = None
+      soonest_wait = None
+      for client_id in client_ids:
+        quota = self.get_quota(client_id)
+        wait = self.get_reset_wait(quota)
+        if wait is None:
+          # Nearly used up, but the reset time is unknown.
+          wait = max(quota.parked_until - now, 0)
+        if wait:
+          if soonest is None or soonest_wait > wait:
+            (soonest, soonest_wait) = (client_id, wait)
+          continue
+        budget = quota.get_budget()
+        if best is None or (budget is None and best_budget is not None) or (
+            budget is not None and best_budget is not None
+            and budget > best_budget):
+          (best, best_budget) = (client_id, budget)
+      if best is not None:
+        return best
+      if soonest is not None:
+        return soonest
+      return client_ids[0]
+
+  def update(self, response, client_id=None):
+    """Record the rate limit headers from a response to a request made with
+    "client_id"."""
+    user_remaining = get_int_header(response, 'X-RateLimit-UserRemaining')
+    user_reset = get_int_header(response, 'X-RateLimit-UserReset')
+    client_remaining = get_int_header(response, 'X-RateLimit-ClientRemaining')
+    client_reset = get_int_header(response, 'X-RateLimit-ClientReset')
+    with self.lock:
+      quota = self.get_quota(client_id)
+      if user_remaining is not None:
+        quota.user_remaining = user_remaining
+      if user_reset is not None:
+        quota.user_reset = user_reset
+      if client_remaining is not None:
+        quota.client_remaining = client_remaining
+      if client_reset is not None:
+        quota.client_reset = client_reset
+      quota.refill(self.burst)
+      now = time.time()
+      if self.get_reset_wait(quota) is None:
+        quota.parked_until = now + self.park_time
+      if (quota.user_remaining is not None and quota.user_reset is not None
+          and quota.user_reset > now):
+        budget = max(quota.user_remaining - self.margin, 0)
+        quota.rate = budget / (quota.user_reset - now)
+      else:
+        quota.rate = None
+
+  def get_reset_wait(self, quota):
+    """If one of "quota"'s limits is nearly used up, return how many seconds
+    until it resets (None if unknown). Returns 0 if neither is near its
+    limit."""
+    now = time.time()
+    if quota.user_remaining is not None and quota.user_remaining <= self.margin:
+      if quota.user_reset is None:
+        return None
+      return max(quota.user_reset - now, 0)
+    if (quota.client_remaining is not None
+        and quota.client_remaining <= self.margin):
+      if quota.client_reset is None:
+        return None
+      return max(quota.client_reset - now, 0)
+    return 0
+
+  def can_wait(self, client_id=None):
+    """Return whether a nearly used up quota should be waited for, instead of
+    giving up."""
+    with self.lock:
+      wait = self.get_reset_wait(self.get_quota(client_id))
+    if wait is None:
+      return False
+    return self.max_wait is None or wait <= self.max_wait
+
+  def can_continue(self, client_ids):
+    """Return whether requests can go on once one of "client_ids" is nearly
+    used up: whether another one still has budget left, or the wait for one to
+    reset is allowed."""
+    for client_id in client_ids:
+      with self.lock:
+        wait = self.get_reset_wait(self.get_quota(client_id))
+      if wait == 0:
+        return True
+    return any(self.can_wait(client_id) for client_id in client_ids)
+
+  def acquire(self, client_id=None):
+    """Block until the next request can be made with "client_id".
+    If its quota is nearly used up (and it's ok to wait), the quota is paused
+    until it resets, and every request with it waits for that, not just the
+    first one to notice."""
+    while True:
+      reset_wait = 0
+      with self.lock:
+        quota = self.get_quota(client_id)
+        now = time.time()
+        if quota.paused_until and quota.paused_until <= now:
+          # Assume the budget is back once it resets.
+          quota.paused_until = 0
+          quota.user_remaining = None
+          quota.client_remaining = None
+          quota.rate = None
+          quota.tokens = self.burst
+        if not quota.paused_until:
+          reset_wait = self.get_reset_wait(quota)
+          if reset_wait and (self.max_wait is None
+                             or reset_wait <= self.max_wait):
+            quota.paused_until = now + reset_wait + 1
+          else:
+            reset_wait = 0
+        pause = quota.paused_until - now
+        if pause <= 0:
+          quota.refill(self.burst)
+          quota.tokens -= 1
+          if quota.tokens >= 0 or not quota.rate:
+            wait = 0
+          else:
+            wait = -quota.tokens / quota.rate
+          break
+      if reset_wait:
+        sys.stderr.write('Near the request quota. Waiting {:0.0f} seconds for '
+          'it to reset.\n'.format(reset_wait))
+      time.sleep(pause)
+    if wait:
+      time.sleep(wait)
+
+  def backoff(self, attempt, response=None):
+    """Sleep before retry number "attempt" (starting at 0). Honors a
+    Retry-After header, if "response" has one."""
+    delay = None
+    if response is not None:
+      delay = get_int_header(response, 'Retry-After')
+    if delay is None:
+      delay = self.base_backoff * 2**attempt
+      delay = delay/2 + random.uniform(0, delay/2)
+    time.sleep(delay)
+
+
+SCHEDULER = RateLimiter()
+
+
+class Quota(object):
+  """The rate limit state of one Client-ID, as last reported by the API, and
+  its token bucket (see RateLimiter)."""
+
+  def __init__(self, burst):
+    self.user_remaining = None
+    self.user_reset = None
+    self.client_remaining = None
+    self.client_reset = None
+    self.rate = None
+    self.tokens = burst
+    self.last_refill = time.time()
+    # Until when choose() passes over it (see RateLimiter.park_time).
+    self.parked_until = 0
+    # Until when acquire() holds back all requests, waiting for it to reset.
+    self.paused_until = 0
+
+  def get_budget(self):
+    """Return the number of requests left before one of the limits is hit, or
+    None if that isn't known yet."""
+    remaining = [value for value in (self.user_remaining, self.client_remaining)
+                 if value is not None]
+    if remaining:
+      return min(remaining)
+    return None
+
+  def refill(self, burst):
+    now = time.time()
+    if self.rate is not None:
+      elapsed = now - self.last_refill
+      self.tokens = min(burst, self.tokens + elapsed*self.rate)
+    self.last_refill = now
+
+
+# Set by set_client_ids(), if there's more than one Client-ID to use.
+CLIENT_IDS = None
+
+
+def set_client_ids(client_ids):
+  """Spread the API requests over all of "client_ids" (a list), instead of just
+  the one passed to make_request() (see RateLimiter.choose()). Returns the
+  first, to pass along where a single Client-ID is expected."""
+  global CLIENT_IDS
+  # Drop duplicates, but keep the order.
+  unique = []
+  for client_id in client_ids:
+    if client_id not in unique:
+      unique.append(client_id)
+  if len(unique) > 1:
+    CLIENT_IDS = unique
+  else:
+    CLIENT_IDS = None
+  return unique[0]
+
+
+def get_int_header(response, header):
+  try:
+    return int(response.getheader(header))
+  except (ValueError, TypeError):
+    return None
+
+
+class ResponseCache(object):
+  """An on-disk cache of API responses, keyed by domain, path, and params.
+  Each response is kept in its own file in "cache_dir". Responses stay fresh
+  for the TTL of their endpoint (from "ttls", a list of (regex, seconds)
+  tuples matched against the path). After that they're revalidated with their
+  ETag, if they had one. Reading an entry updates its file's modification
+  time, and once the files add up to more than "max_bytes", the least recently
+  used ones are deleted.
+  The size of the files is counted once, then kept up to date as they're
+  written. (Other processes' writes are only counted once it's recounted, when
+  the cache looks full.)"""
+
+  def __init__(self, cache_dir, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+      ttls=RESPONSE_TTLS):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.ttls = [(re.compile(pattern), ttl) for (pattern, ttl) in ttls]
+    self.lock = threading.Lock()
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    self.total = sum(size for (mtime, size, path) in self.list_files())
+
+  def get_ttl(self, path):
+    for (pattern, ttl) in self.ttls:
+      if pattern.search(path):
+        return ttl
+    return None
+
+  def is_fresh(self, entry, path):
+    return time.time() - entry['time'] < self.get_ttl(path)
+
+  def get_filename(self, key):
+    return os.path.join(self.cache_dir, hashlib.sha1(key).hexdigest()+'.json')
+
+  def get(self, key):
+    """Return the cached entry for "key", or None."""
+    filename = self.get_filename(key)
+    try:
+      with open(filename) as filehandle:
+        entry = json.load(filehandle)
+      os.utime(filename, None)
+    except (IOError, OSError, ValueError):
+      return None
+    if entry.get('key') != key:
+      return None
+    return entry
+
+  def put(self, key, response, data):
+    entry = {
+      'key':key,
+      'time':time.time(),
+      'status':response.status,
+      'etag':response.getheader('ETag'),
+      'headers':response.getheaders(),
+      'data':data,
+    }
+    self.write(key, entry)
+    if self.total > self.max_bytes:
+      self.evict()
+
+  def refresh(self, key, entry):
+    """Mark "entry" as fresh again, after the server said it's unchanged."""
+    entry['time'] = time.time()
+    self.write(key, entry)
+
+  def write(self, key, entry):
+    filename = self.get_filename(key)
+    temp_file = '{}.{}.{}.tmp'.format(filename, os.getpid(),
+      threading.current_thread().ident)
+    with open(temp_file, 'w') as filehandle:
+      json.dump(entry, filehandle)
+      size = filehandle.tell()
+    try:
+      old_size = os.path.getsize(filename)
+    except OSError:
+      old_size = 0
+    os.rename(temp_file, filename)
+    with self.lock:
+      self.total += size - old_size
+
+  def list_files(self):
+    """Return a (mtime, size, path) tuple for each entry's file."""
+    files = []
+    for filename in os.listdir(self.cache_dir):
+      if not filename.endswith('.json'):
+        continue
+      path = os.path.join(self.cache_dir, filename)
+      try:
+        stats = os.stat(path)
+      except OSError:
+        continue
+      files.append((stats.st_mtime, stats.st_size, path))
+    return files
+
+  def evict(self):
+    """Recount the size of the cache and, if it doesn't fit in "max_bytes",
+    delete the least recently used entries until it's down to
+    RESPONSE_CACHE_LOW_WATER of that."""
+    with self.lock:
+      files = sorted(self.list_files())
+      total = sum(size for (mtime, size, path) in files)
+      if total > self.max_bytes:
+        for (mtime, size, path) in files:
+          if total <= self.max_bytes*RESPONSE_CACHE_LOW_WATER:
+            break
+          try:
+            os.remove(path)
+          except OSError:
+            pass
+          total -= size
+      self.total = total
+
+
+class CachedResponse(object):
+  """Stands in for an httplib.HTTPResponse when make_request() answers from the
+  response cache."""
+
+  def __init__(self, entry):
+    self.status = entry['status']
+    self.reason = 'Cached'
+    self.headers = entry['headers']
+    self.will_close = False
+
+  def getheader(self, name, default=None):
+    for (header, value) in self.headers:
+      if header.lower() == name.lower():
+        return value
+    return default
+
+  def getheaders(self):
+    return self.headers
+
+  def read(self):
+    return ''
+
+
+RESPONSE_CACHE = None
+
+
+def enable_response_cache(cache_dir, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttls=RESPONSE_TTLS):
+  """Turn on the response cache for make_request(), storing it in
+  "cache_dir". "ttls" are the TTLs for each kind of endpoint (see
+  RESPONSE_TTLS)."""
+  global RESPONSE_CACHE
+  RESPONSE_CACHE = ResponseCache(cache_dir, max_bytes=max_bytes, ttls=ttls)
+
+
+class Metrics(object):
+  """Counts and timings of the API requests made (and anything else the tools
+  choose to time, with add_time()). Thread-safe.
+  For each endpoint (see ENDPOINTS) it keeps the number of requests by status,
+  the bytes received, and a latency histogram for each of the PHASES. It also
+  keeps the remaining quota as of the latest response. If a log file is
+  opened with open_log(), a line of JSON is appended to it for every request,
+  which gives the quota over time too."""
+
+  def __init__(self):
+    self.requests = collections.Counter()
+    self.bytes = collections.Counter()
+    self.histograms = {}
+    self.totals = collections.Counter()
+    self.quota = {}
+    self.log = None
+    self.lock = threading.Lock()
+
+  def open_log(self, path):
+    self.log = open(path, 'a')
+
+  def record(self, path, status, timings, size=0, response=None):
+    """Record a request for "path" which got "status" (or "cached", if it was
+    answered from the response cache). "timings" is a dict of the seconds
+    spent in each of the PHASES, and "size" is the length of the body as it
+    was sent (so compressed, if it was)."""
+    endpoint = get_endpoint(path)
+    quota = {}
+    if response is not None:
+      for (name, header) in (('user', 'X-RateLimit-UserRemaining'),
+                             ('client', 'X-RateLimit-ClientRemaining')):
+        remaining = get_int_header(response, header)
+        if remaining is not None:
+          quota[name] = remaining
+    with self.lock:
+      self.requests[(endpoint, str(status))] += 1
+      self.bytes[endpoint] += size
+      for (phase, seconds) in timings.items():
+        self.observe(endpoint, phase, seconds)
+        if phase != 'total':
+          self.totals[phase] += seconds
+      self.quota.update(quota)
+      if self.log is not None:
+        event = {'time':round(time.time(), 3), 'endpoint':endpoint,
+          'status':status, 'bytes':size}
+        event['seconds'] = dict((phase, round(seconds, 6))
+                                for (phase, seconds) in timings.items())
+        for (name, remaining) in quota.items():
+          event[name+'_remaining'] = remaining
+        self.log.write(json.dumps(event, sort_keys=True)+'\n')
+        self.log.flush()
+
+  def observe(self, endpoint, phase, seconds):
+    histogram = self.histograms.get((endpoint, phase))
+    if histogram is None:
+      histogram = {'buckets':[0]*len(LATENCY_BUCKETS), 'sum':0, 'count':0}
+      self.histograms[(endpoint, phase)] = histogram
+    for (i, bound) in enumerate(LATENCY_BUCKETS):
+      if seconds <= bound:
+        histogram['buckets'][i] += 1
+        break
+    histogram['sum'] += seconds
+    histogram['count'] += 1
+
+  def add_time(self, name, seconds):
+    """Add "seconds" to the total time spent on "name" (like "match")."""
+    with self.lock:
+      self.totals[name] += seconds
+
+  def write_prometheus(self, filehandle):
+    """Write the metrics in the Prometheus text exposition format."""
+    with self.lock:
+      lines = [
+        '# HELP imgur_requests_total API requests made.',
+        '# TYPE imgur_requests_total counter',
+      ]
+      for ((endpoint, status), count) in sorted(self.requests.items()):
+        lines.append('imgur_requests_total{{endpoint="{}",status="{}"}} {}'
+          .format(endpoint, status, count))
+      lines.append('# HELP imgur_response_bytes_total Bytes of response bodies '
+        'received.')
+      lines.append('# TYPE imgur_response_bytes_total counter')
+      for (endpoint, size) in sorted(self.bytes.items()):
+        lines.append('imgur_response_bytes_total{{endpoint="{}"}} {}'.format(
+          endpoint, size))
+      lines.append('# HELP imgur_request_seconds Time spent in each phase of '
+        'API requests.')
+      lines.append('# TYPE imgur_request_seconds histogram')
+      for ((endpoint, phase), histogram) in sorted(self.histograms.items()):
+        labels = 'endpoint="{}",phase="{}"'.format(endpoint, phase)
+        cumulative = 0
+        for (bound, count) in zip(LATENCY_BUCKETS, histogram['buckets']):
+          cumulative += count
+          lines.append('imgur_request_seconds_bucket{{{},le="{}"}} {}'.format(
+            labels, bound, cumulative))
+        lines.append('imgur_request_seconds_bucket{{{},le="+Inf"}} {}'.format(
+          labels, histogram['count']))
+        lines.append('imgur_request_seconds_sum{{{}}} {}'.format(labels,
+          histogram['sum']))
+        lines.append('imgur_request_seconds_count{{{}}} {}'.format(labels,
+          histogram['count']))
+      lines.append('# HELP imgur_seconds_total Total time spent on each kind of '
+        'work.')
+      lines.append('# TYPE imgur_seconds_total counter')
+      for (name, seconds) in sorted(self.totals.items()):
+        lines.append('imgur_seconds_total{{name="{}"}} {}'.format(name,
+          seconds))
+      lines.append('# HELP imgur_quota_remaining Requests left in the quota, as '
+        'of the latest response.')
+      lines.append('# TYPE imgur_quota_remaining gauge')
+      for (name, remaining) in sorted(self.quota.items()):
+        lines.append('imgur_quota_remaining{{quota="{}"}} {}'.format(name,
+          remaining))
+    filehandle.write('\n'.join(lines)+'\n')
+
+  def summary(self, elapsed=None):
+    """Return a human-readable breakdown of the requests and where the time
+    went."""
+    with self.lock:
+      lines = []
+      if elapsed is not None:
+        lines.append('Total run time: {:0.3f}s'.format(elapsed))
+      endpoints = sorted(set(endpoint for (endpoint, status) in self.requests))
+      for endpoint in endpoints:
+        statuses = ', '.join('{} {}'.format(count, status) for
+                             ((this_endpoint, status), count)
+                             in sorted(self.requests.items())
+                             if this_endpoint == endpoint)
+        line = '{}: {} ({} bytes)'.format(endpoint, statuses,
+          self.bytes[endpoint])
+        histogram = self.histograms.get((endpoint, 'total'))
+        if histogram and histogram['count']:
+          line += ', {:0.3f}s average'.format(histogram['sum']
+                                              / histogram['count'])
+        lines.append(line)
+      if self.totals:
+        lines.append('Time spent: '+', '.join('{} {:0.3f}s'.format(name,
+          seconds) for (name, seconds) in sorted(self.totals.items())))
+      if self.quota:
+        lines.append('Quota remaining: '+', '.join('{} {}'.format(name,
+          remaining) for (name, remaining) in sorted(self.quota.items())))
+    if not lines:
+      return 'No requests made.'
+    return '\n'.join(lines)
+
+
+METRICS = Metrics()
+
+
+def get_endpoint(path):
+  for (pattern, endpoint) in ENDPOINTS:
+    if re.search(pattern, path):
+      return endpoint
+  return 'other'
+
+
+def add_timing(timings, phase, seconds):
+  timings[phase] = timings.get(phase, 0) + seconds
+
+
+def enable_metrics(path):
+  """Record metrics on the run to the file "path". If it ends in ".prom", they're
+  written in the Prometheus text format when the program exits. Otherwise, a
+  line of JSON is appended for every request as it's made."""
+  if path.endswith('.prom'):
+    atexit.register(write_metrics, path)
+  else:
+    METRICS.open_log(path)
+
+
+def write_metrics(path):
+  temp_file = path+'.tmp'
+  with open(temp_file, 'w') as filehandle:
+    METRICS.write_prometheus(filehandle)
+  os.rename(temp_file, path)
+
+
+def start_profiling():
+  """Profile the rest of the run with cProfile, and when the program exits,
+  print a breakdown of where the time went to stderr: by API request phase
+  (from METRICS), then by function. cProfile only sees the main thread, so
+  requests made by worker threads only show up in the first part."""
+  profiler = cProfile.Profile()
+  atexit.register(print_profile, profiler, time.time())
+  profiler.enable()
+
+
+def print_profile(profiler, start):
+  profiler.disable()
+  sys.stderr.write(METRICS.summary(time.time() - start)+'\n')
+  stats = pstats.Stats(profiler, stream=sys.stderr)
+  stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+
+
 def near_quota(response, margin=1):
   """Return a true value if either remaining is within "margin" of the limit,
   false if not.
@@ -119,13 +1142,15 @@ def near_quota(response, margin=1):
 
 
 def human_format(comment):
-  comment['when'] = unicode(datetime.datetime.fromtimestamp(comment['datetime']))
-  return HUMAN_FORMAT.format(**comment)
+  fields = dict(comment)
+  fields['when'] = unicode(datetime.datetime.fromtimestamp(comment['datetime']))
+  return HUMAN_FORMAT.format(**fields)
 
 
 def details_format(comment):
-  comment['when'] = unicode(datetime.datetime.fromtimestamp(comment['datetime']))
-  return DETAILS_FORMAT.format(**comment)
+  fields = dict(comment)
+  fields['when'] = unicode(datetime.datetime.fromtimestamp(comment['datetime']))
+  return DETAILS_FORMAT.format(**fields)
 
 
 def link_format(comment):
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""Match comment text against one or more queries in a single pass."""
+from __future__ import division
+import re
+import sre_compile
+
+BACKREFERENCE_PATTERN = r'\\[1-9]|\(\?P='
+
+
+def get_case_folds():
+  """Return a translate() table for the letters which case-insensitive Unicode
+  regexes treat as the same beyond what lower() says (like "i" and the dotless
+  "\u0131"), mapping each to the first letter of its group. The groups are the
+  re module's own."""
+  folds = {}
+  for group in getattr(sre_compile, '_equivalences', ()):
+    letters = [char for char in group if unichr(char).isalpha()]
+    for char in group:
+      if char != letters[0]:
+        folds[char] = letters[0]
+  return folds
+
+
+CASE_FOLDS = get_case_folds()
+
+
+class Matcher(object):
+  """A set of queries compiled once, to be checked against many comments.
+  All the queries are combined into one alternation, so a comment which
+  matches none of them (the usual case) is rejected by a single regex search,
+  no matter how many queries there are. Only comments which do match are
+  checked against each query, to find out which ones hit.
+  Literal queries are escaped, and case-insensitivity is done with re.I
+  instead of lowercasing every comment."""
+
+  def __init__(self, queries, regex=False, ignore_case=True):
+    self.queries = list(queries)
+    flags = re.UNICODE
+    if ignore_case:
+      flags |= re.IGNORECASE
+    if regex:
+      patterns = self.queries
+    else:
+      patterns = [re.escape(query) for query in self.queries]
+    self.patterns = [re.compile(pattern, flags) for pattern in patterns]
+    # Backreferences would point at the wrong groups once the patterns are
+    # combined, and group names used in more than one pattern can't be combined
+    # at all, so those can only be checked one at a time.
+    if len(patterns) == 1:
+      self.combined = self.patterns[0]
+    elif any(re.search(BACKREFERENCE_PATTERN, pattern) for pattern in patterns):
+      self.combined = None
+    else:
+      try:
+        self.combined = re.compile('|'.join('(?:{})'.format(pattern)
+                                            for pattern in patterns), flags)
+      except re.error:
+        self.combined = None
+
+  def search(self, text):
+    """Return whether "text" matches any of the queries."""
+    if self.combined is None:
+      return any(pattern.search(text) for pattern in self.patterns)
+    return self.combined.search(text) is not None
+
+  def get_hits(self, text):
+    """Return the list of queries which "text" matches (in the order they were
+    given)."""
+    if self.combined is not None:
+      if self.combined.search(text) is None:
+        return []
+      if len(self.patterns) == 1:
+        return self.queries
+    return [query for (query, pattern) in zip(self.queries, self.patterns)
+            if pattern.search(text)]
+
+
+def fold_case(text):
+  """Return "text" (unicode) with the case of its letters folded: two strings
+  fold to the same thing if they'd match each other as literal queries with
+  ignore_case (given re.IGNORECASE|re.UNICODE). That's for indexes of the text
+  to look up, so they find the same comments a search would."""
+  return text.lower().translate(CASE_FOLDS)
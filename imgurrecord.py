@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""A compact form of comments, for keeping lots of them in memory and on disk.
+The API returns each comment as a dict of over a dozen fields, but only a few
+are ever used. Those get a slot each in a Comment, and the rest are kept as one
+JSON string, which is only decoded if something asks for them."""
+from __future__ import division
+import json
+
+# The fields the tools use (in the order they're encoded in).
+FIELDS = ('id', 'datetime', 'ups', 'downs', 'points', 'image_id', 'parent_id',
+  'author', 'comment')
+FIELD_SET = frozenset(FIELDS)
+# Fields whose values repeat a lot, so comments kept together can share one
+# copy of each distinct value (see Comment.share_strings()).
+INTERNED_FIELDS = ('image_id', 'author')
+
+
+class Comment(object):
+  """One comment. It acts like the (read-only) dict the API returned, so it can
+  be used anywhere one of those is, and dict(comment) gives back exactly that
+  dict.
+  If "strings" is given, the values of the INTERNED_FIELDS are shared through
+  it (see share_strings())."""
+  __slots__ = FIELDS + ('extra',)
+
+  def __init__(self, values, extra='{}', strings=None):
+    for (field, value) in zip(FIELDS, values):
+      setattr(self, field, value)
+    self.extra = extra
+    if strings is not None:
+      self.share_strings(strings)
+
+  def share_strings(self, strings):
+    """Replace the values of the INTERNED_FIELDS with the equal ones in the
+    dict "strings" (adding them if they aren't there yet), so all the comments
+    using the same dict keep one copy of each. A dict is meant for a group of
+    comments kept together (like one user's), so it goes away with them."""
+    for field in INTERNED_FIELDS:
+      value = getattr(self, field)
+      if value is not None:
+        setattr(self, field, strings.setdefault(value, value))
+
+  def get_extra(self):
+    """Return a dict of the fields which aren't in FIELDS."""
+    return json.loads(self.extra)
+
+  def __getitem__(self, key):
+    if key in FIELD_SET:
+      return getattr(self, key)
+    return self.get_extra()[key]
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __contains__(self, key):
+    return key in FIELD_SET or key in self.get_extra()
+
+  def keys(self):
+    return list(FIELDS) + self.get_extra().keys()
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __len__(self):
+    return len(self.keys())
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+  def __reduce__(self):
+    return (Comment, ([getattr(self, field) for field in FIELDS], self.extra))
+
+  def __repr__(self):
+    return 'Comment({!r})'.format(dict(self))
+
+
+def from_dict(comment, strings=None):
+  """Return "comment" (a dict from the API) as a Comment. Returns it unchanged
+  if it's already a Comment (but sharing "strings", if given), or can't be made
+  into one because it's missing one of the FIELDS."""
+  if isinstance(comment, Comment):
+    if strings is not None:
+      comment.share_strings(strings)
+    return comment
+  for field in FIELDS:
+    if field not in comment:
+      return comment
+  extra = dict((key, value) for (key, value) in comment.iteritems()
+               if key not in FIELD_SET)
+  return Comment([comment[field] for field in FIELDS],
+    json.dumps(extra, sort_keys=True), strings=strings)
+
+
+def encode(comment):
+  """Return a one-line string encoding "comment" (a Comment or a dict from the
+  API). Normally that's a JSON list of the FIELDS, a tab, and a JSON object of
+  the other fields. Comments missing one of the FIELDS are just encoded as a
+  JSON object."""
+  comment = from_dict(comment)
+  if not isinstance(comment, Comment):
+    return json.dumps(comment)
+  return json.dumps([getattr(comment, field) for field in FIELDS]) \
+    +'\t'+comment.extra
+
+
+def decode(line):
+  """Return the comment in a line written by encode() (or a line of plain
+  JSON). That's a Comment, or a dict for comments which couldn't be made into
+  one."""
+  line = line.rstrip('\r\n')
+  if line.startswith('{'):
+    return json.loads(line)
+  # JSON never has a raw tab in it, so the first one is the separator.
+  (values, extra) = line.split('\t', 1)
+  return Comment(json.loads(values), extra)
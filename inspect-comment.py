@@ -5,16 +5,21 @@ import os
 import sys
 import argparse
 import imgurlib
+import imgurcache
 
 USER_AGENT = 'NBS comment-inspector'
 CONFIG_FILE = 'default.args'  # must be in same directory as script
-API_DOMAIN = 'api.imgur.com'
+API_DOMAIN = imgurlib.API_DOMAIN
 API_PATH = '/3/comment/'
+THREAD_PATH = '/3/gallery/{}/comments'
 
-OPT_DEFAULTS = {}
+OPT_DEFAULTS = {'max_age':None}
 USAGE = "%(prog)s [options]"
 DESCRIPTION = """Get info on a comment, including the upvote/downvote ratio.
-"""
+Give several comments to inspect them all. With --recursive, --replies, or
+--siblings, the whole comment thread of the image is downloaded in one request
+and the related comments are found in it (each image's thread is only
+downloaded once)."""
 EPILOG = """You can include command line arguments from a file by including the
 path to the file, prefixed with "@", as an argument (like "@dir/args.txt"). The
 file should contain normal command line options, one per line. Ones that take
@@ -23,7 +28,7 @@ arguments and the arguments themselves should be on separate lines (e.g. put
 directory, it will automatically include arguments from the file "\
 """+CONFIG_FILE+'"'
 
-PERMALINK_PATTERN = r'^(?:https?://)?imgur\.com/gallery/[^/]{5,7}/comment/(\d+)$'
+PERMALINK_PATTERN = r'^(?:https?://)?imgur\.com/gallery/([^/]{5,7})/comment/(\d+)$'
 COMMENT_ID_PATTERN = r'^\d+$'
 
 def main():
@@ -32,57 +37,245 @@ def main():
     fromfile_prefix_chars='@')
   parser.set_defaults(**OPT_DEFAULTS)
 
-  parser.add_argument('comment_identifier',
+  parser.add_argument('comment_identifiers', metavar='comment_identifier',
+    nargs='+',
     help='The comment ID or the URL to the comment (permalink).')
-  parser.add_argument('-C', '--client-id', required=True,
-    help='Imgur API Client-ID to use. Required, if not provided by an @ file '
-      'like @default.args.')
+  parser.add_argument('-C', '--client-id', required=True, action='append',
+    help='Imgur API Client-ID to use. Give it more than once to spread the '
+      'requests over several, each going to the one with the most quota '
+      'left. Required, if not provided by an @ file like @default.args.')
   parser.add_argument('-u', '--user',
     help='Imgur username. For compatibility only; not required.')
   parser.add_argument('-r', '--recursive', action='store_true',
     help='Show the comment, then show its parent, etc, all the way up the '
       'thread.')
+  parser.add_argument('-R', '--replies', action='store_true',
+    help='After the comment, show all the replies to it, and the replies to '
+      'those, etc.')
+  parser.add_argument('-s', '--siblings', action='store_true',
+    help='After the comment, show the other replies to its parent (or the '
+      'other top-level comments, if it\'s one).')
+  parser.add_argument('-a', '--max-age', type=float,
+    help='Comments already in the local cache (downloaded by the other tools) '
+      'are shown from there instead of requesting them from the API. This sets '
+      'how old (in seconds) a cached comment may be and still be used. Set to '
+      '0 to always use the API. Default: any age.')
+  parser.add_argument('--cache-responses', action='store_true',
+    help='Keep API responses which rarely change (like account IDs) in a local '
+      'cache, and reuse them instead of repeating the request.')
+
+  parser.add_argument('--metrics', metavar='FILE',
+    help='Record metrics on the API requests made (counts, timings, bytes, and '
+      'the remaining quota) to this file. If it ends in ".prom", they\'re '
+      'written in the Prometheus text format at the end. Otherwise, a line of '
+      'JSON is appended for each request.')
+  parser.add_argument('--profile', action='store_true',
+    help='When done, print a breakdown of where the time went to stderr: by '
+      'phase of the API requests, then by function (from cProfile).')
 
   new_argv = imgurlib.include_args_from_file(sys.argv, CONFIG_FILE)
   args = parser.parse_args(new_argv)
+  args.client_id = imgurlib.set_client_ids(args.client_id)
 
-  match = re.search(PERMALINK_PATTERN, args.comment_identifier)
-  if match:
-    comment_id = match.group(1)
+  if args.profile:
+    imgurlib.start_profiling()
+  if args.metrics:
+    imgurlib.enable_metrics(args.metrics)
+
+  if args.cache_responses:
+    imgurcache.enable_response_cache()
+
+  targets = []
+  for identifier in args.comment_identifiers:
+    (image_id, comment_id) = parse_identifier(identifier)
+    if comment_id == '0':
+      fail('Error: That\'s the root comment! (The comment you gave is not a '
+        'reply.)')
+    targets.append((image_id, comment_id))
+
+  if args.max_age == 0:
+    locator = None
   else:
-    match = re.search(COMMENT_ID_PATTERN, args.comment_identifier)
-    if match:
-      comment_id = args.comment_identifier
+    locator = imgurcache.CommentLocator()
+    locator.update()
+
+  use_thread = args.recursive or args.replies or args.siblings
+  threads = {}
+  for (i, (image_id, comment_id)) in enumerate(targets):
+    if i > 0:
+      print
+
+    comment = None
+    thread = None
+    if use_thread:
+      thread = find_thread(threads, comment_id)
+      if thread is None:
+        if image_id is None:
+          comment = get_comment(comment_id, args.client_id, locator,
+            args.max_age)
+          image_id = comment['image_id']
+        thread = get_thread(image_id, args.client_id, threads)
+      if thread is not None and thread.get(comment_id) is None:
+        thread = None
+      if thread is None:
+        sys.stderr.write('Couldn\'t get the thread of comment {}, so its '
+          'replies and siblings can\'t be shown.\n'.format(comment_id))
+
+    if thread is not None:
+      comment = thread.get(comment_id)
+      if args.recursive:
+        comments = thread.get_ancestors(comment)
+      else:
+        comments = []
     else:
-      fail('Error: Unrecognized comment identifier "'+args.comment_identifier
-        +'"')
+      if comment is None:
+        comment = get_comment(comment_id, args.client_id, locator,
+          args.max_age)
+      comments = []
+      if args.recursive:
+        parent_id = str(comment['parent_id'])
+        while parent_id != '0':
+          parent = get_comment(parent_id, args.client_id, locator,
+            args.max_age)
+          comments.insert(0, parent)
+          parent_id = str(parent['parent_id'])
+
+    for ancestor in comments:
+      print imgurlib.details_format(ancestor)
+    print imgurlib.details_format(comment)
+    if thread is None:
+      continue
+    if args.siblings:
+      siblings = thread.get_siblings(comment)
+      print '\n=== {} siblings ==='.format(len(siblings))
+      for sibling in siblings:
+        print imgurlib.details_format(sibling)
+    if args.replies:
+      replies = thread.get_descendants(comment)
+      print '\n=== {} replies ==='.format(len(replies))
+      for (depth, reply) in replies:
+        print indent(imgurlib.details_format(reply), depth)
 
-  if comment_id == '0':
-    fail('Error: That\'s the root comment! (The comment you gave is not a '
-      'reply.)')
 
-  comments = []
-  while comment_id != '0':
+def parse_identifier(identifier):
+  """Return the image id (or None, if it isn't given) and comment id from a
+  permalink or comment id."""
+  match = re.search(PERMALINK_PATTERN, identifier)
+  if match:
+    return (match.group(1), match.group(2))
+  match = re.search(COMMENT_ID_PATTERN, identifier)
+  if match:
+    return (None, identifier)
+  fail('Error: Unrecognized comment identifier "'+identifier+'"')
 
-    path = API_PATH+comment_id
-    (response, comment) = imgurlib.make_request(
-      path,
-      args.client_id,
-      user_agent=USER_AGENT,
-      domain=API_DOMAIN
-    )
-    imgurlib.handle_status(response.status)
 
-    comments.append(comment)
+def get_comment(comment_id, client_id, locator=None, max_age=None):
+  """Return a comment from the local cache (via "locator"), or if it isn't
+  there (or is older than "max_age" seconds), from the API."""
+  if locator is not None:
+    comment = locator.get(comment_id, max_age=max_age)
+    if comment is not None:
+      return comment
+  (response, comment) = imgurlib.make_request(
+    API_PATH+comment_id,
+    client_id,
+    user_agent=USER_AGENT,
+    domain=API_DOMAIN
+  )
+  imgurlib.handle_status(response.status)
+  return comment
 
-    if args.recursive:
-      comment_id = str(comment['parent_id'])
+
+def get_thread(image_id, client_id, threads):
+  """Return the CommentThread of "image_id", or None if the API won't give
+  it. Threads are kept in the "threads" dict (by image id), and reused from
+  there instead of requested again."""
+  if image_id in threads:
+    return threads[image_id]
+  (response, roots) = imgurlib.make_request(
+    THREAD_PATH.format(image_id),
+    client_id,
+    user_agent=USER_AGENT,
+    domain=API_DOMAIN,
+    stream=True
+  )
+  thread = None
+  if response.status == 200 and not isinstance(roots, dict):
+    try:
+      thread = CommentThread(roots)
+    except ValueError:
+      # The data wasn't a list of comments after all (a streamed response is
+      # only found out once it's all been read). Comments get looked up one
+      # at a time instead.
+      pass
+  threads[image_id] = thread
+  return thread
+
+
+def find_thread(threads, comment_id):
+  """Return the thread in "threads" which has the comment "comment_id", if
+  one does."""
+  for thread in threads.values():
+    if thread is not None and thread.get(comment_id) is not None:
+      return thread
+  return None
+
+
+class CommentThread(object):
+  """All the comments on an image, indexed by id, so the ancestors, replies,
+  and siblings of any of them can be found without more requests.
+  "roots" are the top-level comments, each with its replies in "children", as
+  the API gives them."""
+
+  def __init__(self, roots):
+    self.roots = list(roots)
+    self.comments = {}
+    pending = list(self.roots)
+    while pending:
+      comment = pending.pop()
+      self.comments[comment['id']] = comment
+      pending.extend(comment.get('children') or ())
+
+  def get(self, comment_id):
+    return self.comments.get(int(comment_id))
+
+  def get_ancestors(self, comment):
+    """Return the chain of parents of "comment", starting at the top-level
+    one."""
+    ancestors = []
+    parent = self.comments.get(comment['parent_id'])
+    while parent is not None and len(ancestors) < len(self.comments):
+      ancestors.append(parent)
+      parent = self.comments.get(parent['parent_id'])
+    ancestors.reverse()
+    return ancestors
+
+  def get_siblings(self, comment):
+    """Return the other replies to the parent of "comment" (or the other
+    top-level comments)."""
+    parent = self.comments.get(comment['parent_id'])
+    if parent is None:
+      children = self.roots
     else:
-      break
+      children = parent.get('children') or ()
+    return [child for child in children if child['id'] != comment['id']]
+
+  def get_descendants(self, comment):
+    """Return a (depth, reply) tuple for every reply under "comment", in
+    thread order. Direct replies have a depth of 1."""
+    descendants = []
+    pending = [(1, child) for child in reversed(comment.get('children') or ())]
+    while pending:
+      (depth, reply) = pending.pop()
+      descendants.append((depth, reply))
+      pending.extend((depth+1, child)
+                     for child in reversed(reply.get('children') or ()))
+    return descendants
 
-  for comment in reversed(comments):
-    print imgurlib.details_format(comment)
 
+def indent(text, depth):
+  prefix = '  '*depth
+  return '\n'.join(prefix+line for line in text.split('\n'))
 
 def fail(message):
   sys.stderr.write(message+"\n")
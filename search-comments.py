@@ -3,19 +3,34 @@ from __future__ import division
 import re
 import os
 import sys
+import time
+import socket
 import argparse
+import itertools
+import collections
+import multiprocessing
 import imgurlib
 import imgurcache
+import imgurdb
+import imgurdaemon
+import imgurmatch
 
 USER_AGENT = 'NBS comment-searcher'
 CONFIG_FILE = 'default.args'  # must be in same directory as script
-API_DOMAIN = 'api.imgur.com'
+API_DOMAIN = imgurlib.API_DOMAIN
 API_PATH_TEMPLATE = '/3/account/{}/comments'
+CHUNK_SIZE = 2000
+# The encoding of queries, on the command line and in watch lists.
+ENCODING = 'utf8'
+# The first chunk searched in parallel is this big (a page of comments), and
+# each one after is twice as big, up to CHUNK_SIZE.
+FIRST_CHUNK_SIZE = 100
 
 OPT_DEFAULTS = {'limit':20, 'ignore_case':True, 'verbose_mode':True,
-  'verbose':None, 'quiet':None, 'format':'human'}
+  'verbose':None, 'quiet':None, 'format':'human', 'sort':'newest', 'jobs':1}
 USAGE = "%(prog)s [options]"
-DESCRIPTION = """Search all comments by an Imgur user."""
+DESCRIPTION = """Search all comments by an Imgur user. Give several queries
+(or a --watch-list of them) to search for all of them in one pass."""
 EPILOG = """You can include command line arguments from a file by including the
 path to the file, prefixed with "@", as an argument (like "@dir/args.txt"). The
 file should contain normal command line options, one per line. Ones that take
@@ -31,14 +46,29 @@ def main():
     fromfile_prefix_chars='@')
   parser.set_defaults(**OPT_DEFAULTS)
 
-  parser.add_argument('query',
-    help='String to search for.')
-  parser.add_argument('-u', '--user', required=True,
-    help='The username whose comments will be searched. Required, if not '
-      'provided by an @ file like @default.args.')
-  parser.add_argument('-C', '--client-id', required=True,
-    help='Imgur API Client-ID to use. Required, if not provided by an @ file '
-      'like @default.args.')
+  parser.add_argument('queries', metavar='query', nargs='*',
+    help='String to search for. If more than one is given, comments matching '
+      'any of them are found, and each result says which ones it matched.')
+  parser.add_argument('-w', '--watch-list',
+    help='File of queries to search for, one per line (in addition to any '
+      'given on the command line).')
+  parser.add_argument('-u', '--user',
+    help='The username whose comments will be searched. Required (unless using '
+      '--all-users), if not provided by an @ file like @default.args.')
+  parser.add_argument('-a', '--all-users', action='store_true',
+    help='Search the comments of every user in the local cache, instead of '
+      'one user. This only searches what has already been downloaded, and '
+      'makes no API requests. Overrides --user.')
+  parser.add_argument('--image',
+    help='Only search comments on this image (gallery id). Requires '
+      '--all-users.')
+  parser.add_argument('--sort', choices=sorted(imgurdb.ORDERS),
+    help='Order of the results. Anything but "newest" requires --all-users. '
+      'Default: %(default)s')
+  parser.add_argument('-C', '--client-id', required=True, action='append',
+    help='Imgur API Client-ID to use. Give it more than once to spread the '
+      'requests over several, each going to the one with the most quota '
+      'left. Required, if not provided by an @ file like @default.args.')
   parser.add_argument('-c', '--case-sensitive', dest='ignore_case',
     action='store_false',
     help='Don\'t ignore case when searching. Default: '
@@ -64,15 +94,48 @@ def main():
     action='store_const', const=1,
     help='Stop searching once the first hit is found. A shorthand for -l 1. '
       'Default: False')
+  parser.add_argument('-j', '--jobs', type=int,
+    help='Number of processes to search with. The comments are split into '
+      'chunks of up to '+str(CHUNK_SIZE)+' which are searched in parallel. '
+      'With a --limit, only as many comments as it looks like it will take to '
+      'reach it are read ahead. Default: %(default)s')
   parser.add_argument('-q', '--quiet', dest='quiet', action='store_true',
     help='Do not print anything but the results (even if there are none). '
       'Default: '+str(not OPT_DEFAULTS['verbose_mode']))
   parser.add_argument('-V', '--verbose', action='store_true',
     help='Verbose output (print more than just the results). Default: '
       +str(OPT_DEFAULTS['verbose_mode']))
+  parser.add_argument('--cache-responses', action='store_true',
+    help='Keep API responses which rarely change (like account IDs) in a local '
+      'cache, and reuse them instead of repeating the request.')
+  parser.add_argument('-d', '--daemon', action='store_true',
+    help='Send the search to a running search-daemon.py instead of doing it '
+      'here, which is much faster for users it already has in memory. Can\'t '
+      'be used with --all-users.')
+  parser.add_argument('--socket',
+    help='The socket of the search daemon, for --daemon. Default: "'
+      +imgurdaemon.SOCKET_FILENAME+'" in the cache directory.')
+
+  parser.add_argument('--metrics', metavar='FILE',
+    help='Record metrics on the API requests made (counts, timings, bytes, and '
+      'the remaining quota) to this file. If it ends in ".prom", they\'re '
+      'written in the Prometheus text format at the end. Otherwise, a line of '
+      'JSON is appended for each request.')
+  parser.add_argument('--profile', action='store_true',
+    help='When done, print a breakdown of where the time went to stderr: by '
+      'phase of the API requests, then by function (from cProfile).')
 
   new_argv = imgurlib.include_args_from_file(sys.argv, CONFIG_FILE)
   args = parser.parse_args(new_argv)
+  args.client_id = imgurlib.set_client_ids(args.client_id)
+
+  if args.profile:
+    imgurlib.start_profiling()
+  if args.metrics:
+    imgurlib.enable_metrics(args.metrics)
+
+  if args.cache_responses:
+    imgurcache.enable_response_cache()
   
   if args.verbose is None and args.quiet is None:
     if args.format == 'human':
@@ -82,20 +145,71 @@ def main():
   else:
     args.verbose_mode = bool(args.verbose or not args.quiet)
 
-  comments = imgurcache.get_cached_and_live_comments(args.user, args.client_id,
-    user_agent=USER_AGENT)
+  if not (args.user or args.all_users):
+    fail('Error: Either --user or --all-users is required.')
+  if not args.all_users and (args.image or args.sort != 'newest'):
+    fail('Error: --image and --sort require --all-users.')
+  if args.all_users and args.daemon:
+    fail('Error: --daemon can\'t be used with --all-users.')
 
-  hits = 0
-  for comment in comments:
-    match = is_match(comment['comment'], args)
-    if (not args.invert and match) or (args.invert and not match):
-      hits+=1
-      if args.format == 'human':
-        print imgurlib.human_format(comment)
-      elif args.format == 'links':
-        print imgurlib.link_format(comment)
-    if args.limit and hits >= args.limit:
-      break
+  if args.watch_list:
+    with open(args.watch_list) as filehandle:
+      for line in filehandle:
+        if line.rstrip('\r\n'):
+          args.queries.append(line.rstrip('\r\n'))
+  if not args.queries:
+    fail('Error: No query given.')
+  # Comment text is unicode, so the queries have to be too, or non-ASCII ones
+  # won't match anything.
+  try:
+    args.queries = [query.decode(ENCODING) for query in args.queries]
+  except UnicodeDecodeError as error:
+    fail('Error: Queries must be in {}: {}'.format(ENCODING, error))
+  matcher = imgurmatch.Matcher(args.queries, regex=args.regex,
+    ignore_case=args.ignore_case)
+
+  # Inverted searches have to look at everything, so they can't use the index.
+  # Others read only the comments it gives as candidates, and (with a limit)
+  # stop once they've found enough.
+  if args.invert:
+    queries = None
+  else:
+    queries = args.queries
+  if args.daemon:
+    socket_path = args.socket or imgurdaemon.get_socket_path()
+    request = {'user':args.user, 'queries':args.queries, 'regex':args.regex,
+      'ignore_case':args.ignore_case, 'invert':args.invert,
+      'limit':args.limit}
+    results = imgurdaemon.query_daemon(socket_path, request)
+  else:
+    if args.all_users:
+      db = imgurcache.open_comment_db()
+      comments = db.get_comments(queries=queries, regex=args.regex,
+        ignore_case=args.ignore_case, image_id=args.image, order=args.sort)
+    else:
+      account_id = imgurcache.username_to_id(args.user, args.client_id,
+        user_agent=USER_AGENT)
+      comments = imgurcache.get_cached_and_live_comments(args.user,
+        args.client_id, account_id=account_id, queries=queries,
+        regex=args.regex, user_agent=USER_AGENT)
+    if args.jobs > 1:
+      results = search_parallel(comments, args, args.jobs)
+    else:
+      results = search(comments, matcher, args.invert)
+
+  try:
+    hits = print_results(results, args)
+  except socket.error as error:
+    if not args.daemon:
+      raise
+    fail('Error: Couldn\'t reach the search daemon at {}: {}'.format(
+      socket_path, error))
+  except imgurdaemon.DaemonError as error:
+    fail('Error from the search daemon: '+str(error))
+  finally:
+    # Stop any worker processes (or hang up on the daemon) now, instead of
+    # whenever this is garbage collected.
+    results.close()
 
   if args.verbose_mode:
     sys.stderr.write('Found '+str(hits)+' hits.\n')
@@ -105,19 +219,121 @@ def main():
         '(currently '+str(args.limit)+') with the -l option to show more.\n')
     else:
       sys.stderr.write('Search complete. All matching comments were printed.\n')
+    sys.stderr.write(imgurlib.POOL.stats_summary()+'\n')
 
 
-def is_match(text, args):
-  if args.regex:
-    flags = 0
-    if args.ignore_case:
-      flags = re.I
-    return bool(re.search(args.query, text, flags=flags))
-  else:
-    if args.ignore_case:
-      return args.query.lower() in text.lower()
+def print_results(results, args):
+  """Print each (comment, matched) tuple from "results" in the chosen format,
+  up to the limit. Returns the number printed."""
+  hits = 0
+  for (comment, matched) in results:
+    hits+=1
+    if len(args.queries) > 1 and not args.invert:
+      label = ', '.join(matched)
     else:
-      return args.query in text
+      label = None
+    if args.format == 'human':
+      if label:
+        print '['+label+']'
+      print imgurlib.human_format(comment)
+    elif args.format == 'links':
+      if label:
+        print imgurlib.link_format(comment)+'\t'+label
+      else:
+        print imgurlib.link_format(comment)
+    if args.limit and hits >= args.limit:
+      break
+  return hits
+
+
+def search(comments, matcher, invert=False):
+  """Yield a (comment, matched) tuple for each comment which matches, where
+  "matched" is the list of queries it matched. The time spent matching is
+  added to imgurlib.METRICS as "match"."""
+  elapsed = 0
+  try:
+    for comment in comments:
+      start = time.time()
+      matched = matcher.get_hits(comment['comment'])
+      elapsed += time.time() - start
+      if (not invert and matched) or (invert and not matched):
+        yield (comment, matched)
+  finally:
+    imgurlib.METRICS.add_time('match', elapsed)
+
+
+def search_parallel(comments, args, jobs, chunk_size=CHUNK_SIZE):
+  """Same as search(), but split "comments" into chunks and search them in a
+  pool of "jobs" processes. Results are still yielded in the original order.
+  The chunks start small and grow up to "chunk_size", so the first results
+  come quickly. At most "jobs"*2 chunks are ever in flight, and with a limit
+  ("args.limit"), only about as many comments as it should take to reach it,
+  going by the share of them which have matched so far. Once it's reached,
+  no more comments are read (so no more pages are requested), and the workers
+  are stopped."""
+  pool = multiprocessing.Pool(jobs, initializer=init_worker,
+    initargs=(args.queries, args.regex, args.ignore_case, args.invert))
+  try:
+    pending = collections.deque()
+    comments = iter(comments)
+    size = min(FIRST_CHUNK_SIZE, chunk_size)
+    in_flight = 0
+    searched = 0
+    hits = 0
+    done = False
+    while not done or pending:
+      while not done and len(pending) < jobs*2:
+        if args.limit:
+          # Estimate how many more comments it'll take, erring on the high side
+          # when there have been few hits.
+          wanted = (args.limit - hits) * (searched + 1) / (hits + 1)
+          if in_flight >= wanted:
+            break
+        chunk = list(itertools.islice(comments, size))
+        if not chunk:
+          done = True
+          break
+        texts = [comment['comment'] for comment in chunk]
+        pending.append((chunk, pool.apply_async(search_chunk, (texts,))))
+        in_flight += len(chunk)
+        size = min(size*2, chunk_size)
+      if pending:
+        (chunk, result) = pending.popleft()
+        (chunk_hits, elapsed) = result.get()
+        imgurlib.METRICS.add_time('match', elapsed)
+        in_flight -= len(chunk)
+        searched += len(chunk)
+        for (i, matched) in chunk_hits:
+          yield (chunk[i], matched)
+          hits += 1
+          if args.limit and hits >= args.limit:
+            return
+  finally:
+    pool.terminate()
+
+
+# State for the worker processes of search_parallel().
+worker = {}
+
+
+def init_worker(queries, regex, ignore_case, invert):
+  worker['matcher'] = imgurmatch.Matcher(queries, regex=regex,
+    ignore_case=ignore_case)
+  worker['invert'] = invert
+
+
+def search_chunk(texts):
+  """Return a list of (index, matched) tuples for the "texts" which match, and
+  the seconds it took."""
+  start = time.time()
+  matcher = worker['matcher']
+  invert = worker['invert']
+  hits = []
+  for (i, text) in enumerate(texts):
+    matched = matcher.get_hits(text)
+    if (not invert and matched) or (invert and not matched):
+      hits.append((i, matched))
+  return (hits, time.time() - start)
 
 
 def fail(message):
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+from __future__ import division
+import os
+import sys
+import argparse
+import imgurlib
+import imgurcache
+import imgurdaemon
+
+CONFIG_FILE = 'default.args'  # must be in same directory as script
+
+OPT_DEFAULTS = {'memory':512, 'refresh':300, 'verbosity':1}
+USAGE = "%(prog)s [options]"
+DESCRIPTION = """Run a search server which keeps users' comments and search
+indexes in memory between searches, and keeps them up to date in the
+background. Search it with search-comments.py --daemon. Stop it with Ctrl+C."""
+EPILOG = """You can include command line arguments from a file by including the
+path to the file, prefixed with "@", as an argument (like "@dir/args.txt"). The
+file should contain normal command line options, one per line. Ones that take
+arguments and the arguments themselves should be on separate lines (e.g. put
+"-l" on one line, and "10" on the next). If it is present in the script
+directory, it will automatically include arguments from the file "\
+"""+CONFIG_FILE+'"'
+
+
+def main():
+
+  parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG,
+    fromfile_prefix_chars='@')
+  parser.set_defaults(**OPT_DEFAULTS)
+
+  parser.add_argument('-C', '--client-id', required=True, action='append',
+    help='Imgur API Client-ID to use. Give it more than once to spread the '
+      'requests over several, each going to the one with the most quota '
+      'left. Required, if not provided by an @ file like @default.args.')
+  parser.add_argument('-S', '--socket',
+    help='Path of the Unix socket to listen on. Default: "'
+      +imgurdaemon.SOCKET_FILENAME+'" in the cache directory.')
+  parser.add_argument('-m', '--memory', type=int,
+    help='Roughly how much memory (in MB) to use for keeping users\' comments. '
+      'The users searched least recently are dropped to stay under it. '
+      'Default: %(default)s')
+  parser.add_argument('-r', '--refresh', type=int,
+    help='Check for new comments by each user in memory this often (in '
+      'seconds). Default: %(default)s')
+  parser.add_argument('-u', '--user',
+    help='For compatibility only; not used.')
+  parser.add_argument('-q', '--quiet', dest='verbosity', action='store_const',
+    const=0,
+    help='Print nothing but errors.')
+  parser.add_argument('-V', '--verbose', dest='verbosity', action='store_const',
+    const=2,
+    help='Print more about what the daemon is doing.')
+  parser.add_argument('--cache-responses', action='store_true',
+    help='Keep API responses which rarely change (like account IDs) in a local '
+      'cache, and reuse them instead of repeating the request.')
+
+  parser.add_argument('--metrics', metavar='FILE',
+    help='Record metrics on the API requests made (counts, timings, bytes, and '
+      'the remaining quota) to this file. If it ends in ".prom", they\'re '
+      'written in the Prometheus text format at the end. Otherwise, a line of '
+      'JSON is appended for each request.')
+  parser.add_argument('--profile', action='store_true',
+    help='When done, print a breakdown of where the time went to stderr: by '
+      'phase of the API requests, then by function (from cProfile).')
+
+  new_argv = imgurlib.include_args_from_file(sys.argv, CONFIG_FILE)
+  args = parser.parse_args(new_argv)
+  args.client_id = imgurlib.set_client_ids(args.client_id)
+
+  if args.profile:
+    imgurlib.start_profiling()
+  if args.metrics:
+    imgurlib.enable_metrics(args.metrics)
+
+  if args.cache_responses:
+    imgurcache.enable_response_cache()
+
+  if args.socket:
+    socket_path = args.socket
+  else:
+    socket_path = imgurdaemon.get_socket_path()
+  directory = os.path.dirname(socket_path)
+  if directory and not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  daemon = imgurdaemon.SearchDaemon(args.client_id,
+    memory_budget=args.memory*1024*1024, refresh_interval=args.refresh,
+    verbosity=args.verbosity)
+  try:
+    server = imgurdaemon.DaemonServer(socket_path, daemon)
+  except imgurdaemon.DaemonError as error:
+    fail('Error: '+str(error))
+  daemon.start_refresher()
+  if args.verbosity >= 1:
+    sys.stderr.write('Listening on '+socket_path+'\n')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+
+def fail(message):
+  sys.stderr.write(message+"\n")
+  sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+"""Shared setup for the tests: a fake Imgur API server (from bench/) and a
+scratch cache directory, plus a way to run the tools against them."""
+from __future__ import division
+import os
+import imp
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'bench'))
+import fakeimgur
+
+CLIENT_ID = 'test'
+
+
+def load_tool(script):
+  """Import one of the tools as a module (their names have dashes in them)."""
+  name = os.path.splitext(script)[0].replace('-', '_')
+  return imp.load_source(name, os.path.join(ROOT_DIR, script))
+
+
+class FakeAPITestCase(unittest.TestCase):
+  """Starts a server for the FakeImgur made by make_fake() before each test,
+  with an empty cache directory in "cache_dir"."""
+
+  def make_fake(self):
+    return fakeimgur.FakeImgur(user_limit=10**9, client_limit=10**9)
+
+  def setUp(self):
+    self.fake = self.make_fake()
+    self.server = fakeimgur.start_server(self.fake)
+    self.work_dir = tempfile.mkdtemp(prefix='imgur-test.')
+    self.cache_dir = os.path.join(self.work_dir, 'cache')
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.work_dir, ignore_errors=True)
+
+  def use_fake_api(self):
+    """Point the modules imported here at the fake server and the scratch
+    cache directory, for tests which call them directly."""
+    import imgurlib
+    import imgurcache
+    for (module, name, value) in (
+        (imgurcache, 'API_DOMAIN', self.server.get_domain()),
+        (imgurlib, 'API_SCHEME', 'http')):
+      self.addCleanup(setattr, module, name, getattr(module, name))
+      setattr(module, name, value)
+    # Hang up the connections left open to the server, which is about to go.
+    self.addCleanup(imgurlib.POOL.clear)
+    self.addCleanup(os.environ.pop, 'IMGUR_CACHE_DIR', None)
+    os.environ['IMGUR_CACHE_DIR'] = self.cache_dir
+
+  def start_tool(self, script, *args):
+    """Start one of the tools against the fake server, with its stdout piped.
+    Returns the subprocess.Popen."""
+    env = dict(os.environ)
+    env['IMGUR_API_DOMAIN'] = self.server.get_domain()
+    env['IMGUR_API_SCHEME'] = 'http'
+    env['IMGUR_CACHE_DIR'] = self.cache_dir
+    command = [sys.executable, os.path.join(ROOT_DIR, script), '-C',
+      CLIENT_ID] + list(args)
+    return subprocess.Popen(command, env=env, cwd=self.work_dir,
+      stdout=subprocess.PIPE)
+
+  def run_tool(self, script, *args):
+    """Run one of the tools against the fake server and return its stdout."""
+    process = self.start_tool(script, *args)
+    output = process.communicate()[0]
+    self.assertEqual(process.returncode, 0)
+    return output
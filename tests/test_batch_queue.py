@@ -0,0 +1,44 @@
+from __future__ import division
+import os
+import shutil
+import tempfile
+import unittest
+import support
+import imgurcache
+
+
+class BatchQueueTest(unittest.TestCase):
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp(prefix='imgur-test.')
+    self.path = os.path.join(self.work_dir, 'queue.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir, ignore_errors=True)
+
+  def test_interrupted_batch_resumes_from_journal(self):
+    queue = imgurcache.BatchQueue(self.path)
+    queue.add(['a', 'b', 'c'])
+    queue.mark('a', 'done', new_comments=5)
+    queue.mark('b', 'failed', error='oops')
+    # Don't save(), as if the batch was killed.
+    queue = imgurcache.BatchQueue(self.path)
+    self.assertEqual(queue.get_pending(), ['c'])
+    self.assertEqual(queue.by_name['a']['new_comments'], 5)
+    self.assertEqual(queue.by_name['b']['error'], 'oops')
+    queue.save()
+    self.assertFalse(os.path.exists(queue.journal_path))
+    self.assertEqual(imgurcache.BatchQueue(self.path).get_counts(),
+                     {'pending':1, 'done':1, 'failed':1})
+
+  def test_cut_off_journal_line_is_ignored(self):
+    queue = imgurcache.BatchQueue(self.path)
+    queue.add(['a', 'b'])
+    queue.mark('a', 'done')
+    with open(queue.journal_path, 'a') as filehandle:
+      filehandle.write('{"user": "b", "sta')
+    self.assertEqual(imgurcache.BatchQueue(self.path).get_pending(), ['b'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+from __future__ import division
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import support
+import imgurcache
+
+
+class ConcurrentWriteTest(support.FakeAPITestCase):
+
+  def make_fake(self):
+    # Slow enough that the two downloads overlap.
+    return support.fakeimgur.FakeImgur(latency=0.02, user_limit=10**9,
+      client_limit=10**9)
+
+  def test_concurrent_downloads_share_the_cache(self):
+    """Two downloads of the same user through the cache at once should each
+    output every comment, and leave each in the cache exactly once."""
+    processes = [self.start_tool('dl-comments.py', '-q', '-c', '-u', 'x_2000'),
+                 self.start_tool('dl-comments.py', '-q', '-c', '-u', 'x_2000',
+                                 '-j', '4')]
+    for process in processes:
+      output = process.communicate()[0]
+      self.assertEqual(process.returncode, 0)
+      ids = [comment['id'] for comment in json.loads(output)]
+      self.assertEqual(len(set(ids)), 2000)
+      self.assertEqual(ids, sorted(ids, reverse=True))
+    (account_id,) = [name for name in os.listdir(self.cache_dir)
+                     if name.isdigit()]
+    ids = [comment['id'] for comment in
+           imgurcache.get_cached_comments(account_id, cache_dir=self.cache_dir)]
+    self.assertEqual(len(ids), 2000)
+    self.assertEqual(len(set(ids)), 2000)
+
+
+class ResumeLockTest(unittest.TestCase):
+  """Only one writer at a time may hold an account's partial segment, so a
+  second download waits for the first to stop, then resumes from where it
+  left off."""
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp(prefix='imgur-test.')
+    self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+
+  def test_second_writer_waits_then_resumes(self):
+    fake = support.fakeimgur.FakeImgur()
+    comments = [fake.make_comment('x_300', i) for i in range(100)]
+    first = imgurcache.SegmentWriter('1', cache_dir=self.cache_dir,
+      resume=True)
+    first.write(comments, page=0, per_page=100)
+    writers = []
+    thread = threading.Thread(target=lambda: writers.append(
+      imgurcache.SegmentWriter('1', cache_dir=self.cache_dir, resume=True)))
+    thread.start()
+    time.sleep(0.2)
+    self.assertEqual(writers, [])
+    first.close()
+    thread.join()
+    (second,) = writers
+    self.assertEqual(second.count, 100)
+    self.assertEqual([comment['id'] for comment in second.read_written()],
+                     [comment['id'] for comment in comments])
+    second.close()
+
+
+if __name__ == '__main__':
+  support.unittest.main()
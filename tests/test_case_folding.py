@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import shutil
+import tempfile
+import unittest
+import support
+import imgurdb
+import imgurindex
+import imgurmatch
+
+COMMENTS = [
+  {'id':1, 'comment':u'the kapı door'},
+  {'id':2, 'comment':u'Iago said so'},
+  {'id':3, 'comment':u'İstanbul'},
+  {'id':4, 'comment':u'nothing to see'},
+]
+
+
+class CaseFoldingTest(unittest.TestCase):
+  """The indexes used to narrow down searches have to find every comment a
+  case-insensitive search matches, including letters lower() doesn't fold
+  together (like "i" and the dotless "ı")."""
+
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp(prefix='imgur-test.')
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir, ignore_errors=True)
+
+  def get_matching_ids(self, query):
+    matcher = imgurmatch.Matcher([query])
+    return set(comment['id'] for comment in COMMENTS
+               if matcher.search(comment['comment']))
+
+  def test_comment_db(self):
+    db = imgurdb.CommentDB(os.path.join(self.work_dir, 'comments.db'))
+    with db.conn:
+      db.add_comments(1, COMMENTS)
+    for query in (u'the kapi door', u'Ia', u'İ', u'I'):
+      found = set(comment['id'] for comment in db.get_comments([query]))
+      self.assertEqual(found, self.get_matching_ids(query), query)
+    db.close()
+
+  def test_comment_index(self):
+    index = imgurindex.CommentIndex(os.path.join(self.work_dir, 'index.db'))
+    index.add(COMMENTS)
+    for query in (u'the kapi door', u'Ia', u'İ', u'KAPI'):
+      ids = index.candidates(query)
+      if ids is not None:
+        self.assertLessEqual(self.get_matching_ids(query), ids, query)
+    index.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,33 @@
+from __future__ import division
+import sys
+import support
+import imgurrecord
+import imgurdaemon
+
+
+class EvictionTest(support.FakeAPITestCase):
+
+  def setUp(self):
+    support.FakeAPITestCase.setUp(self)
+    self.use_fake_api()
+    self.daemon = imgurdaemon.SearchDaemon(support.CLIENT_ID, memory_budget=1)
+
+  def test_evicted_user_frees_shared_strings(self):
+    """With no room for more than one user, loading others should drop the
+    first one, including the strings its comments shared."""
+    list(self.daemon.search('first_1500', ['the']))
+    entry = self.daemon.users['first_1500']
+    strings = entry.strings
+    self.assertGreater(len(strings), 500)
+    comment = entry.comments[0]
+    self.assertIs(comment.image_id, strings[comment.image_id])
+    del entry, comment
+    for user in ('second_1500', 'third_1500', 'fourth_1500'):
+      list(self.daemon.search(user, ['the']))
+    self.assertEqual(self.daemon.users.keys(), ['fourth_1500'])
+    # Nothing but "strings" here (and getrefcount()'s argument) refers to it.
+    self.assertEqual(sys.getrefcount(strings), 2)
+
+
+if __name__ == '__main__':
+  support.unittest.main()
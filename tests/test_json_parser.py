@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import json
+import unittest
+import support
+import imgurlib
+
+DOCUMENT = {
+  'data':[
+    {'id':12345, 'comment':u'a "quoted" [bracket], {brace} \\ and kapı',
+     'points':-7, 'ratio':0.5, 'deleted':False, 'album_cover':None},
+    {'id':67890, 'comment':u'☃ snow', 'children':[1, [2, 3], {'a':[]}]},
+    [],
+    42,
+  ],
+  'success':True,
+  'status':200,
+}
+
+
+class JSONItemParserTest(unittest.TestCase):
+
+  def parse(self, pieces):
+    parser = imgurlib.JSONItemParser('data')
+    items = []
+    for piece in pieces:
+      items.extend(parser.feed(piece))
+    items.extend(parser.close())
+    return (items, parser.values)
+
+  def check(self, text):
+    expected = json.loads(text)
+    for split in range(len(text)+1):
+      (items, values) = self.parse([text[:split], text[split:]])
+      self.assertEqual(items, expected['data'], split)
+      self.assertEqual(values, {'success':True, 'status':200}, split)
+    (items, values) = self.parse(list(text))
+    self.assertEqual(items, expected['data'])
+
+  def test_splits(self):
+    """Splitting the text anywhere (inside strings, escapes, multibyte
+    characters, numbers, or literals) shouldn't change what's parsed."""
+    self.check(json.dumps(DOCUMENT))
+    self.check(json.dumps(DOCUMENT, ensure_ascii=False).encode('utf8'))
+    self.check(json.dumps(DOCUMENT, indent=2))
+
+  def test_numbers_at_split(self):
+    """A number cut off at the end of a piece isn't complete yet."""
+    parser = imgurlib.JSONItemParser('data')
+    self.assertEqual(parser.feed('{"data": [12'), [])
+    self.assertEqual(parser.feed('34, 5'), [1234])
+    self.assertEqual(parser.feed(']}'), [5])
+    self.assertEqual(parser.close(), [])
+
+  def test_incomplete(self):
+    parser = imgurlib.JSONItemParser('data')
+    parser.feed('{"data": [1, 2')
+    self.assertRaises(ValueError, parser.close)
+
+
+if __name__ == '__main__':
+  unittest.main()
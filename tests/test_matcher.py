@@ -0,0 +1,21 @@
+from __future__ import division
+import unittest
+import support
+import imgurmatch
+
+
+class MatcherTest(unittest.TestCase):
+
+  def test_duplicate_group_names(self):
+    """Regexes which each use the same group name can't go in one alternation,
+    but should still be matched (separately)."""
+    matcher = imgurmatch.Matcher([r'(?P<word>cat)s', r'(?P<word>dog)s'],
+      regex=True)
+    self.assertTrue(matcher.search(u'raining dogs'))
+    self.assertFalse(matcher.search(u'one dog'))
+    self.assertEqual(matcher.get_hits(u'cats and dogs'),
+                     [r'(?P<word>cat)s', r'(?P<word>dog)s'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,71 @@
+from __future__ import division
+import time
+import threading
+import unittest
+import support
+import imgurlib
+
+
+class FakeResponse(object):
+  """Just the rate limit headers of a response."""
+
+  def __init__(self, **headers):
+    self.headers = dict(('X-RateLimit-'+name, str(value))
+                        for (name, value) in headers.items())
+
+  def getheader(self, name, default=None):
+    return self.headers.get(name, default)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+  def setUp(self):
+    self.limiter = imgurlib.RateLimiter(max_wait=None)
+
+  def use_up(self, client_id, reset=None):
+    """Make "client_id"'s quota look nearly used up, resetting at "reset"."""
+    quota = self.limiter.get_quota(client_id)
+    quota.user_remaining = 0
+    quota.user_reset = reset
+
+  def test_acquire_waits_for_reset_in_every_thread(self):
+    """Once one request starts waiting for a quota to reset, others with the
+    same Client-ID shouldn't go ahead while it's still used up."""
+    self.use_up('a', time.time() + 0.5)
+    finished = []
+
+    def acquire():
+      self.limiter.acquire('a')
+      finished.append(time.time())
+
+    start = time.time()
+    threads = [threading.Thread(target=acquire) for i in range(3)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(len(finished), 3)
+    self.assertGreaterEqual(min(finished) - start, 0.5)
+    # The budget is assumed to be back after the reset.
+    self.assertEqual(self.limiter.get_quota('a').paused_until, 0)
+
+  def test_choose_passes_over_unknown_reset(self):
+    """A Client-ID which is used up without saying when it resets shouldn't be
+    chosen while others have budget left, until it's been parked a while."""
+    self.limiter.park_time = 0.2
+    self.limiter.update(FakeResponse(UserRemaining=0), 'a')
+    self.limiter.update(FakeResponse(UserRemaining=5), 'b')
+    self.assertEqual(self.limiter.choose(['a', 'b']), 'b')
+    self.use_up('b', time.time() + 60)
+    # Both used up: the parked one is back first.
+    self.assertEqual(self.limiter.choose(['a', 'b']), 'a')
+    time.sleep(0.2)
+    self.assertEqual(self.limiter.choose(['b', 'a']), 'a')
+
+  def test_choose_prefers_unused(self):
+    self.limiter.get_quota('a').user_remaining = 5
+    self.assertEqual(self.limiter.choose(['a', 'b']), 'b')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+from __future__ import division
+import os
+import re
+import support
+import imgurcache
+
+USER = 'editable_300'
+
+
+class EditableImgur(support.fakeimgur.FakeImgur):
+  """A FakeImgur whose comments by USER are an actual list (newest first),
+  which tests can post to and delete from."""
+
+  def __init__(self, **kwargs):
+    support.fakeimgur.FakeImgur.__init__(self, **kwargs)
+    self.comments = [self.make_comment(USER, i)
+                     for i in range(self.get_num_comments(USER))]
+
+  def post(self, text):
+    comment = dict(self.comments[0], comment=text)
+    comment['id'] += support.fakeimgur.ID_SPACING // 2
+    comment['datetime'] += support.fakeimgur.INTERVAL
+    self.comments.insert(0, comment)
+    return comment
+
+  def handle(self, path, params, client_id=None):
+    if re.search(r'^/3/account/{}/comments/count$'.format(USER), path):
+      return (200, len(self.comments))
+    if re.search(r'^/3/account/{}/comments$'.format(USER), path):
+      per_page = min(int(params.get('perPage', 50)), 100)
+      start = int(params.get('page', 0))*per_page
+      return (200, self.comments[start:start+per_page])
+    return support.fakeimgur.FakeImgur.handle(self, path, params,
+      client_id=client_id)
+
+
+class RefreshTest(support.FakeAPITestCase):
+  """A user who deletes one comment and posts another has the same comment
+  count as before, but the refresh still has to find the new comment."""
+
+  def make_fake(self):
+    return EditableImgur(user_limit=10**9, client_limit=10**9)
+
+  def get_cached_ids(self):
+    (account_id,) = [name for name in os.listdir(self.cache_dir)
+                     if name.isdigit()]
+    return [comment['id'] for comment in
+            imgurcache.get_cached_comments(account_id, cache_dir=self.cache_dir)]
+
+  def search(self, query):
+    return self.run_tool('search-comments.py', '-q', '-L', '-u', USER,
+      query).splitlines()
+
+  def delete_one_post_one(self):
+    del self.fake.comments[150]
+    return self.fake.post(u'zyzzyva')
+
+  def test_search_finds_new_comment(self):
+    self.assertEqual(self.search('zyzzyva'), [])
+    comment = self.delete_one_post_one()
+    self.assertEqual(self.search('zyzzyva'),
+                     [imgurcache.imgurlib.link_format(comment)])
+
+  def test_batch_refresh_finds_new_comment(self):
+    users_file = os.path.join(self.work_dir, 'users.txt')
+    with open(users_file, 'w') as filehandle:
+      filehandle.write(USER+'\n')
+    self.run_tool('dl-comments.py', '-q', '-b', users_file, '--queue', 'q1')
+    self.assertEqual(len(self.get_cached_ids()), 300)
+    comment = self.delete_one_post_one()
+    self.run_tool('dl-comments.py', '-q', '-b', users_file, '--queue', 'q2')
+    self.assertEqual(self.get_cached_ids()[0], comment['id'])
+
+
+if __name__ == '__main__':
+  support.unittest.main()
@@ -0,0 +1,50 @@
+from __future__ import division
+import os
+import shutil
+import tempfile
+import unittest
+import support
+import imgurlib
+
+
+class FakeResponse(object):
+  status = 200
+
+  def getheader(self, name, default=None):
+    return default
+
+  def getheaders(self):
+    return []
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp(prefix='imgur-test.')
+    self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+
+  def get_size(self):
+    return sum(os.path.getsize(os.path.join(self.cache_dir, filename))
+               for filename in os.listdir(self.cache_dir))
+
+  def test_eviction_keeps_running_total(self):
+    """The cache should stay under its limit, keeping the newest entries,
+    without recounting the whole directory on every write."""
+    cache = imgurlib.ResponseCache(self.cache_dir, max_bytes=10000)
+    scans = []
+    list_files = cache.list_files
+    cache.list_files = lambda: scans.append(1) or list_files()
+    for i in range(200):
+      cache.put('key{}'.format(i), FakeResponse(), 'x'*100)
+      self.assertEqual(cache.total, self.get_size())
+      self.assertLessEqual(cache.total, 10000)
+    self.assertIsNotNone(cache.get('key199'))
+    self.assertIsNone(cache.get('key0'))
+    self.assertLess(len(scans), 50)
+    # A new cache on the same directory starts from its actual size.
+    self.assertEqual(imgurlib.ResponseCache(self.cache_dir).total,
+                     self.get_size())
+
+
+if __name__ == '__main__':
+  unittest.main()
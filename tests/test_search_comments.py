@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+import os
+import support
+import imgurlib
+from test_refresh import EditableImgur, USER
+
+
+class SearchLimitTest(support.FakeAPITestCase):
+
+  def count_requests(self, *args):
+    before = self.fake.requests
+    self.run_tool('search-comments.py', '-q', '-u', 'cold_50000', *args)
+    return self.fake.requests - before
+
+  def test_parallel_limit_stops_reading(self):
+    """A limited parallel search of a cold cache shouldn't request any more
+    pages than a serial one."""
+    serial = self.count_requests('-l', '5', 'upvote')
+    self.tearDown()
+    self.setUp()
+    parallel = self.count_requests('-l', '5', '-j', '4', 'upvote')
+    self.assertLessEqual(parallel, serial)
+    self.assertLessEqual(parallel, 5)
+
+
+class NonASCIIQueryTest(support.FakeAPITestCase):
+  """Queries arrive as bytes (from the command line or a watch list), but have
+  to match unicode comment text, with or without the search index."""
+
+  def make_fake(self):
+    return EditableImgur(user_limit=10**9, client_limit=10**9)
+
+  def test_non_ascii_query(self):
+    comment = self.fake.post(u'the kapı door')
+    watch_list = os.path.join(self.work_dir, 'watch.txt')
+    with open(watch_list, 'w') as filehandle:
+      filehandle.write(u'kapı\n'.encode('utf8'))
+    for args in (['kapı'], ['-w', watch_list]):
+      output = self.run_tool('search-comments.py', '-q', '-L', '-u', USER,
+        *args)
+      self.assertEqual(output.splitlines(), [imgurlib.link_format(comment)])
+
+
+if __name__ == '__main__':
+  support.unittest.main()
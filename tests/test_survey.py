@@ -0,0 +1,57 @@
+from __future__ import division
+import math
+import random
+import unittest
+import support
+
+survey = support.load_tool('comment-survey.py')
+
+
+class ReservoirSamplerTest(unittest.TestCase):
+
+  def test_size(self):
+    sampler = survey.ReservoirSampler(5)
+    for item in range(3):
+      sampler.add(item)
+    self.assertEqual(sorted(sampler.sample), [0, 1, 2])
+    for item in range(100):
+      sampler.add(item)
+    self.assertEqual(len(sampler.sample), 5)
+    self.assertEqual(len(set(sampler.sample)), 5)
+
+  def test_uniform(self):
+    """Every item should be about equally likely to end up in the sample, with
+    repeats not counting for more."""
+    random.seed(1)
+    (size, items, trials) = (5, 20, 20000)
+    counts = [0]*items
+    for trial in range(trials):
+      sampler = survey.ReservoirSampler(size)
+      for item in range(items):
+        sampler.add(item)
+        if item % 4 == 0:
+          sampler.add(item)
+      for item in sampler.sample:
+        counts[item] += 1
+    expected = size/items
+    for count in counts:
+      self.assertAlmostEqual(count/trials, expected, delta=0.02)
+
+
+class RunningStatsTest(unittest.TestCase):
+
+  def test_mean_and_stdev(self):
+    values = [random.uniform(0, 100) for i in range(1000)]
+    stats = survey.RunningStats()
+    for value in values:
+      stats.add(value)
+    mean = sum(values)/len(values)
+    stdev = math.sqrt(sum((value - mean)**2 for value in values)
+                      / (len(values) - 1))
+    self.assertAlmostEqual(stats.mean, mean)
+    self.assertAlmostEqual(stats.stdev(), stdev)
+    self.assertAlmostEqual(stats.error(2), 2*stdev/math.sqrt(len(values)))
+
+
+if __name__ == '__main__':
+  unittest.main()